@@ -0,0 +1,123 @@
+# Throughput of whole call flows (player load, scene / room selection, player save, script state integrate and
+# reduce) with a lot of callers at once. Runs against the in-memory redis by default, so it doesn't need a server,
+# and can pretend redis is across a network.
+#
+# run from the repo root (needs creds.json like the server does):
+#   python -m benchmarks.call_flow_bench                                 # memory redis, 1ms per round trip
+#   python -m benchmarks.call_flow_bench memory://?latency_ms=5
+#   python -m benchmarks.call_flow_bench redis://localhost/              # a real server
+import logging
+import sys
+from time import perf_counter
+
+import trio
+
+from spins_halp_line.constants import Script_New_State, Script_Any_Number, Script_End_State
+from spins_halp_line.player import Player
+from spins_halp_line.resources import redis as redis_resource
+from spins_halp_line.resources.numbers import PhoneNumber
+from spins_halp_line.stories.request_context import RequestContext
+from spins_halp_line.stories.story_objects import Script, Scene, Room, SceneAndState, ScriptStateManager
+from spins_halp_line.tasks import _get_task
+from spins_halp_line.util import get_logger
+
+Callers = 200
+# digits each caller presses, one request each
+Presses = ['', '3', '1']
+
+
+class BenchRequest:
+
+    def __init__(self, caller: str, digits: str):
+        self.data = {'From': caller, 'Called': '+15556667777', 'Digits': digits}
+        self.is_text = False
+
+    @property
+    def caller(self):
+        return PhoneNumber(self.data['From'])
+
+    @property
+    def num_called(self):
+        return PhoneNumber(self.data['Called'])
+
+    @property
+    def digits(self):
+        return self.data.get('Digits')
+
+    async def load(self):
+        return self
+
+
+class Hello(Room):
+    Name = 'Bench Hello'
+
+    async def action(self, context):
+        return 'hello'
+
+
+class Goodbye(Room):
+    Name = 'Bench Goodbye'
+
+    async def action(self, context):
+        return 'goodbye'
+
+
+class BenchScene(Scene):
+    Name = 'Bench Scene'
+    Start = [Hello()]
+    Choices = {Hello(): {'1': Goodbye(), '*': Hello()}}
+
+
+async def call(script: Script, number: str):
+    for digits in Presses:
+        request = BenchRequest(number, digits)
+        context = RequestContext(request)
+        if not await script.request_made_by_active_player(request, context):
+            await script.call_could_start_game(request)
+        await script.play(request, context)
+
+
+async def run_tasks(task_status=trio.TASK_STATUS_IGNORED):
+    # what Trio_Task_Task_Object_Runner does with the StateReducer requests hand their shards to, minus the printing
+    async with trio.open_nursery() as nurse:
+        task_status.started()
+        async for task in _get_task:
+            nurse.start_soon(task.do_an_execute, task)
+
+
+async def main(url: str):
+    get_logger().setLevel(logging.WARNING)
+    redis_resource._redis = redis_resource.redis_factory(url)
+    script = Script(
+        'call_flow_bench',
+        {Script_New_State: {Script_Any_Number: SceneAndState(BenchScene(), Script_End_State)}},
+        ScriptStateManager()
+    )
+    numbers = [f'+1415556{n:04}' for n in range(Callers)]
+
+    async with trio.open_nursery() as tasks:
+        await tasks.start(run_tasks)
+
+        start = perf_counter()
+        async with trio.open_nursery() as callers:
+            for number in numbers:
+                callers.start_soon(call, script, number)
+        elapsed = perf_counter() - start
+
+        tasks.cancel_scope.cancel()
+
+    requests = Callers * len(Presses)
+    stats = redis_resource.redis_stats()
+    print(f'{url}: {Callers} callers, {requests} requests in {elapsed:.2f}s')
+    print(f'  {requests / elapsed:8.1f} requests/s')
+    print(f'  {stats["round_trips"] / requests:8.2f} round trips per request')
+    reducer = script.state_manager.reducer_stats
+    print(f'  {reducer["average_batch"]:8.1f} shards per reduce ({reducer["batches"]} reduces), '
+          f'{reducer["average_lag_ms"]:.1f}ms average lag')
+
+    for number in numbers:
+        await Player.reset(number)
+
+
+if __name__ == '__main__':
+    trio.run(main, sys.argv[1] if len(sys.argv) > 1 else 'memory://?latency_ms=1')
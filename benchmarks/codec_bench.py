@@ -0,0 +1,69 @@
+# Compares resources/codec.py against the plain stdlib json we used to use for everything we store.
+#
+# run from the repo root (needs creds.json like the server does):
+#   python -m benchmarks.codec_bench
+import json
+import timeit
+from dataclasses import asdict
+
+from spins_halp_line.player import ScriptInfo, SceneInfo, RoomInfo
+from spins_halp_line.resources import codec
+from spins_halp_line.stories.tele_story_objects import TeleState
+
+Rounds = 2000
+
+
+def tele_state(players: int = 200) -> dict:
+    numbers = [f'+1415555{n:04}' for n in range(players)]
+    state = TeleState(
+        clavae_players=numbers[::2],
+        karen_players=numbers[1::2],
+        clavae_waiting_for_conf=numbers[:20:2],
+        karen_waiting_for_conf=numbers[1:20:2],
+        clavae_in_conf=numbers[20:40:2],
+        karen_in_conf=numbers[21:40:2],
+    )
+    # what gets stored: the lists as plain lists
+    data = {name: list(value) for name, value in asdict(state).items()}
+    data['version'] = 1234
+    data['generation'] = 2
+    return data
+
+
+def player(scenes: int = 6, rooms: int = 8) -> dict:
+    info = ScriptInfo(state='Some_Scene_State', data={'path': 'clavae', 'ready_for_conf': True})
+    for s in range(scenes):
+        scene: SceneInfo = info.add_scene(f'Scene {s}')
+        scene.data['has_pendant'] = bool(s % 2)
+        info.scene_history.append(scene.name)
+        for r in range(rooms):
+            room: RoomInfo = scene.room_state(f'Room {s}.{r}')
+            room.state = 'visited'
+            room.choices.extend(['1', '2', '*'])
+            room.data['timestamp'] = '2021-03-14T12:34:56.789012'
+            scene.rooms_visited.append(room.name)
+
+    return {'version': 12, 'generation': 0, 'scripts': {'telemarketopia': info.to_dict()}}
+
+
+def bench(name: str, data: dict):
+    stdlib_blob = json.dumps(data).encode()
+    codec_blob = codec.encode(data)
+    assert codec.decode(codec_blob) == json.loads(stdlib_blob)
+
+    results = {
+        'stdlib encode': timeit.timeit(lambda: json.dumps(data).encode(), number=Rounds),
+        'codec encode': timeit.timeit(lambda: codec.encode(data), number=Rounds),
+        'stdlib decode': timeit.timeit(lambda: json.loads(stdlib_blob), number=Rounds),
+        'codec decode': timeit.timeit(lambda: codec.decode(codec_blob), number=Rounds),
+    }
+
+    print(f'{name}: stdlib {len(stdlib_blob)} bytes, codec {len(codec_blob)} bytes '
+          f'(backend: {"orjson" if codec.orjson else "stdlib"})')
+    for label, seconds in results.items():
+        print(f'  {label:>14}: {seconds / Rounds * 1_000_000:8.2f}us')
+
+
+if __name__ == '__main__':
+    bench('TeleState', tele_state())
+    bench('Player', player())
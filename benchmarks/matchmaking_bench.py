@@ -0,0 +1,117 @@
+# How long players wait in the conference queues, in simulated time (trio's MockClock) against the in-memory
+# redis. A broadcast text brings a few hundred players back at once, they all reach the conference queue within
+# Rush seconds, and after that there's only the odd request now and then.
+#
+# OnePairPerReduce is how TeleStateManager.do_reduce used to work: one pair per reduce, and reduces only happen
+# after requests.
+#
+# run from the repo root (needs creds.json like the server does):
+#   python -m benchmarks.matchmaking_bench
+import logging
+import random
+
+import trio
+import trio.testing
+
+from spins_halp_line.resources import redis as redis_resource
+from spins_halp_line.stories.matchmaking import Matchmaker
+from spins_halp_line.stories.telemarketopia import TeleStateManager
+from spins_halp_line.stories.telemarketopia_conferences import ConfStartFirst, StoryInfo
+from spins_halp_line.stories.story_objects import StateReducer
+from spins_halp_line.tasks import _get_task
+from spins_halp_line.util import get_logger
+
+Clavae = 400
+Karen = 350
+# seconds it takes everyone to get to the queue
+Rush = 10
+# seconds between requests once the rush is over
+Quiet_Every = 30
+# how long we watch for, in seconds
+Length = 30 * 60
+
+
+class OnePairPerReduce(TeleStateManager):
+    Reduce_Every = None
+
+    async def do_reduce(self, state, shard):
+        if len(state.clavae_waiting_for_conf) >= 1 and len(state.karen_waiting_for_conf) >= 1:
+            clav_p = state.clavae_waiting_for_conf.pop(0)
+            karen_p = state.karen_waiting_for_conf.pop(0)
+            state.clavae_in_conf.append(clav_p)
+            state.karen_in_conf.append(karen_p)
+            self.mark_dirty()
+
+            self.after_save(ConfStartFirst(StoryInfo(clav_p, karen_p, shard)))
+
+        return state
+
+
+async def simulate(manager: TeleStateManager) -> dict:
+    redis_resource._redis = redis_resource.redis_factory('memory://?latency_ms=1')
+    manager.set_key(f'matchmaking_bench:{type(manager).__name__}')
+    await manager.load_from_redis()
+    if manager.Reduce_Every:
+        await manager.start_reducer()
+
+    start = trio.current_time()
+    joined = {}
+    waits = []
+
+    async def run_tasks():
+        async with trio.open_nursery() as nurse:
+            async for task in _get_task:
+                if isinstance(task, StateReducer):
+                    nurse.start_soon(task.execute)
+                elif isinstance(task, ConfStartFirst):
+                    # we only care when they got paired, not the calls
+                    for number in (task.info.c_num.e164, task.info.k_num.e164):
+                        waits.append(trio.current_time() - joined[number])
+
+    async def request(at: float, queue: str = None, number: str = None):
+        await trio.sleep_until(start + at)
+        shard = manager.shard
+        if queue:
+            joined[number] = trio.current_time()
+            shard.append(queue, number)
+        await manager.integrate_shard(shard)
+
+    rand = random.Random(1)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(run_tasks)
+        for n in range(Clavae):
+            nursery.start_soon(request, rand.uniform(0, Rush), 'clavae_waiting_for_conf', f'+1415555{n:04}')
+        for n in range(Karen):
+            nursery.start_soon(request, rand.uniform(0, Rush), 'karen_waiting_for_conf', f'+1416555{n:04}')
+        for at in range(Rush + Quiet_Every, Length, Quiet_Every):
+            nursery.start_soon(request, at)
+
+        await trio.sleep_until(start + Length)
+        nursery.cancel_scope.cancel()
+
+    return {
+        'paired': len(waits),
+        # who could have been paired but wasn't
+        'stranded': 2 * min(Clavae, Karen) - len(waits),
+        'reduces': manager.reducer_stats.get('batches', 0) + manager.reducer_stats.get('timed', 0),
+        'p50': Matchmaker.percentile(waits, 50),
+        'p90': Matchmaker.percentile(waits, 90),
+        'p99': Matchmaker.percentile(waits, 99),
+        'max': max(waits, default=0),
+    }
+
+
+async def main():
+    get_logger().setLevel(logging.WARNING)
+    print(f'{Clavae} Clavae + {Karen} Karen players queue up within {Rush}s, then a request every {Quiet_Every}s '
+          f'for {Length // 60} minutes')
+    print(f'  {"":<18} {"paired":>7} {"stranded":>9} {"reduces":>8} {"p50":>8} {"p90":>8} {"p99":>8} {"max":>8}')
+    for manager in [OnePairPerReduce(), TeleStateManager()]:
+        result = await simulate(manager)
+        print(f'  {type(manager).__name__:<18} {result["paired"]:>7} {result["stranded"]:>9} '
+              f'{result["reduces"]:>8} {result["p50"]:>7.1f}s {result["p90"]:>7.1f}s {result["p99"]:>7.1f}s '
+              f'{result["max"]:>7.1f}s')
+
+
+if __name__ == '__main__':
+    trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
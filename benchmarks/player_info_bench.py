@@ -0,0 +1,148 @@
+# Load / save time and memory for the ScriptInfo tree of a player who has played all the way through
+# (long rooms_visited and choices histories), next to the dataclass infos players used before.
+#
+# Legacy*Info are the dataclasses as they were (from_dict through keyword arguments, asdict to save). Both go
+# through the same codec and sections, so the difference is only the info classes.
+#
+# run from the repo root (needs creds.json like the server does):
+#   python -m benchmarks.player_info_bench
+import timeit
+import tracemalloc
+from dataclasses import dataclass, field, asdict
+from typing import Any, Dict, List
+
+from spins_halp_line.constants import Script_New_State
+from spins_halp_line.player import ScriptInfo, _split_sections, _merge_sections
+from spins_halp_line.resources import codec
+
+Rounds = 500
+Held_Players = 200
+
+
+@dataclass
+class LegacyRoomInfo:
+    name: str
+    state: str = ""
+    fresh_state: bool = True
+    choices: List[str] = field(default_factory=list)
+    data: Dict[Any, Any] = field(default_factory=dict)
+
+    @staticmethod
+    def from_dict(d: dict) -> 'LegacyRoomInfo':
+        return LegacyRoomInfo(
+            name=d.get('name'),
+            state=d.get('state', ""),
+            fresh_state=d.get('fresh_state', True),
+            choices=d.get('choices', []),
+            data=d.get('data', {})
+        )
+
+
+@dataclass
+class LegacySceneInfo:
+    name: str
+    rooms_visited: List[str] = field(default_factory=list)
+    room_states: Dict[str, LegacyRoomInfo] = field(default_factory=dict)
+    room_queue: List[str] = field(default_factory=list)
+    data: Dict[Any, Any] = field(default_factory=dict)
+    ended_early: bool = False
+
+    @staticmethod
+    def from_dict(d: dict) -> 'LegacySceneInfo':
+        return LegacySceneInfo(
+            name=d.get('name'),
+            rooms_visited=d.get('rooms_visited', []),
+            room_states={k: LegacyRoomInfo.from_dict(v) for k, v in d.get("room_states", {}).items()},
+            room_queue=d.get('room_queue', []),
+            data=d.get('data', {}),
+            ended_early=d.get('ended_early', False)
+        )
+
+
+@dataclass
+class LegacyScriptInfo:
+    state: str = Script_New_State
+    scene_states: Dict[str, LegacySceneInfo] = field(default_factory=dict)
+    scene_history: List[str] = field(default_factory=list)
+    text_handler_states: Dict[str, Dict[Any, Any]] = field(default_factory=list)
+    data: Dict[Any, Any] = field(default_factory=dict)
+
+    @staticmethod
+    def from_dict(d: dict):
+        return LegacyScriptInfo(
+            state=d.get("state", Script_New_State),
+            scene_states={k: LegacySceneInfo.from_dict(v) for k, v in d.get("scene_states", {}).items()},
+            scene_history=d.get('scene_history', []),
+            text_handler_states=d.get('text_handler_states', []),
+            data=d.get('data', {})
+        )
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def played_through(scenes: int = 10, rooms: int = 12, visits: int = 40) -> ScriptInfo:
+    info = ScriptInfo(state='Finished', data={'path': 'clavae', 'ready_for_conf': True})
+    for s in range(scenes):
+        scene = info.add_scene(f'Scene {s}')
+        info.scene_history.append(scene.name)
+        for v in range(visits):
+            scene.rooms_visited.append(f'Room {s}.{v % rooms}')
+        for r in range(rooms):
+            room = scene.room_state(f'Room {s}.{r}')
+            room.state = 'visited'
+            room.choices.extend(str(c % 10) for c in range(visits))
+            room.data['timestamp'] = '2021-03-14T12:34:56.789012'
+
+    return info
+
+
+def measure(info_class, position_blob: bytes, register_blob: bytes) -> dict:
+    # what Player.load() does for a script section
+    def load():
+        return info_class.from_dict(_merge_sections(codec.decode(position_blob), codec.decode(register_blob)))
+
+    info = load()
+    merged = _merge_sections(codec.decode(position_blob), codec.decode(register_blob))
+
+    # just building the infos, from_dict keeps the containers it's handed so one dict does for every round
+    def from_dict():
+        return info_class.from_dict(merged)
+
+    # what Player.save() does for a script it handed out
+    def save():
+        p, r = _split_sections(info.to_dict())
+        return codec.encode(p), codec.encode(r)
+
+    load_time = timeit.timeit(load, number=Rounds)
+    from_dict_time = timeit.timeit(from_dict, number=Rounds)
+    save_time = timeit.timeit(save, number=Rounds)
+
+    tracemalloc.start()
+    held = [load() for _ in range(Held_Players)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'load': f'{load_time / Rounds * 1_000_000:8.1f}us',
+        'from_dict': f'{from_dict_time / Rounds * 1_000_000:8.1f}us',
+        'save': f'{save_time / Rounds * 1_000_000:8.1f}us',
+        'memory': f'{current / len(held) / 1024:7.1f}KiB',
+    }
+
+
+def main():
+    position, registers = _split_sections(played_through().to_dict())
+    position_blob, register_blob = codec.encode(position), codec.encode(registers)
+
+    legacy = measure(LegacyScriptInfo, position_blob, register_blob)
+    now = measure(ScriptInfo, position_blob, register_blob)
+
+    print(f'played through player: {len(position_blob) + len(register_blob)} bytes stored')
+    print(f'  {"":>9} {"dataclasses":>12} {"now":>12}')
+    for name in ['load', 'from_dict', 'save', 'memory']:
+        print(f'  {name:>9} {legacy[name]:>12} {now[name]:>12}')
+
+
+if __name__ == '__main__':
+    main()
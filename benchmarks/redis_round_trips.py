@@ -0,0 +1,92 @@
+# Counts redis round trips (and wall time) for the pieces of a simulated call step:
+#   - the caller's player being loaded and saved by the request
+#   - the request's shard changes being integrated into the script state and reduced
+#   - a conference task refreshing and saving both of its players
+#
+# Every round trip is a network hop to redis, so on a hosted redis these counts matter more than the times.
+#
+# run from the repo root (needs creds.json and a redis like the server does):
+#   python -m benchmarks.redis_round_trips
+from time import perf_counter
+
+import trio
+
+from spins_halp_line.player import ScriptInfo
+from spins_halp_line.resources import redis as redis_resource
+from spins_halp_line.stories.tele_constants import Key_ready_for_conf, Telemarketopia_Name
+from spins_halp_line.stories.tele_story_objects import TelePlayer
+from spins_halp_line.stories.telemarketopia import TeleStateManager
+from spins_halp_line.stories.telemarketopia_conferences import StoryInfo, ConferenceTask
+
+Steps = 50
+_clavae = '+14155550180'
+_karen = '+14155550181'
+
+
+def round_trips() -> int:
+    return redis_resource.redis_stats().get('round_trips', 0)
+
+
+async def measure(results: dict, name: str, step):
+    start_trips = round_trips()
+    start = perf_counter()
+    await step()
+    results.setdefault(name, []).append((round_trips() - start_trips, perf_counter() - start))
+
+
+async def main():
+    for number in [_clavae, _karen]:
+        await TelePlayer.reset(number)
+        player = TelePlayer(number)
+        await player.load()
+        player.set_script(Telemarketopia_Name, ScriptInfo())
+        await player.save()
+
+    state = TeleStateManager()
+    state.set_key('script_state_bench_round_trips')
+    await state.reset()
+
+    info = StoryInfo(_clavae, _karen, state.shard)
+    task = ConferenceTask(info)
+    results = {}
+
+    for n in range(Steps):
+        player = TelePlayer(_clavae)
+
+        async def caller():
+            await player.load()
+            player.script(Telemarketopia_Name).state = f'step {n}'
+            await player.save()
+
+        async def shard_update():
+            shard = state.shard
+            shard.append('clavae_players', f'+1415555{n:04}')
+            # what the StateReducer does with a batch of one shard
+            await state.reduce(shard.take_changes())
+
+        async def conference():
+            await task.refresh_players()
+            info.clv_p.timestamp(Key_ready_for_conf)
+            info.kar_p.timestamp(Key_ready_for_conf)
+            await info.save()
+
+        await measure(results, 'player load + save', caller)
+        await measure(results, 'shard integrate + reduce', shard_update)
+        await measure(results, 'conference refresh + save', conference)
+
+    total = 0
+    print(f'{Steps} call steps:')
+    for name, samples in results.items():
+        trips = sum(t for t, _ in samples) / len(samples)
+        ms = sum(s for _, s in samples) / len(samples) * 1000
+        total += trips
+        print(f'  {name:>26}: {trips:5.1f} round trips {ms:7.2f}ms')
+    print(f'  {"total":>26}: {total:5.1f} round trips per step')
+
+    await TelePlayer.reset(_clavae)
+    await TelePlayer.reset(_karen)
+    await state.reset()
+
+
+if __name__ == '__main__':
+    trio.run(main)
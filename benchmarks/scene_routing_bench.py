@@ -0,0 +1,181 @@
+# What routing a request costs in Scene.play: picking the next room from the player's digits and path, finding the
+# room by name and checking if the scene is done.
+#
+# LegacyRouting is how scenes used to route, re-deriving everything from the nested Choices dicts on every
+# request (isinstance checks, wrapping single rooms in lists, hashing rooms by name, and debug lines that format
+# whole Choices entries even with debug logging off). The scene is a PathScene
+# shaped like the tip line's, with Rooms rooms in a loop.
+#
+# run from the repo root (needs creds.json like the server does):
+#   python -m benchmarks.scene_routing_bench
+import logging
+from time import perf_counter
+from typing import Dict, List, Optional
+
+import trio
+
+from benchmarks.call_flow_bench import BenchRequest
+from spins_halp_line.player import ScriptInfo
+from spins_halp_line.stories.story_objects import Room
+from spins_halp_line.stories.tele_story_objects import PathScene
+from spins_halp_line.util import get_logger
+
+Rooms = 30
+Routes = 100000
+Paths = ['Clavae', 'Karen']
+
+
+class BenchRoom(Room):
+
+    def __init__(self, n: int):
+        super(BenchRoom, self).__init__()
+        self.Name = f'Bench Room {n}'
+
+    async def action(self, context):
+        return self.Name
+
+
+def _choices(rooms: List[Room]) -> dict:
+    choices = {}
+    for n, room in enumerate(rooms):
+        after = rooms[(n + 1) % len(rooms)]
+        choices[room] = {
+            path: {'1': after, '2': [after, rooms[(n + 2) % len(rooms)]], '*': room} for path in Paths
+        }
+    return choices
+
+
+class BenchPathScene(PathScene):
+    Name = 'Bench Path Scene'
+    Start = [BenchRoom(0)]
+    Choices = _choices([BenchRoom(n) for n in range(Rooms)])
+
+
+# Scene and PathScene's routing before SceneGraph, as it was (logging and all)
+class LegacyRouting(BenchPathScene):
+
+    def __init__(self):
+        super(LegacyRouting, self).__init__()
+        self._room_index: Dict[str, Room] = {}
+        for r in self.Start:
+            self._add_to_index(r)
+        for r, paths in self.Choices.items():
+            self._add_to_index(r)
+            for path, room_dict in paths.items():
+                for choice, room_choice in room_dict.items():
+                    self._add_to_index(room_choice)
+
+    def _add_to_index(self, room_list):
+        if not isinstance(room_list, list):
+            room_list = [room_list]
+        for room in room_list:
+            if room.Name not in self._room_index:
+                self._room_index[room.Name] = room
+
+    def _name_to_room(self, room_name: str) -> Optional[Room]:
+        return self._room_index[room_name]
+
+    def done(self, info: ScriptInfo) -> bool:
+        done = False
+        self.d(f"done?")
+        our_info = info.scene(self.Name)
+        if our_info:
+            if our_info.ended_early:
+                done = True
+                self.d(f"done! - ended early {done}")
+            elif not our_info.room_queue:
+                prev_room = self._name_to_room(our_info.prev_room)
+                if not prev_room:
+                    done = True
+                    self.d(f"done! - no previous room {done}")
+                else:
+                    done = self.choices_for_room(prev_room) is None
+                    self.d(f"done? {done}")
+            else:
+                self.d(f"not done - have rooms in queue {done}")
+        else:
+            self.d(f"not done - we have not run the scene yet! {done}")
+        return done
+
+    def choices_for_room(self, room):
+        choices = self.Choices.get(room, None)
+        self.d(f"Choices_for_room({room}) -> {choices}")
+        return choices
+
+    def _get_state(self, info: ScriptInfo):
+        scene_state = info.scene(self.Name)
+        if not scene_state:
+            scene_state = info.add_scene(self.Name)
+            scene_state.room_queue = self._item_to_room_name_list(self.Start)
+        return scene_state
+
+    def _get_queue(self, request, script_state: ScriptInfo, our_info) -> List[str]:
+        self.d(f"_get_queue()")
+        if our_info.has_rooms_in_queue:
+            self.d(f"Returning existing queue: {our_info.room_queue}")
+            return our_info.room_queue
+        queue = []
+        prev_room = self._name_to_room(our_info.prev_room)
+        number = str(request.digits)
+        self.d(f"_get_queue() {number=} previous room: {prev_room}")
+        if self.choices_for_room(prev_room) is not None:
+            queue = self._get_choice_for_request(number, prev_room, script_state)
+        return self._item_to_room_name_list(queue)
+
+    def _get_choice_for_request(self, number: str, room: Room, script_state: ScriptInfo):
+        path = script_state.data.get('path')
+        path_options = self.Choices.get(room)
+        if len(path_options.keys()) == 1:
+            room_choices = path_options.get(path, path_options.get('*'))
+        else:
+            room_choices = path_options[path]
+        self.d(f"_get_choice_for_request({number}) choices: {room_choices}")
+        queue = []
+        if number in room_choices:
+            queue = room_choices[number]
+            self.d(f"Choice #{number}: {queue}")
+        elif '*' in room_choices:
+            queue = room_choices['*']
+            self.d(f"Choice *: {queue}")
+        if not isinstance(queue, list):
+            queue = [queue]
+        return queue
+
+    @staticmethod
+    def _item_to_room_name_list(obj) -> List[str]:
+        if not isinstance(obj, list):
+            obj = [obj]
+        return [item.Name if isinstance(item, Room) else item for item in obj]
+
+
+# what Scene.play does to route a request, minus the rooms and the bookkeeping around them
+def route(scene: PathScene, request, info: ScriptInfo) -> bool:
+    scene_info = scene._get_state(info)
+    queue = scene._get_queue(request, info, scene_info)
+    room = scene._name_to_room(queue.pop(0))
+    scene_info.rooms_visited[-1] = room.Name
+    return scene.done(info)
+
+
+def measure(scene: PathScene) -> float:
+    info = ScriptInfo(state='Playing', data={'path': 'Karen'})
+    info.add_scene(scene.Name).rooms_visited.append(scene.Start[0].Name)
+    requests = [BenchRequest('+14155550191', digits) for digits in ['1', '2', '7', '1', '']]
+
+    start = perf_counter()
+    for n in range(Routes):
+        route(scene, requests[n % len(requests)], info)
+    return (perf_counter() - start) / Routes
+
+
+async def main():
+    get_logger().setLevel(logging.WARNING)
+    print(f'us to route a request ({Rooms} rooms, {Routes} requests)')
+    for scene in [LegacyRouting(), BenchPathScene()]:
+        # compiling is part of startup, not of a request
+        scene.compile()
+        print(f'  {type(scene).__name__:<16} {measure(scene) * 1e6:8.2f}us')
+
+
+if __name__ == '__main__':
+    trio.run(main)
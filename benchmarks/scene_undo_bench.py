@@ -0,0 +1,57 @@
+# Per-room cost of Scene.play for players with longer and longer histories. Scene.play used to StateCopy (deep
+# copy) the player's whole ScriptInfo before saving a room's changes, in case saving them failed. Now it keeps an
+# UndoLog of just the changes, so the backup shouldn't grow with the history. The StateCopy column is what that
+# deep copy alone costs on the same player.
+#
+# run from the repo root (needs creds.json like the server does):
+#   python -m benchmarks.scene_undo_bench
+import logging
+import timeit
+from time import perf_counter
+
+import trio
+
+from benchmarks.call_flow_bench import BenchRequest, BenchScene
+from spins_halp_line.player import Player, ScriptInfo
+from spins_halp_line.util import StateCopy, get_logger
+
+Rooms = 500
+# (scenes, rooms visited per scene)
+Histories = [(1, 10), (10, 40), (40, 200)]
+
+
+def history(scenes: int, visits: int) -> ScriptInfo:
+    info = ScriptInfo(state='Playing', data={'path': 'clavae'})
+    for s in range(scenes):
+        scene = info.add_scene(f'Old Scene {s}')
+        info.scene_history.append(scene.name)
+        for v in range(visits):
+            scene.rooms_visited.append(f'Room {s}.{v % 12}')
+            room = scene.room_state(f'Room {s}.{v % 12}')
+            room.choices.append(str(v % 10))
+            room.data['timestamp'] = '2021-03-14T12:34:56.789012'
+    return info
+
+
+async def main():
+    get_logger().setLevel(logging.WARNING)
+    scene = BenchScene()
+    player = Player('+14155550190')
+    print(f'ms per room ({Rooms} rooms)')
+    for scenes, visits in Histories:
+        info = history(scenes, visits)
+        request = BenchRequest(player.number.e164, '3')
+        copy = timeit.timeit(lambda: StateCopy(info), number=50) / 50
+
+        # every room adds to the history, so the last plays have a few hundred more visits than we started with
+        start = perf_counter()
+        for _ in range(Rooms):
+            await scene.play(request, player, None, info)
+        play = (perf_counter() - start) / Rooms
+
+        print(f'  {scenes:>3} scenes x {visits:>3} visits: play {play * 1000:7.3f}ms   '
+              f'StateCopy {copy * 1000:7.3f}ms')
+
+
+if __name__ == '__main__':
+    trio.run(main)
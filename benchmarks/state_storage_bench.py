@@ -0,0 +1,68 @@
+# Cost of integrating one shard change into TeleState as the number of players grows, stored as one blob
+# (ScriptStateManager) vs one sorted set per list (FieldStateManager).
+#
+# run from the repo root (needs creds.json like the server does):
+#   python -m benchmarks.state_storage_bench                       # memory redis
+#   python -m benchmarks.state_storage_bench redis://localhost/
+import logging
+import sys
+from time import perf_counter
+
+import trio
+
+from spins_halp_line.resources import redis as redis_resource
+from spins_halp_line.stories.story_objects import ScriptStateManager, FieldStateManager
+from spins_halp_line.stories.tele_story_objects import TeleState
+from spins_halp_line.util import get_logger
+
+Populations = [100, 1000, 5000]
+Changes = 200
+
+
+class BlobManager(ScriptStateManager):
+
+    def _make_new_state(self, base: dict = None) -> TeleState:
+        return TeleState(**(base or {}))
+
+
+class ListsManager(FieldStateManager, BlobManager):
+    pass
+
+
+async def bench(manager: ScriptStateManager, players: int) -> float:
+    manager.set_key(f'bench_state_storage_{manager.__class__.__name__}')
+    await manager.load_from_redis()
+    await manager.reset()
+    await manager.update(lambda state: seed(manager, state, players))
+
+    # only the integrate is timed, making the shard costs the same either way
+    elapsed = 0
+    for n in range(Changes):
+        shard = manager.shard
+        shard.append('clavae_waiting_for_conf', f'+1415557{n:04}')
+        start = perf_counter()
+        await shard.integrate()
+        elapsed += perf_counter() - start
+
+    await manager.reset()
+    return elapsed / Changes * 1000
+
+
+async def seed(manager: ScriptStateManager, state: TeleState, players: int):
+    state.clavae_players = [f'+1415555{n:04}' for n in range(0, players, 2)]
+    state.karen_players = [f'+1415555{n:04}' for n in range(1, players, 2)]
+    manager.mark_dirty()
+
+
+async def main(url: str):
+    get_logger().setLevel(logging.WARNING)
+    redis_resource._redis = redis_resource.redis_factory(url)
+    print(f'{url}: ms per integrated change')
+    for players in Populations:
+        blob = await bench(BlobManager(), players)
+        lists = await bench(ListsManager(), players)
+        print(f'  {players:>5} players: blob {blob:7.3f}ms   lists {lists:7.3f}ms')
+
+
+if __name__ == '__main__':
+    trio.run(main, sys.argv[1] if len(sys.argv) > 1 else 'memory://')
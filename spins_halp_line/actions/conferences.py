@@ -1,35 +1,53 @@
-import json
 from datetime import datetime
 from typing import List, Optional, Dict
 
-import trio
 from twilio.twiml.voice_response import VoiceResponse, Dial, Play
 from twilio.rest.api.v2010.account.conference import ConferenceInstance
 
-from spins_halp_line.constants import Root_Url
+from spins_halp_line.constants import Root_Url, Shared_Workers
 from spins_halp_line.media.common import Conference_Hold_Music
 from spins_halp_line.media.resource_space import RSResource
 from spins_halp_line.resources.numbers import PhoneNumber
-from spins_halp_line.resources.redis import new_redis
+from spins_halp_line.resources.redis import new_redis, RedisBatch, RedisScript
+from spins_halp_line.resources import codec
+from spins_halp_line.resources.locks import Conference_Locks, fenced_set
 from spins_halp_line.util import Logger, LockManager
 from spins_halp_line.actions.twilio import (
     _twilio_client,
     _twil_lock
 )
 
-_last_conference = 0
+# Every conference has its own key in redis (and lock, from Conference_Locks), so whichever process gets a twilio callback can load the
+# conference it's about. Ids come from a counter in redis so processes don't hand out the same one.
+# _conferences is just what this process has loaded; with shared workers it's reloaded from redis before use.
+_conferences: Dict[int, 'TwilConference'] = {}
 
-_conference_lock = trio.Lock()
-# I get why we use strings of object names that haven't been defined yet but like my god
-_conferences: List['TwilConference'] = []
-# This exists because we need to keep track of conferences and how they are progressing
-
-_conference_key = "spins_conference_list"
+_conference_id_key = "spins_conference_id"
+# ids of every conference we know about
+_conference_index_key = "spins_conferences"
+# where all the conferences used to be saved, in one blob. Moved over by load_conferences.
+_conference_list_key = "spins_conference_list"
 
 Conf_Twiml_Path = "/conf/twiml/<c_number>"
 Conf_Status_Path = "/conf/status/<c_number>"
 
 
+# KEYS[1]: the id counter
+# ARGV: an id that's already taken
+def _raise_counter(call, keys, args):
+    if int(call('GET', keys[0]) or 0) < int(args[0]):
+        call('SET', keys[0], args[0])
+    return 1
+
+
+_raise_counter_script = RedisScript("""
+if tonumber(redis.call('GET', KEYS[1]) or 0) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return 1
+""", emulate=_raise_counter)
+
+
 class TwilConference(Logger):
     Event_Conference_Start = 'conference-start'
     Event_Participant_Join = 'participant-join'
@@ -42,48 +60,67 @@ class TwilConference(Logger):
     _callbacks = " ".join(['start', 'end', 'leave', 'join'])
     _custom_handlers = []
 
-    # This function does not use the global conference lock because trio locks are not reentrant and
-    # in theory that should be fine? We should only call this once a lock is established and EVEN IF WE DON'T,
-    # it will not be a problem because this is writing to the persistent database and those writes should be
-    # ordered by redio
-    @classmethod
-    async def _save_conference_list(cls, locked=False):
-        # global _conferences
-        # global _conference_lock
-        db = new_redis()
-        async with LockManager(_conference_lock, locked):
-            await db.set(_conference_key, json.dumps([c.to_redis() for c in _conferences]))  # list of dict
+    @staticmethod
+    def _key(id_: int) -> str:
+        return f'spins_conference:{id_}'
+
+    # Call with our lock held. The write is sent before this returns, so it can't land after we let go of the lock
+    # (and someone else has written a newer copy).
+    async def _save(self):
+        batch = RedisBatch()
+        # if our hold on the lock ran out and someone else has written the conference since, this is dropped
+        fenced_set(self._lock, self._key(self.id), codec.encode(self.to_redis()), batch)
+        batch.sadd(_conference_index_key, self.id)
+        await batch.flush()
+
+    def _load(self, saved_data: dict):
+        self.from_number = PhoneNumber(saved_data.get('from'))
+        self._participating = saved_data.get('participants', {})
+        self.twil_sid = saved_data.get('sid', "")
+        self.intros = saved_data.get('intros', {})
+        started = saved_data.get('started', None)
+        self.started = datetime.fromisoformat(started) if started else None
 
     @classmethod
-    async def from_redis(cls, saved_data, locked=False):
-        # global _conference_lock
-        global _last_conference
-
-        async with LockManager(_conference_lock, locked):
-            int_id = int(saved_data['id'])
-            if int_id > _last_conference:
-                # keep up gid as conference increases
-                _last_conference = int_id
+    async def from_redis(cls, saved_data) -> 'TwilConference':
+        conference = TwilConference(int(saved_data['id']), saved_data.get('from'))
+        conference._load(saved_data)
+        return conference
+
+    # Reloads the conference from redis. Returns False if it isn't there.
+    async def refresh(self) -> bool:
+        saved_data = codec.decode(await new_redis().get(self._key(self.id)))
+        if not saved_data:
+            return False
+        self._load(saved_data)
+        return True
+
+    # Picks up changes other processes made to the conference, if there are other processes
+    async def sync(self):
+        if Shared_Workers:
+            await self.refresh()
 
-            participants = saved_data.get('participants', {})
-            from_num = saved_data.get('from')
-            sid = saved_data.get('sid', "")
-            started = saved_data.get('started', None)
-            if started:
-                started = datetime.fromisoformat(started)
-
-            return TwilConference(int_id, from_num, participants, sid, started)
+    @classmethod
+    async def create(cls, number: PhoneNumber) -> 'TwilConference':
+        new_id = await new_redis().incr(_conference_id_key)
+        return TwilConference(new_id, number)
 
+    # The conference with this id, or None if nobody has made it
     @classmethod
-    async def create(cls, number: PhoneNumber, locked=None) -> 'TwilConference':
-        # global _conference_lock
-        global _last_conference
+    async def get(cls, id_: int) -> Optional['TwilConference']:
+        conference = _conferences.get(id_)
+        if conference is not None and not Shared_Workers:
+            return conference
 
-        async with LockManager(_conference_lock, locked):
-            new_id = _last_conference + 1
-            _last_conference = new_id
+        saved_data = codec.decode(await new_redis().get(cls._key(id_)))
+        if not saved_data:
+            return conference
 
-            return TwilConference(new_id, number)
+        if conference is None:
+            conference = _conferences[id_] = await cls.from_redis(saved_data)
+        else:
+            conference._load(saved_data)
+        return conference
 
     def __init__(self, id_, from_number: PhoneNumber, participants=None, sid=None, started=None):
         super(TwilConference, self).__init__()
@@ -101,6 +138,7 @@ class TwilConference(Logger):
         self._participating: Dict[str, str] = participants
         self.intros: Dict[str, int] = {}
         self.started: Optional[datetime] = started
+        self._lock = Conference_Locks.lock(id_)
 
     @property
     def is_active(self) -> bool:
@@ -154,7 +192,7 @@ class TwilConference(Logger):
             'participants': self._participating,
             'sid': self.twil_sid,
             'started': started,
-            'intros': json.dumps(self.intros)
+            'intros': self.intros
         }
 
     def __str__(self):
@@ -183,7 +221,9 @@ class TwilConference(Logger):
     # conference-start: both people are in
     async def handle_conf_event(self, body) -> str:
 
-        async with LockManager(_conference_lock):
+        async with LockManager(self._lock):
+            # the last callback may have gone to another process
+            await self.sync()
             dirty = False
 
             participant = body.get('ParticipantLabel')
@@ -221,7 +261,7 @@ class TwilConference(Logger):
                 dirty = True
 
             if dirty:
-                await self._save_conference_list(True)
+                await self._save()
 
         return ""
 
@@ -240,22 +280,33 @@ class TwilConference(Logger):
             await handler.event(self, event, participant)
 
     async def add_participant(self, number_to_call: PhoneNumber, play_first: RSResource = None):
-
-        # todo: figure out this whole async machine detection business
-        async with LockManager(_twil_lock):
-            _twilio_client.calls.create(
-                # machine_detection='Enable',
-                # async_amd='true',
-                # async_amd_status_callback='',
-                url=self.twiml_callback,
-                to=number_to_call.e164,
-                from_=self.from_number.e164
-            )
-
-        async with LockManager(_conference_lock):
+        # Saved before we call, since the twiml callback for the call (which wants the intro) can go to any process
+        async with LockManager(self._lock):
+            await self.sync()
             self._participating[number_to_call.e164] = self.Status_Invited
-            self.intros[number_to_call.e164] = play_first.id
-            await self._save_conference_list(True)
+            if play_first is not None:
+                self.intros[number_to_call.e164] = play_first.id
+            await self._save()
+
+        try:
+            # todo: figure out this whole async machine detection business
+            async with LockManager(_twil_lock):
+                _twilio_client.calls.create(
+                    # machine_detection='Enable',
+                    # async_amd='true',
+                    # async_amd_status_callback='',
+                    url=self.twiml_callback,
+                    to=number_to_call.e164,
+                    from_=self.from_number.e164
+                )
+        except Exception:
+            # they were never called, so they aren't invited
+            async with LockManager(self._lock):
+                await self.sync()
+                self._participating.pop(number_to_call.e164, None)
+                self.intros.pop(number_to_call.e164, None)
+                await self._save()
+            raise
 
     async def play_sound(self, sound: RSResource):
         if not self.twil_sid:
@@ -268,16 +319,20 @@ class TwilConference(Logger):
 
     async def twiml_xml(self, number_calling: PhoneNumber) -> VoiceResponse:
         response = VoiceResponse()
-        if number_calling.e164 in self.intros:
-            resource = RSResource(self.intros[number_calling.e164])
+        async with LockManager(self._lock):
+            # add_participant may have been called in another process
+            await self.sync()
+            intro = self.intros.pop(number_calling.e164, None)
+            if intro is not None:
+                # clear flag
+                await self._save()
+
+        if intro is not None:
+            resource = RSResource(intro)
             # hopefully these requests will be cached
             await resource.load()
             play = Play(resource.url, loop=1)
             response.append(play)
-            async with LockManager(_conference_lock):
-                # clear flag
-                del self.intros[number_calling.e164]
-                await self._save_conference_list(True)
 
         dial = Dial()
         self.d(f'Returning conference xml. Hold music url: {Conference_Hold_Music.url}')
@@ -295,28 +350,49 @@ class TwilConference(Logger):
 
 
 async def new_conference(number: PhoneNumber) -> TwilConference:
-    # global _conferences
-    # global _conference_lock
-
-    # will lock and unlock
     new_conf = await TwilConference.create(number)
 
-    async with LockManager(_conference_lock):
-        _conferences.append(new_conf)
-        await TwilConference._save_conference_list(True)
+    async with LockManager(new_conf._lock):
+        _conferences[new_conf.id] = new_conf
+        await new_conf._save()
 
     return new_conf
 
 
+# The conference a twilio callback is about, from the id in its url
+async def get_conference(conf_id: str) -> Optional[TwilConference]:
+    try:
+        return await TwilConference.get(int(conf_id))
+    except ValueError:
+        return None
+
+
 async def load_conferences():
-    async with LockManager(_conference_lock):
-        db = new_redis()
-        confs = await db.get(_conference_key).autodecode  # list of dict
-        if confs:
-            _conferences = [(await TwilConference.from_redis(conf_data, locked=True)) for conf_data in confs]
+    db = new_redis()
+    legacy = codec.decode(await db.get(_conference_list_key))  # list of dict
+    if legacy:
+        for conf_data in legacy:
+            conference = await TwilConference.from_redis(conf_data)
+            async with LockManager(conference._lock):
+                await conference._save()
+        await db.delete(_conference_list_key)
+
+    ids = [int(conf_id) for conf_id in await new_redis().smembers(_conference_index_key)]
+    if not ids:
+        return
+
+    # conferences saved before the counter was in redis
+    await _raise_counter_script.run([_conference_id_key], [max(ids)])
+
+    blobs = await new_redis().mget(*[TwilConference._key(conf_id) for conf_id in ids])
+    if not isinstance(blobs, list):
+        blobs = [blobs]
+    for blob in blobs:
+        conf_data = codec.decode(blob)
+        if conf_data:
+            conference = await TwilConference.from_redis(conf_data)
+            _conferences[conference.id] = conference
 
 
 def conferences() -> List[TwilConference]:
-    # global _conferences
-
-    return _conferences
+    return list(_conferences.values())
@@ -1,4 +1,3 @@
-import trio
 from twilio import rest
 # from greenletio import async_
 # from trio_asyncio import aio_as_trio
@@ -6,11 +5,13 @@ from twilio.base import values
 
 from ..constants import Credentials
 from spins_halp_line.util import LockManager
-from spins_halp_line.tasks import add_task, Task
+from spins_halp_line.resources.locks import LocalLock
+from spins_halp_line.tasks import SharedTask, send_task
 from ..resources.numbers import PhoneNumber, Global_Number_Library
 
 _twilio_client: rest.Client = rest.Client(Credentials["twilio"]["sid"], Credentials["twilio"]["token"])
-_twil_lock = trio.Lock()
+# only guards our twilio client, so other processes (with their own clients) don't need to wait for it
+_twil_lock = LocalLock('twilio')
 
 
 # todo: This is the source of the following error during the tests:
@@ -98,7 +99,7 @@ async def make_call(to_num: PhoneNumber, from_num: PhoneNumber, callback_url: st
         )
 
 
-class TextTask(Task):
+class TextTask(SharedTask):
     Text = ""
     From_Number_Label = None
     Image = values.unset
@@ -107,6 +108,13 @@ class TextTask(Task):
         super(TextTask, self).__init__(delay)
         self.to = to
 
+    def shared_args(self) -> dict:
+        return {'to': self.to.e164}
+
+    @classmethod
+    def from_shared_args(cls, args: dict) -> 'TextTask':
+        return cls(PhoneNumber(args['to']))
+
     async def execute(self):
         image = self.Image
         if self.Image != values.unset:
@@ -124,4 +132,4 @@ class TextTask(Task):
 
 
 async def send_text(TextClass, player_numer: PhoneNumber, delay=0):
-    await add_task.send(TextClass(player_numer, delay))
+    await send_task(TextClass(player_numer, delay))
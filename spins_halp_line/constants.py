@@ -14,3 +14,7 @@ try:
         Credentials = json.loads(f.read())
 except FileNotFoundError:
     pass
+
+# Set "workers": {"shared": true} in creds.json to run more than one server process against the same redis. Anything
+# a request, task or twilio callback needs from another process is then kept in redis instead of in memory.
+Shared_Workers = Credentials.get("workers", {}).get("shared", False)
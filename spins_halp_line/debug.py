@@ -8,6 +8,10 @@ class Restoreable(Protocol):
     def get_snapshot_name(self) -> str:
         pass
 
+    # Optional: return a function that builds what get_snapshot() returns now, for when building it is expensive
+    # and usually won't be needed. See Snapshot.
+    # def snapshot_later(self) -> Callable[[], dict]:
+
 
 class Restoreer(Protocol):
     async def restore_states(self, name: str, shared_state: dict, sub_states: Dict[str, dict]):
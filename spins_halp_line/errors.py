@@ -28,3 +28,28 @@ class StoryNavigationException(WrapException):
 
 class DataIntegrityError(WrapException):
     _NAME = "DataIntegrityError"
+
+
+# Raised when a compare-and-set save finds a newer copy of the object in redis than the one we loaded.
+class SaveConflict(DataIntegrityError):
+    _NAME = "SaveConflict"
+
+    Reason_Generation = 'generation'
+    Reason_Version = 'version'
+
+    def __init__(self, key: str, reason: str, db_generation: int, db_version: int, generation: int, version: int):
+        super(SaveConflict, self).__init__(
+            f'save {key} (g{generation}v{version}) over newer {reason} in redis (g{db_generation}v{db_version})'
+        )
+        self.key = key
+        self.reason = reason
+        self.db_generation = db_generation
+        self.db_version = db_version
+        self.generation = generation
+        self.version = version
+
+    # Generation conflicts mean a debug restore has replaced the object and our copy should be thrown away.
+    # Version conflicts just mean someone else saved first, so reloading and re-applying the change is fine.
+    @property
+    def retryable(self) -> bool:
+        return self.reason == self.Reason_Version
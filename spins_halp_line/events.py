@@ -4,9 +4,17 @@ from typing import Set
 import trio
 from trio import MemorySendChannel
 
+from spins_halp_line.constants import Shared_Workers
+from spins_halp_line.resources.redis import new_redis, new_pubsub
+from spins_halp_line.tasks import Task
+
 # https://gitlab.com/pgjones/quart/-/blob/master/examples/websocket/websocket.py
 event_websocket_channels: Set[MemorySendChannel] = set()
 
+# With shared workers an event can happen in one process while the websocket is open on another, so events go
+# through this redis channel and every process's EventRelay hands them to its own websockets.
+_event_channel = 'spins_events'
+
 
 def event_websocket(func):
     @wraps(func)
@@ -22,10 +30,35 @@ def event_websocket(func):
     return wrapper
 
 
-async def send_event(text: str):
+async def _send_local_event(text: str):
     global event_websocket_channels
     try:
         for channel in event_websocket_channels:
             await channel.send(text)
     except Exception as e:
         print(f"Got exception {e} in send_event")
+
+
+async def send_event(text: str):
+    if not Shared_Workers:
+        return await _send_local_event(text)
+
+    try:
+        await new_redis().publish(_event_channel, text)
+    except Exception as e:
+        print(f"Got exception {e} publishing event")
+
+
+# Passes events published by any process to the websockets open on this one
+class EventRelay(Task):
+    # how long to wait before subscribing again if we lose redis
+    Retry_After = 1
+
+    async def execute(self):
+        while True:
+            try:
+                async for message in new_pubsub(_event_channel):
+                    await _send_local_event(message.decode() if isinstance(message, bytes) else message)
+            except Exception as e:
+                self.e(f'Lost the event channel: {e}')
+            await trio.sleep(self.Retry_After)
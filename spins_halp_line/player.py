@@ -1,43 +1,98 @@
 import json
-from dataclasses import dataclass, field, asdict
-from typing import Any, Dict, Optional, List, Union
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, List, Union, Callable, Tuple
 
 from spins_halp_line.constants import Script_New_State, Script_End_State
+from spins_halp_line.errors import SaveConflict
+from spins_halp_line.resources import codec
 from spins_halp_line.resources.numbers import PhoneNumber
-from spins_halp_line.resources.redis import new_redis
-from spins_halp_line.util import Logger
+from spins_halp_line.resources.redis import new_redis, RedisScript, RedisBatch
+from spins_halp_line.util import Logger, RequestStats
 
 
-@dataclass
-class RoomInfo:
-    name: str
-    state: str = ""
-    fresh_state: bool = True
-    choices: List[str] = field(default_factory=list)
-    data: Dict[Any, Any] = field(default_factory=dict)  # the only field exposed to Rooms
+# Base for the per-player state trees. These used to be dataclasses, but a player who has played all the
+# way through has hundreds of these, and `asdict` / `from_dict` with keyword arguments were most of the
+# cost of loading and saving them. Subclasses list their fields in `__slots__` and write their own
+# to_dict / from_dict.
+#
+# They don't keep track of what changed: the player encodes the scripts it handed out when it saves and only
+# writes the sections whose encoding changed (see Player._changed_fields). So dicts and lists are kept as they
+# are, and changing something deep inside data, or a dict you assigned into it, is saved like anything else.
+class _PlayerInfo:
+    __slots__ = ()
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    # mutable, like the dataclasses were
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ", ".join(f'{k}={v!r}' for k, v in self.to_dict().items())
+        return f'{self.__class__.__name__}({fields})'
+
+
+class RoomInfo(_PlayerInfo):
+    __slots__ = ('name', 'state', 'fresh_state', 'choices', 'data')
+
+    def __init__(self,
+                 name: str,
+                 state: str = "",
+                 fresh_state: bool = True,
+                 choices: List[str] = None,
+                 data: Dict[Any, Any] = None):
+        self.name = name
+        self.state = state
+        self.fresh_state = fresh_state
+        self.choices = choices if choices is not None else []
+        self.data = data if data is not None else {}  # the only field exposed to Rooms
 
     @staticmethod
     def from_dict(d: dict) -> 'RoomInfo':  # "python type system is great"
-        return RoomInfo(
-            name=d.get('name'),
-            state=d.get('state', ""),
-            fresh_state=d.get('fresh_state', True),
-            choices=d.get('choices', []),
-            data=d.get('data', {})
-        )
+        # skips __init__, d was just decoded so everything in it is ours
+        info = object.__new__(RoomInfo)
+        info.name = d.get('name')
+        info.state = d.get('state', "")
+        info.fresh_state = d.get('fresh_state', True)
+        info.choices = d.get('choices', [])
+        info.data = d.get('data', {})
+        return info
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'state': self.state,
+            'fresh_state': self.fresh_state,
+            'choices': list(self.choices),
+            'data': dict(self.data)
+        }
+
+    def compact(self, policy: 'HistoryPolicy') -> List[dict]:
+        trimmed = policy.trim(self.choices, policy.choices)
+        return [{'room': self.name, 'choices': trimmed}] if trimmed else []
 
     def __str__(self):
         return f'RoomInfo[{self.name}]'
 
 
-@dataclass
-class SceneInfo:
-    name: str
-    rooms_visited: List[str] = field(default_factory=list)
-    room_states: Dict[str, RoomInfo] = field(default_factory=dict)
-    room_queue: List[str] = field(default_factory=list)
-    data: Dict[Any, Any] = field(default_factory=dict)  # the only field exposed to Rooms
-    ended_early: bool = False
+class SceneInfo(_PlayerInfo):
+    __slots__ = ('name', 'rooms_visited', 'room_states', 'room_queue', 'data', 'ended_early')
+
+    def __init__(self,
+                 name: str,
+                 rooms_visited: List[str] = None,
+                 room_states: Dict[str, RoomInfo] = None,
+                 room_queue: List[str] = None,
+                 data: Dict[Any, Any] = None,
+                 ended_early: bool = False):
+        self.name = name
+        self.rooms_visited = rooms_visited if rooms_visited is not None else []
+        self.room_states = room_states if room_states is not None else {}
+        self.room_queue = room_queue if room_queue is not None else []
+        self.data = data if data is not None else {}  # the only field exposed to Rooms
+        self.ended_early = ended_early
 
     def room_state(self, name: str) -> RoomInfo:
         if name not in self.room_states:
@@ -47,14 +102,39 @@ class SceneInfo:
 
     @staticmethod
     def from_dict(d: dict) -> 'SceneInfo':  # "python type system is great"
-        return SceneInfo(
-            name=d.get('name'),
-            rooms_visited=d.get('rooms_visited', []),
-            room_states={k: RoomInfo.from_dict(v) for k, v in d.get("room_states", {}).items()},
-            room_queue=d.get('room_queue', []),
-            data=d.get('data', {}),
-            ended_early=d.get('ended_early', False)
-        )
+        info = object.__new__(SceneInfo)
+        info.name = d.get('name')
+        info.rooms_visited = d.get('rooms_visited', [])
+        info.room_states = {k: RoomInfo.from_dict(v) for k, v in d.get("room_states", {}).items()}
+        info.room_queue = d.get('room_queue', [])
+        info.data = d.get('data', {})
+        info.ended_early = d.get('ended_early', False)
+        return info
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'rooms_visited': list(self.rooms_visited),
+            'room_states': {k: v.to_dict() for k, v in self.room_states.items()},
+            'room_queue': list(self.room_queue),
+            'data': dict(self.data),
+            'ended_early': self.ended_early
+        }
+
+    def compact(self, policy: 'HistoryPolicy') -> List[dict]:
+        keep = policy.rooms_visited
+        if keep is not None:
+            # prev_room needs at least the last room
+            keep = max(keep, 1)
+
+        trimmed = policy.trim(self.rooms_visited, keep)
+        entries = [{'rooms_visited': trimmed}] if trimmed else []
+        for room in self.room_states.values():
+            entries.extend(room.compact(policy))
+
+        for entry in entries:
+            entry['scene'] = self.name
+        return entries
 
     @property
     def prev_room(self) -> Optional[str]:
@@ -77,13 +157,20 @@ class SceneInfo:
 # todo: First, should make managing events easser - new event, new dict
 # todo: Second, should help with housekeeping from multiple places
 
-@dataclass
-class ScriptInfo:
-    state: str = Script_New_State
-    scene_states: Dict[str, SceneInfo] = field(default_factory=dict)
-    scene_history: List[str] = field(default_factory=list)
-    text_handler_states: Dict[str, Dict[Any, Any]] = field(default_factory=list)
-    data: Dict[Any, Any] = field(default_factory=dict)  # the only field exposed to Rooms
+class ScriptInfo(_PlayerInfo):
+    __slots__ = ('state', 'scene_states', 'scene_history', 'text_handler_states', 'data')
+
+    def __init__(self,
+                 state: str = Script_New_State,
+                 scene_states: Dict[str, SceneInfo] = None,
+                 scene_history: List[str] = None,
+                 text_handler_states: Dict[str, Dict[Any, Any]] = None,
+                 data: Dict[Any, Any] = None):
+        self.state = state
+        self.scene_states = scene_states if scene_states is not None else {}
+        self.scene_history = scene_history if scene_history is not None else []
+        self.text_handler_states = text_handler_states if text_handler_states is not None else []
+        self.data = data if data is not None else {}  # the only field exposed to Rooms
 
     def add_scene(self, name: str) -> SceneInfo:
         info = SceneInfo(name=name)
@@ -100,13 +187,29 @@ class ScriptInfo:
 
     @staticmethod
     def from_dict(d: dict):
-        return ScriptInfo(
-            state=d.get("state", Script_New_State),
-            scene_states={k: SceneInfo.from_dict(v) for k, v in d.get("scene_states", {}).items()},
-            scene_history=d.get('scene_history', []),
-            text_handler_states=d.get('text_handler_states', []),
-            data=d.get('data', {})
-        )
+        info = object.__new__(ScriptInfo)
+        info.state = d.get("state", Script_New_State)
+        info.scene_states = {k: SceneInfo.from_dict(v) for k, v in d.get("scene_states", {}).items()}
+        info.scene_history = d.get('scene_history', [])
+        info.text_handler_states = d.get('text_handler_states', [])
+        info.data = d.get('data', {})
+        return info
+
+    def to_dict(self) -> dict:
+        return {
+            'state': self.state,
+            'scene_states': {k: v.to_dict() for k, v in self.scene_states.items()},
+            'scene_history': list(self.scene_history),
+            'text_handler_states': self.text_handler_states.copy(),
+            'data': dict(self.data)
+        }
+
+    def compact(self, policy: 'HistoryPolicy') -> List[dict]:
+        trimmed = policy.trim(self.scene_history, policy.scene_history)
+        entries = [{'scene_history': trimmed}] if trimmed else []
+        for scene in self.scene_states.values():
+            entries.extend(scene.compact(policy))
+        return entries
 
     def __str__(self):
         return f'ScriptInfo[{self.state}]{self.scene_history}] -> {list(self.scene_states.keys())}'
@@ -152,6 +255,303 @@ class ScriptInfo:
 # todo:     (like now but w/o `data` members) (plr:+14156864014:telemarketopia:position)
 # todo: - script / scene / room storage (plr:+14156864014:telemarketopia:reg)
 # todo: - events associated with player & script (plr:+14156864014:telemarketopia:event:<name>)
+#
+# That's now how players are stored (apart from events, which nothing uses yet), except the sections are fields
+# of a single hash at plr:<number> rather than separate keys (so we can still check-and-set the whole player in
+# one go):
+#   generation / version               -> ints
+#   active                             -> the name of the script the player is playing (see active_script)
+#   <script>:position                  -> ScriptInfo with all `data` / `text_handler_states` taken out
+#   <script>:reg                       -> just the `data` / `text_handler_states` parts of ScriptInfo
+# Sections are only decoded when a script asks for its ScriptInfo, only scripts that were decoded get encoded
+# and only sections whose encoding changed get written back. Players still stored as one json blob are read as before and converted on their next save.
+
+_position_section = 'position'
+_register_section = 'reg'
+
+# fields of ScriptInfo / SceneInfo / RoomInfo that go in the register section
+_register_fields = {'data', 'text_handler_states'}
+# fields that hold dictionaries of child infos which need to be split up too
+_nested_fields = {'scene_states', 'room_states'}
+
+
+def _split_sections(info: dict) -> Tuple[dict, dict]:
+    position = {}
+    registers = {}
+    for name, value in info.items():
+        if name in _register_fields:
+            # empty registers are the default, no need to store them
+            if value:
+                registers[name] = value
+        elif name in _nested_fields:
+            child_positions = {}
+            child_registers = {}
+            for child_name, child in value.items():
+                child_positions[child_name], child_register = _split_sections(child)
+                if child_register:
+                    child_registers[child_name] = child_register
+
+            position[name] = child_positions
+            if child_registers:
+                registers[name] = child_registers
+        else:
+            position[name] = value
+
+    return position, registers
+
+
+def _merge_sections(position: dict, registers: dict) -> dict:
+    merged = dict(position)
+    for name, value in registers.items():
+        if name in _nested_fields:
+            children = dict(merged.get(name, {}))
+            for child_name, child_register in value.items():
+                children[child_name] = _merge_sections(children.get(child_name, {}), child_register)
+            merged[name] = children
+        else:
+            merged[name] = value
+
+    return merged
+
+
+# Three way merge of a section two saves both changed: whatever `ours` changed from `loaded`, on top of `now`
+def _merge_changes(loaded, now, ours):
+    if not isinstance(ours, dict) or not isinstance(now, dict):
+        return ours
+    loaded = loaded if isinstance(loaded, dict) else {}
+
+    merged = dict(now)
+    for name in loaded.keys() - ours.keys():
+        merged.pop(name, None)
+    for name, value in ours.items():
+        if name not in loaded or loaded[name] != value:
+            merged[name] = _merge_changes(loaded.get(name), now.get(name), value)
+    return merged
+
+
+def _section_field(script: str, section: str) -> str:
+    return f'{script}:{section}'
+
+
+# ScriptInfos by script name that are only decoded when someone asks for them
+class _LazyScripts(dict):
+
+    def __init__(self, raw: Dict[str, Dict[str, bytes]] = None):
+        super(_LazyScripts, self).__init__()
+        # script name -> {section name -> encoded section}
+        self._raw = raw if raw is not None else {}
+
+    def _decode(self, name):
+        sections = self._raw.pop(name)
+        position = codec.decode(sections.get(_position_section, b'{}'))
+        registers = codec.decode(sections.get(_register_section, b'{}'))
+        super(_LazyScripts, self).__setitem__(name, ScriptInfo.from_dict(_merge_sections(position, registers)))
+
+    def _decode_all(self):
+        for name in list(self._raw.keys()):
+            self._decode(name)
+
+    @property
+    def decoded(self) -> Dict[str, 'ScriptInfo']:
+        # only the ones we've looked at (and so could have changed)
+        return dict(super(_LazyScripts, self).items())
+
+    def __getitem__(self, name):
+        if name in self._raw:
+            self._decode(name)
+        return super(_LazyScripts, self).__getitem__(name)
+
+    def get(self, name, default=None):
+        if name in self._raw:
+            self._decode(name)
+        return super(_LazyScripts, self).get(name, default)
+
+    def __setitem__(self, name, value):
+        self._raw.pop(name, None)
+        super(_LazyScripts, self).__setitem__(name, value)
+
+    def __contains__(self, name):
+        return name in self._raw or super(_LazyScripts, self).__contains__(name)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return super(_LazyScripts, self).__len__() + len(self._raw)
+
+    def keys(self):
+        return list(super(_LazyScripts, self).keys()) + list(self._raw.keys())
+
+    def items(self):
+        self._decode_all()
+        return super(_LazyScripts, self).items()
+
+    def values(self):
+        self._decode_all()
+        return super(_LazyScripts, self).values()
+
+    def __eq__(self, other):
+        self._decode_all()
+        return super(_LazyScripts, self).__eq__(other)
+
+
+# How much of each history list we keep on the player. Rooms only ever look at the last room visited and
+# recent choices, but the lists used to grow forever, and a player who loops a menu would end up with a blob
+# that got bigger on every call. None keeps everything.
+@dataclass
+class HistoryPolicy:
+    rooms_visited: Optional[int] = 20
+    choices: Optional[int] = 20
+    scene_history: Optional[int] = 20
+    # if set, trimmed entries get appended to the player's archive list instead of being thrown away
+    archive: bool = True
+
+    # Lists are allowed to grow to twice their limit before they get cut back, so that we aren't writing to the
+    # archive on every request
+    @staticmethod
+    def trim(items: list, keep: Optional[int]) -> list:
+        if keep is None or len(items) <= keep * 2:
+            return []
+
+        cut = len(items) - keep
+        trimmed = items[:cut]
+        del items[:cut]
+        return trimmed
+
+
+# Loads a player whichever way they are stored.
+# KEYS[1]: player key
+# ARGV: the fields to load (none to load them all, see Player._fields_for), so a player who has played a lot of
+#       scripts doesn't cost every reader all of them
+# returns: {'hash', field, value, field, value...} or {'string', json blob}
+def _load_player(call, keys, args):
+    if call('TYPE', keys[0]) == 'string':
+        return ['string', call('GET', keys[0])]
+    if not args:
+        return ['hash'] + call('HGETALL', keys[0])
+
+    result = ['hash']
+    for name, value in zip(args, call('HMGET', keys[0], *args)):
+        if value is not None:
+            result.extend([name, value])
+    return result
+
+
+_load_player_script = RedisScript("""
+if redis.call('TYPE', KEYS[1])['ok'] == 'string' then
+    return {'string', redis.call('GET', KEYS[1])}
+end
+if #ARGV == 0 then
+    local result = redis.call('HGETALL', KEYS[1])
+    table.insert(result, 1, 'hash')
+    return result
+end
+
+local result = {'hash'}
+local values = redis.call('HMGET', KEYS[1], unpack(ARGV))
+for i, value in ipairs(values) do
+    if value then
+        table.insert(result, ARGV[i])
+        table.insert(result, value)
+    end
+end
+return result
+""", emulate=_load_player)
+
+
+# Check-and-set for player saves. Doing the check inside redis means a call webhook and a text webhook
+# for the same number can't both read version N and then both write version N+1.
+# KEYS[1]: player key, KEYS[2]: player index, KEYS[3]: player history archive
+# ARGV: our generation, the version we loaded, force ('1' to ignore version conflicts),
+#       replace ('1' to throw away fields we didn't send), # of archive entries, # of fields to delete,
+#       <archive entries>, <fields to delete>, <field, value pairs to set>
+# returns: {saved (1/0), reason, db generation, db version}
+def _save_player(call, keys, args):
+    generation, version = int(args[0]), int(args[1])
+    key_type = call('TYPE', keys[0])
+    db_generation = db_version = 0
+
+    if key_type == 'hash':
+        meta = call('HMGET', keys[0], 'generation', 'version')
+        db_generation = int(meta[0] or 0)
+        db_version = int(meta[1] or 0)
+    elif key_type == 'string':
+        try:
+            data = json.loads(call('GET', keys[0]))
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            db_generation = int(data.get('generation') or 0)
+            db_version = int(data.get('version') or 0)
+
+    if db_generation > generation:
+        return [0, 'generation', db_generation, db_version]
+    if args[2] != b'1' and db_version > version:
+        return [0, 'version', db_generation, db_version]
+
+    if key_type == 'string' or args[3] == b'1':
+        call('DEL', keys[0])
+
+    archived, deletes = int(args[4]), int(args[5])
+    rest = args[6:]
+    if archived:
+        call('RPUSH', keys[2], *rest[:archived])
+    if deletes:
+        call('HDEL', keys[0], *rest[archived:archived + deletes])
+
+    # a forced save can be over a newer version than ours, and versions mustn't go backwards
+    version = max(db_version, version) + 1
+    call('HSET', keys[0], 'generation', generation, 'version', version, *rest[archived + deletes:])
+    call('SADD', keys[1], keys[0])
+    return [1, 'saved', generation, version]
+
+
+_save_player_script = RedisScript("""
+local generation = tonumber(ARGV[1])
+local version = tonumber(ARGV[2])
+local key_type = redis.call('TYPE', KEYS[1])['ok']
+local db_generation = 0
+local db_version = 0
+
+if key_type == 'hash' then
+    local meta = redis.call('HMGET', KEYS[1], 'generation', 'version')
+    db_generation = tonumber(meta[1]) or 0
+    db_version = tonumber(meta[2]) or 0
+elseif key_type == 'string' then
+    -- players saved before the hash layout
+    local ok, data = pcall(cjson.decode, redis.call('GET', KEYS[1]))
+    if ok and type(data) == 'table' then
+        db_generation = tonumber(data['generation']) or 0
+        db_version = tonumber(data['version']) or 0
+    end
+end
+
+if db_generation > generation then
+    return {0, 'generation', db_generation, db_version}
+end
+if ARGV[3] ~= '1' and db_version > version then
+    return {0, 'version', db_generation, db_version}
+end
+
+if key_type == 'string' or ARGV[4] == '1' then
+    redis.call('DEL', KEYS[1])
+end
+
+local archived = tonumber(ARGV[5])
+local deletes = tonumber(ARGV[6])
+if archived > 0 then
+    redis.call('RPUSH', KEYS[3], unpack(ARGV, 7, 6 + archived))
+end
+if deletes > 0 then
+    redis.call('HDEL', KEYS[1], unpack(ARGV, 7 + archived, 6 + archived + deletes))
+end
+
+-- a forced save can be over a newer version than ours, and versions mustn't go backwards
+version = math.max(db_version, version) + 1
+redis.call('HSET', KEYS[1], 'generation', generation, 'version', version, unpack(ARGV, 7 + archived + deletes))
+redis.call('SADD', KEYS[2], KEYS[1])
+return {1, 'saved', generation, version}
+""", emulate=_save_player)
 
 
 class Player(Logger):
@@ -159,42 +559,135 @@ class Player(Logger):
     _scripts_key = 'scripts'
     _generation_key = 'generation'
     _version_key = 'version'
+    # the name of the script the player is playing, see active_script
+    _active_key = 'active'
+
+    # Set of every player key, kept up to date by save() and reset(). This lets us list players without
+    # walking the whole keyspace (which also holds script state, conferences, etc).
+    _index_key = 'plr_index'
+    # Set once rebuild_index() has scanned for players saved before the index, so it only scans the once
+    _index_built_key = 'plr_index:built'
+    # How many players we ask redis for in one go when doing bulk reads
+    _batch_size = 100
+    # What gets trimmed from script histories on save, see HistoryPolicy
+    History = HistoryPolicy()
 
     @classmethod
     async def _get_player_keys(cls, db=None) -> List[str]:
-        # This is a bad method, but I'm not sure how to make it better. There is no documentation in redio about
-        # how to specify a filter in scan (which redis supports but we'd need to format properly) and, in any
-        # case, a filter would still get all keys first but only give friendly some of them. Hopefully a minor
-        # optimization?
         if db is None:
             db = new_redis()
+
+        return sorted(entry.decode("utf-8") for entry in await db.smembers(cls._index_key))
+
+    @classmethod
+    async def rebuild_index(cls, force=False) -> Optional[int]:
+        # Players saved before the index existed are only reachable by scanning. That only needs to happen once,
+        # save() and reset() keep the index up to date after that, so we leave a marker and skip the scan (a walk
+        # over the whole keyspace) on later startups. Pass force to scan anyway.
+        # Returns how many players were found, or None if we skipped the scan.
+        db = new_redis()
+        if not force and await db.get(cls._index_built_key):
+            return None
+
         cursor = "0"
-        players = []
+        found = 0
         while True:
-            scan = await db.scan(cursor)  # don't use autodecode here because the cursor should stay a string I think?
+            scan = await db.scan(cursor, 'MATCH', 'plr:*', 'COUNT', 1000)
             cursor = scan[0].decode("utf-8")  # scan returns bytes
-            these_players = [entry.decode("utf-8") for entry in scan[1] if entry[0:4] == b'plr:']
-            # for entry in these_players:
-            #     print(entry)
-
-            players.extend(these_players)
+            if scan[1]:
+                found += len(scan[1])
+                await db.sadd(cls._index_key, *scan[1])
 
             if cursor == "0":
                 break
 
-        return players
+        await db.set(cls._index_built_key, found)
+        return found
 
     @classmethod
     async def get_all_json(cls) -> dict:
         db = new_redis()
         players = await cls._get_player_keys(db)
         result = {}
-        for player in players:
-            play_dict = await db.get(player).autodecode
-            result[player] = play_dict
+        for start in range(0, len(players), cls._batch_size):
+            batch = players[start:start + cls._batch_size]
+            for player in batch:
+                db.type(player)
+
+            types = await db
+            # redio unwraps single results
+            if len(batch) == 1:
+                types = [types]
+
+            hashes = [player for player, kind in zip(batch, types) if kind == 'hash']
+            # players who are still stored as json blobs
+            legacy = [player for player, kind in zip(batch, types) if kind == 'string']
+
+            for player in hashes:
+                db.hgetall(player)
+            if legacy:
+                db.mget(*legacy)
+
+            if hashes or legacy:
+                replies = await db
+                if len(hashes) + (1 if legacy else 0) == 1:
+                    replies = [replies]
+
+                for player, fields in zip(hashes, replies):
+                    result[player] = cls._data_from_fields(fields)
+                if legacy:
+                    for player, blob in zip(legacy, replies[-1]):
+                        result[player] = codec.decode(blob)
 
         return result
 
+    @classmethod
+    def _data_from_fields(cls, fields: Dict[str, bytes]) -> dict:
+        sections = cls._sections_by_script(fields)
+        return {
+            cls._version_key: int(fields.get(cls._version_key, 0)),
+            cls._generation_key: int(fields.get(cls._generation_key, 0)),
+            cls._scripts_key: {
+                script: _merge_sections(
+                    codec.decode(script_sections.get(_position_section, b'{}')),
+                    codec.decode(script_sections.get(_register_section, b'{}'))
+                ) for script, script_sections in sections.items()
+            }
+        }
+
+    # The ScriptInfo.data of one script for a lot of players, without loading them: one round trip that only reads
+    # each player's register section for that script. Players who don't have one (or are still stored as a json
+    # blob) get {}.
+    @classmethod
+    async def script_data(cls, numbers: List[str], script_name: str) -> Dict[str, dict]:
+        if not numbers:
+            return {}
+
+        batch = RedisBatch()
+        name = _section_field(script_name, _register_section)
+        pending = [batch.hget(Player(number).key, name) for number in numbers]
+        await batch.flush()
+
+        result = {}
+        for number, reply in zip(numbers, pending):
+            registers = reply.value
+            if isinstance(registers, bytes):
+                result[number] = codec.decode(registers).get('data', {})
+            else:
+                result[number] = {}
+        return result
+
+    @staticmethod
+    def _sections_by_script(fields: Dict[str, bytes]) -> Dict[str, Dict[str, bytes]]:
+        # 'telemarketopia:position' -> {'telemarketopia': {'position': ...}}
+        sections = {}
+        for name, value in fields.items():
+            script, _, section = name.partition(':')
+            if section in {_position_section, _register_section}:
+                sections.setdefault(script, {})[section] = value
+
+        return sections
+
     @classmethod
     async def get_all_players(cls) -> List['Player']:
         db = new_redis()
@@ -206,7 +699,24 @@ class Player(Logger):
         db = new_redis()
         if not isinstance(plr, Player):
             plr = Player(plr)
-        return await db.delete(plr.key)
+        deleted, _, _ = await db.delete(plr.key).srem(cls._index_key, plr.key).delete(plr.archive_key)
+        return deleted
+
+    @classmethod
+    async def reset_all(cls) -> int:
+        db = new_redis()
+        players = await cls._get_player_keys(db)
+        if not players:
+            return 0
+
+        archives = [cls._archive_key_for(player) for player in players]
+        deleted, _, _ = await db.delete(*players).delete(cls._index_key).delete(*archives)
+        return deleted
+
+    @staticmethod
+    def _archive_key_for(key: str) -> str:
+        # not plr:... so rebuild_index() doesn't think it's a player
+        return f'plr_history:{key[len("plr:"):]}'
 
     @classmethod
     def from_number(cls, number: Union[int, str]) -> str:
@@ -222,15 +732,81 @@ class Player(Logger):
         self.scripts: Optional[Dict[str, ScriptInfo]] = None
         self._loaded = False
         self._version = 0
+        # the json of every section field as it was when we loaded it, so we only write the ones that changed
+        self._fields: Dict[str, bytes] = {}
+        # set when our fields no longer reflect what's in redis at all and we need to write everything
+        self._replace = False
+        # history trimmed off our scripts that hasn't been written to the archive yet
+        self._archive: List[bytes] = []
+        # set by a RequestContext so we can count what each request costs
+        self.stats: Optional[RequestStats] = None
+        # active_script, if it's been set since we loaded
+        self._active: Optional[str] = None
+        # fields to write as they are (None to delete them), see save_over
+        self._raw: Dict[str, Optional[bytes]] = {}
+        # the scripts we loaded, or None if we loaded them all (see load)
+        self._scope: Optional[List[str]] = None
 
     # connection stuff
 
-    async def load(self):
-        jsn = await self._db.get(self.key)
-        if not jsn:
-            jsn = "{}"
-        self._data = json.loads(jsn)
-        await self.load_state_from_dict(self._data)
+    # Pass a batch to load alongside other commands, the load finishes when the batch is sent.
+    # Pass scripts to only load those scripts. The player then only knows about those scripts, so only do that
+    # when you know which scripts you need, and don't snapshot or restore_to() them.
+    async def load(self, batch: Optional[RedisBatch] = None, scripts: Optional[List[str]] = None):
+        self._scope = scripts
+        if batch is None:
+            reply = await _load_player_script.run([self.key], self._fields_for(scripts), self._db)
+        else:
+            reply = await _load_player_script.queue(batch, [self.key], self._fields_for(scripts))
+
+        await self._load_reply(reply)
+
+    # Loads every player in one round trip
+    @classmethod
+    async def load_all(cls, players: List['Player'], scripts: Optional[List[str]] = None):
+        batch = RedisBatch()
+        pending = [_load_player_script.queue(batch, [player.key], cls._fields_for(scripts)) for player in players]
+        await batch.flush()
+        for player, reply in zip(players, pending):
+            player._scope = scripts
+            await player._load_reply(reply.value)
+
+    # the hash fields a load of `scripts` needs, or [] for all of them
+    @classmethod
+    def _fields_for(cls, scripts: Optional[List[str]]) -> List[str]:
+        if not scripts:
+            return []
+
+        fields = [cls._generation_key, cls._version_key, cls._active_key]
+        for script in scripts:
+            fields.extend(_section_field(script, section) for section in [_position_section, _register_section])
+        return fields
+
+    async def _load_reply(self, reply: list):
+        if self.stats:
+            self.stats.reads += 1
+
+        kind, *reply = reply
+        if kind == b'string':
+            # This player is still stored as a single json blob. Load that and convert them next save.
+            self._data = codec.decode(reply[0] or b"{}")
+            await self.load_state_from_dict(self._data)
+            return
+
+        fields = {reply[i].decode("utf-8"): reply[i + 1] for i in range(0, len(reply), 2)}
+
+        self._generation = int(fields.pop(self._generation_key, 0))
+        self._version = int(fields.pop(self._version_key, 0))
+        self._fields = fields
+        self._replace = False
+        # the copy in redis is what we'll be trimming now
+        self._archive = []
+        self.scripts = _LazyScripts(self._sections_by_script(fields))
+        self._active = None
+        self._raw = {}
+        self._data = {}
+        self._loaded = True
+        self.d(f'Loaded: {list(fields.keys())}')
 
     async def load_state_from_dict(self, data):
         self._generation = data.get(self._generation_key, 0)
@@ -246,6 +822,14 @@ class Player(Logger):
         print_dict = {k: v.data for k, v in self.scripts.items()}
         self.d(f'Loaded: {print_dict}')
 
+        # whatever is in redis has nothing to do with this
+        self._fields = {}
+        self._replace = True
+        self._archive = []
+        self._active = None
+        self._raw = {}
+        self._scope = None
+
         self._data = data
         self._loaded = True
 
@@ -262,11 +846,11 @@ class Player(Logger):
         self._generation = backup_gen + 1
 
         # replace whatever was in the db with the state we got passed
-        await self.save()
+        await self.save(force=True)
 
     async def restore_to(self, new_state: dict):
         await self.load_state_from_dict(new_state)
-        await self.save()
+        await self.save(force=True)
 
     def get_snapshot_name(self):
         return self.key
@@ -274,12 +858,27 @@ class Player(Logger):
     def get_snapshot(self):
         return self.data
 
+    # get_snapshot() as of when we were loaded, but only built if the function we return gets called. Holding on
+    # to what we loaded is nearly free, so every request can keep one of these around in case it fails.
+    def snapshot_later(self) -> Callable[[], dict]:
+        version, generation = self._version, self._generation
+        if self._replace:
+            # loaded from a dict, which we don't change
+            scripts = self._data.get(self._scripts_key, {})
+            return lambda: {self._version_key: version, self._generation_key: generation, self._scripts_key: scripts}
+
+        # save() updates _fields in place
+        fields = dict(self._fields)
+        fields[self._version_key] = version
+        fields[self._generation_key] = generation
+        return lambda: self._data_from_fields(fields)
+
     @classmethod
     def _load_scripts(cls, data: dict):
         scripts = data.get(cls._scripts_key, {})
-        return {
-            script: ScriptInfo.from_dict(info) for script, info in scripts.items()
-        }
+        return _LazyScripts({
+            script: {_position_section: codec.encode(info)} for script, info in scripts.items()
+        })
 
     # def _load_info(self, data):
     #     return dataclass_from_dict(
@@ -291,29 +890,190 @@ class Player(Logger):
     def key(self):
         return f'plr:{self.number.e164}'
 
-    async def save(self):
-        # always save damnit
-        jsn = await self._db.get(self.key)
-        if jsn:
-            data = json.loads(jsn)
+    # The name of the script this player is playing, '' if they aren't playing one, or None if they haven't been
+    # saved since we started keeping track. It's its own field so finding out doesn't decode any scripts.
+    @property
+    def active_script(self) -> Optional[str]:
+        if self._active is not None:
+            return self._active
+        raw = self._fields.get(self._active_key)
+        return raw.decode() if raw is not None else None
 
-            db_generation = data.get(self._generation_key, 0)
-            db_version = data.get(self._version_key, 0)
+    @active_script.setter
+    def active_script(self, name: str):
+        self._active = name
 
-            if db_generation > self._generation:
-                # Do not overwrite
-                self.d("save(): Aborting due to generaton")
-                return
+    @property
+    def archive_key(self):
+        return self._archive_key_for(self.key)
+
+    # Everything that has been trimmed from this player's history, oldest first
+    async def archived_history(self) -> List[dict]:
+        return [codec.decode(entry) for entry in await self._db.lrange(self.archive_key, 0, -1)]
+
+    def _changed_fields(self) -> Tuple[Dict[str, bytes], List[str]]:
+        changed = {}
+        if isinstance(self.scripts, _LazyScripts) and not self._replace:
+            # scripts we never decoded can't have changed. The ones we did get encoded and compared with what we
+            # loaded below, so anything changed in them (however deep) is saved.
+            scripts = self.scripts.decoded
+        else:
+            # replacing, so everything has to be written
+            scripts = dict(self.scripts.items())
+
+        for name, info in scripts.items():
+            self._compact(name, info)
+            position, registers = _split_sections(info.to_dict())
+            changed[_section_field(name, _position_section)] = codec.encode(position)
+            changed[_section_field(name, _register_section)] = codec.encode(registers)
+
+        if self._active is not None:
+            changed[self._active_key] = self._active.encode()
+
+        changed.update({name: value for name, value in self._raw.items() if value is not None})
+
+        if not self._replace:
+            changed = {f: v for f, v in changed.items() if self._fields.get(f) != v}
+
+        deleted = [name for name, value in self._raw.items() if value is None]
+
+        return changed, deleted
+
+    def _compact(self, script_name: str, info: ScriptInfo):
+        for entry in info.compact(self.History):
+            if self.History.archive:
+                entry['script'] = script_name
+                self._archive.append(codec.encode(entry))
+
+    # Raises SaveConflict if redis has a newer generation, or a newer version and force is not set.
+    # Pass a batch to save alongside other commands, the save finishes when the batch is sent
+    async def save(self, force=False, batch: Optional[RedisBatch] = None):
+        request = self._save_request(force)
+        if request is None:
+            return
+
+        keys, args, changed, deleted = request
+        if batch is None:
+            result = await _save_player_script.run(keys, args, self._db)
+        else:
+            result = await _save_player_script.queue(batch, keys, args)
+
+        self._save_reply(result, changed, deleted)
+
+    # Saves every player in one round trip. Players that saved are updated even if others conflicted, then the
+    # first conflict is raised.
+    @classmethod
+    async def save_all(cls, players: List['Player'], force=False):
+        batch = RedisBatch()
+        queued = []
+        for player in players:
+            request = player._save_request(force)
+            if request is not None:
+                keys, args, changed, deleted = request
+                queued.append((player, _save_player_script.queue(batch, keys, args), changed, deleted))
+
+        await batch.flush()
+        conflict = None
+        for player, result, changed, deleted in queued:
+            try:
+                player._save_reply(result.value, changed, deleted)
+            except SaveConflict as e:
+                conflict = conflict or e
+
+        if conflict:
+            raise conflict
+
+    # returns None if there's nothing to save
+    def _save_request(self, force: bool) -> Optional[tuple]:
+        changed, deleted = self._changed_fields()
+
+        if not changed and not deleted and not self._replace:
+            if self.stats:
+                self.stats.saves_elided += 1
+            self.d(f"save(): {self.key} unchanged, not saving")
+            return None
+
+        args = [
+            self._generation,
+            self._version,
+            '1' if force else '0',
+            '1' if self._replace else '0',
+            len(self._archive),
+            len(deleted),
+            *self._archive,
+            *deleted
+        ]
+        for name, value in changed.items():
+            args.extend([name, value])
+
+        return [self.key, self._index_key, self.archive_key], args, changed, deleted
+
+    def _save_reply(self, result: list, changed: Dict[str, bytes], deleted: List[str]):
+        saved, reason, db_generation, db_version = result
+
+        if self.stats:
+            self.stats.writes += 1
+
+        if not saved:
+            raise SaveConflict(
+                self.key, reason.decode(), db_generation, db_version, self._generation, self._version
+            )
+
+        self._version = db_version
+        # what we just wrote is now what's in redis
+        for name, value in changed.items():
+            self._fields[name] = value
+        for name in deleted:
+            self._fields.pop(name, None)
+        self._replace = False
+        self._archive = []
+        self._raw = {}
+
+        self.d(f"save(): {self.key} <- {list(changed.keys())} (deleted: {deleted})")
+
+    # For after a retryable SaveConflict: reloads the player, and saves what this copy changed on top of the newer
+    # copy in redis. Fields only the other save changed keep what it wrote. Fields we both changed are merged
+    # key by key, and ours win where we both changed the same thing.
+    async def save_over(self, attempts: int = 3):
+        changes = self._changes_since_load()
+        archive = list(self._archive)
+        await self.load(scripts=self._scope)
+        await self.update(lambda player: player._reapply(changes, archive), attempts)
+        # what we loaded doesn't have our changes, what we saved does
+        self.scripts = _LazyScripts(self._sections_by_script(self._fields))
+
+    # What a save would write now, as {field: (value when we loaded, value now)}, None meaning there isn't one
+    def _changes_since_load(self) -> Dict[str, Tuple[Optional[bytes], Optional[bytes]]]:
+        changed, deleted = self._changed_fields()
+        changes = {name: (self._fields.get(name), value) for name, value in changed.items()}
+        changes.update({name: (self._fields.get(name), None) for name in deleted})
+        return changes
+
+    def _reapply(self, changes: Dict[str, Tuple[Optional[bytes], Optional[bytes]]], archive: List[bytes]):
+        for name, (loaded, ours) in changes.items():
+            now = self._fields.get(name)
+            if now != loaded and now is not None and ours is not None and name != self._active_key:
+                merged = _merge_changes(codec.decode(loaded or b'{}'), codec.decode(now), codec.decode(ours))
+                ours = codec.encode(merged)
+            self._raw[name] = ours
+        self._archive.extend(archive)
+
+    # Load-mutate-save that reloads and re-applies `mutate` when someone else saved the player first.
+    # `mutate` should only change the player, since it can be called more than once.
+    async def update(self, mutate: Callable[['Player'], None], attempts: int = 3):
+        if not self._loaded:
+            await self.load()
 
-            if db_version > self._version:
-                # Do not overwrite
-                self.d(
-                    f"Warning: Sync problem detected: {self.data}\n>>>overwriting>>>>\n{jsn}"
-                )
+        for attempt in range(attempts):
+            mutate(self)
+            try:
+                return await self.save()
+            except SaveConflict as conflict:
+                if not conflict.retryable or attempt + 1 >= attempts:
+                    raise
 
-        self._version += 1
-        await self._db.set(self.key, json.dumps(self.data))
-        self.d(f"save(): {self.key} <- {json.dumps(self.data)}")
+                self.w(f'update(): {conflict} - reloading and retrying')
+                await self.load(scripts=self._scope)
 
     def ensure_loaded(self):
         if not self._loaded:
@@ -324,7 +1084,7 @@ class Player(Logger):
         return {
             self._version_key: self._version,
             self._generation_key: self._generation,
-            self._scripts_key: {k: asdict(v) for k, v in self.scripts.items()}
+            self._scripts_key: {k: v.to_dict() for k, v in self.scripts.items()}
         }
 
     def set_script(self, script_name: str, info: ScriptInfo) -> None:
@@ -337,7 +1097,6 @@ class Player(Logger):
         return f"Plr[{self.number.friendly}]({self._version})"
 
 
-#
 #  _____       _                        _             _
 # |  __ \     | |                      | |           | |
 # | |  | | ___| |__  _   _  __ _       | |_   _ _ __ | | __
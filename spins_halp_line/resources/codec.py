@@ -0,0 +1,88 @@
+import json
+from dataclasses import is_dataclass, asdict
+from datetime import datetime, date
+from typing import Any, Union
+
+from spins_halp_line.resources.numbers import PhoneNumber
+
+# All the state we keep in redis goes through here so we only have one place that knows how to turn our
+# objects into bytes.
+#
+# Stored values start with a format marker (`~1`) so we can change the encoding later without breaking old
+# data. Anything without a marker was written with the stdlib json module before this existed and is decoded
+# the old way. Plain json can't start with `~`, so there's no way to confuse the two.
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is in pyproject, but this keeps older environments running
+    orjson = None
+
+_marker = b'~'
+_version = b'1'
+_prefix = _marker + _version
+
+
+def _default(obj: Any):
+    if isinstance(obj, PhoneNumber):
+        return obj.e164
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    if hasattr(obj, 'to_list'):
+        return obj.to_list()
+    if is_dataclass(obj) and not isinstance(obj, type):
+        return asdict(obj)
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+
+    raise TypeError(f'codec cannot encode {obj.__class__.__name__}: {obj}')
+
+
+class _Encoder(json.JSONEncoder):
+
+    def default(self, obj):
+        return _default(obj)
+
+
+if orjson is not None:
+    # orjson does datetimes and dataclasses itself, but does them differently than our stdlib fallback
+    # (no microseconds when they're 0, etc) so we keep passing those through our default() too
+    _orjson_options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def _dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default, option=_orjson_options)
+
+    def _loads(data: bytes) -> Any:
+        return orjson.loads(data)
+else:
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj, cls=_Encoder, separators=(',', ':')).encode()
+
+    def _loads(data: bytes) -> Any:
+        return json.loads(data)
+
+
+# For anything that is written to redis
+def encode(obj: Any) -> bytes:
+    return _prefix + _dumps(obj)
+
+
+def decode(data: Union[bytes, str, None]) -> Any:
+    if data is None:
+        return None
+    if isinstance(data, str):
+        data = data.encode()
+
+    if data[:1] == _marker:
+        if data[:len(_prefix)] != _prefix:
+            raise ValueError(f'Unknown codec version in {data[:16]}')
+        return _loads(data[len(_prefix):])
+
+    # from before the codec existed
+    return json.loads(data)
+
+
+# For json people are going to read (logs, debug endpoints). Handles the same objects as encode()
+def to_json(obj: Any) -> str:
+    return json.dumps(obj, cls=_Encoder)
@@ -0,0 +1,62 @@
+from typing import Any, List, Optional, Tuple
+
+from spins_halp_line.resources.redis import new_redis, RedisBatch, RedisScript, Pending
+from spins_halp_line.resources import codec
+from spins_halp_line.util import Logger
+
+# An append-only log kept in a redis stream.
+#
+# Entries are numbered 1, 2, 3... (the stream ids are `0-<seq>`) by a counter in a hash, so someone reading
+# it can tell if they missed anything - if the first entry after the one you have isn't the next number, the
+# entries in between were trimmed and you have to start over from whatever copy of the data they were folded
+# into.
+
+# KEYS[1]: the stream, KEYS[2]: the hash holding the counter
+# ARGV: counter field, encoded entry
+# returns: the entry's sequence number
+def _append(call, keys, args):
+    seq = call('HINCRBY', keys[1], args[0], 1)
+    call('XADD', keys[0], f'0-{seq}', 'entry', args[1])
+    return seq
+
+
+_append_script = RedisScript("""
+local seq = redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+redis.call('XADD', KEYS[1], '0-' .. seq, 'entry', ARGV[2])
+return seq
+""", emulate=_append)
+
+
+class Journal(Logger):
+
+    def __init__(self, key: str, counter_key: str, counter_field: str = 'journal'):
+        super(Journal, self).__init__()
+        self.key = key
+        self.counter_key = counter_key
+        self.counter_field = counter_field
+
+    # Adds an entry (anything codec can encode) and returns its sequence number
+    async def append(self, entry: Any) -> int:
+        return await _append_script.run([self.key, self.counter_key], [self.counter_field, codec.encode(entry)])
+
+    # The entries after `seq` as [(seq, entry)...], oldest first. Await the result, or pass a batch to send the
+    # read along with other commands.
+    def read_after(self, seq: int, batch: Optional[RedisBatch] = None) -> Pending:
+        async def finish(reply) -> List[Tuple[int, Any]]:
+            if isinstance(reply, Exception):
+                raise reply
+            entries = []
+            for entry_id, pairs in reply:
+                entry = dict(zip(pairs[::2], pairs[1::2]))
+                entries.append((int(entry_id.split(b'-')[1]), codec.decode(entry[b'entry'])))
+            return entries
+
+        if batch is None:
+            batch = RedisBatch()
+        return batch.command('XRANGE', self.key, f'(0-{seq}', '+', finish=finish)
+
+    # Drops the entries up to and including `seq`. Redis is allowed to keep a few more than that around.
+    async def trim(self, seq: int) -> int:
+        removed = await new_redis().xtrim(self.key, 'MINID', '~', f'0-{seq + 1}')
+        self.d(f'trim({seq}): removed {removed} entries from {self.key}')
+        return removed
@@ -0,0 +1,371 @@
+import os
+import zlib
+from collections import deque
+from itertools import count
+from typing import Optional, Set
+from uuid import uuid4
+
+import trio
+
+from spins_halp_line.constants import Credentials, Shared_Workers
+from spins_halp_line.resources.redis import RedisBatch, RedisScript, Pending
+from spins_halp_line.tasks import Task, add_task
+from spins_halp_line.util import Logger
+
+# Locks for the things more than one request (or task) changes at a time.
+#
+# LocalLock is a trio.Lock, and only keeps out other tasks in this process. RedisLock is held in redis, so it keeps
+# out everyone talking to the same redis, which is what we need to run more than one server process.
+#
+# A RedisLock is a lease: it's ours for Lease_Seconds at a time, and a LeaseRenewer task keeps extending it while
+# we hold it. If we stall for longer than that (or lose redis for a while) someone else can take it, so every
+# acquire also hands out a fencing token: a number that goes up every time the lock changes hands. Writes that
+# must not come from someone who has lost the lock (see fenced_set) pass the token along, and redis refuses them
+# if it has already seen a bigger one.
+#
+# Both kinds have the same interface (acquire / release / locked / token), LockManager in util.py works with either.
+
+# Settings can be overridden with a "locks" section in creds.json
+_config = Credentials.get("locks", {})
+# Use RedisLocks for anything that's shared between processes. On by default with shared workers.
+Shared_Locks = _config.get("shared", Shared_Workers)
+# How long a RedisLock is ours for without being renewed
+Lease_Seconds = _config.get("lease_seconds", 10)
+# How many locks the KeyedLocks pools below share out
+Player_Stripes = _config.get("player_stripes", 256)
+Conference_Stripes = _config.get("conference_stripes", 64)
+
+
+class Lock(Logger):
+
+    def __init__(self, name: str):
+        super(Lock, self).__init__()
+        self.name = name
+        # fencing token of the current hold, None when nobody in this process has it
+        self.token: Optional[int] = None
+
+    async def acquire(self) -> int:
+        raise NotImplementedError()
+
+    async def release(self):
+        raise NotImplementedError()
+
+    # if someone in this process holds it
+    def locked(self) -> bool:
+        raise NotImplementedError()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}[{self.name}]'
+
+
+class LocalLock(Lock):
+
+    def __init__(self, name: str):
+        super(LocalLock, self).__init__(name)
+        self._lock = trio.Lock()
+        self._tokens = count(1)
+
+    async def acquire(self) -> int:
+        await self._lock.acquire()
+        self.token = next(self._tokens)
+        return self.token
+
+    async def release(self):
+        self.token = None
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+
+# KEYS[1]: the lock, KEYS[2]: its fencing counter
+# ARGV: owner, lease in ms
+# returns: [fencing token, 0] if we got it, [0, ms until the current lease runs out] if not
+def _acquire(call, keys, args):
+    if call('SET', keys[0], args[0], 'NX', 'PX', args[1]) is None:
+        return [0, call('PTTL', keys[0])]
+    return [call('INCR', keys[1]), 0]
+
+
+_acquire_script = RedisScript("""
+if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return {0, redis.call('PTTL', KEYS[1])}
+end
+return {redis.call('INCR', KEYS[2]), 0}
+""", emulate=_acquire)
+
+
+# KEYS[1]: the lock
+# ARGV: owner, lease in ms (renew only)
+# returns: 1 if we still had it, 0 if someone else has it (or nobody does)
+def _renew(call, keys, args):
+    if call('GET', keys[0]) != args[0]:
+        return 0
+    return call('PEXPIRE', keys[0], args[1])
+
+
+_renew_script = RedisScript("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+""", emulate=_renew)
+
+
+def _release(call, keys, args):
+    if call('GET', keys[0]) != args[0]:
+        return 0
+    return call('DEL', keys[0])
+
+
+_release_script = RedisScript("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('DEL', KEYS[1])
+""", emulate=_release)
+
+
+# the RedisLocks this process holds right now, for the LeaseRenewer
+_held: Set['RedisLock'] = set()
+_renewer: Optional['LeaseRenewer'] = None
+# everything we put in a lock's key starts with this, so we can tell our holds from another process's
+_process = f'{os.getpid()}:{uuid4().hex}'
+
+
+class RedisLock(Lock):
+    # how long we wait before asking again when someone else has it, doubling each time up to Retry_Max
+    Retry_Min = 0.005
+    Retry_Max = 0.25
+
+    def __init__(self, name: str, lease_seconds: float = None):
+        super(RedisLock, self).__init__(name)
+        self.lease_seconds = lease_seconds or Lease_Seconds
+        # tasks in this process take turns here before going to redis, so they don't all poll it
+        self._local = trio.Lock()
+        self._owner: Optional[str] = None
+        # set if the lease ran out while we had it
+        self.lost = False
+
+    @property
+    def key(self):
+        return f'lock:{self.name}'
+
+    @property
+    def fence_key(self):
+        return f'lock:{self.name}:fence'
+
+    @property
+    def _lease_ms(self):
+        return int(self.lease_seconds * 1000)
+
+    async def acquire(self) -> int:
+        await self._local.acquire()
+        try:
+            owner = f'{_process}:{uuid4().hex}'
+            delay = self.Retry_Min
+            while True:
+                token, wait_ms = await _acquire_script.run([self.key, self.fence_key], [owner, self._lease_ms])
+                if token:
+                    break
+                # no point asking again before the lease is up if it's going to be a while
+                await trio.sleep(min(delay, max(wait_ms, 1) / 1000))
+                delay = min(delay * 2, self.Retry_Max)
+        except BaseException:
+            self._local.release()
+            raise
+
+        self._owner = owner
+        self.token = token
+        self.lost = False
+        _held.add(self)
+        await _start_renewer()
+        return token
+
+    # Extends our lease. Returns False (and sets .lost) if it had already run out.
+    async def renew(self) -> bool:
+        if self._owner is None:
+            return False
+
+        if not await _renew_script.run([self.key], [self._owner, self._lease_ms]):
+            if not self.lost:
+                self.e(f'renew(): lost {self.key} (token {self.token}), someone else may have it')
+            self.lost = True
+            return False
+        return True
+
+    async def release(self):
+        try:
+            if self._owner is not None and not await _release_script.run([self.key], [self._owner]):
+                self.w(f'release(): lease on {self.key} (token {self.token}) ran out before we let go of it')
+        finally:
+            _held.discard(self)
+            self._owner = None
+            self.token = None
+            self._local.release()
+
+    def locked(self) -> bool:
+        return self._local.locked()
+
+
+# Renews every RedisLock held in this process a few times per lease
+class LeaseRenewer(Task):
+
+    async def execute(self):
+        while True:
+            await trio.sleep(min((lock.lease_seconds for lock in _held), default=Lease_Seconds) / 3)
+            for lock in list(_held):
+                try:
+                    await lock.renew()
+                except Exception as e:
+                    self.e(f'Could not renew {lock}: {e}')
+
+
+async def _start_renewer():
+    global _renewer
+    if _renewer is None:
+        _renewer = LeaseRenewer()
+        await add_task.send(_renewer)
+
+
+# A lock called `name`: shared with every process using our redis if Shared_Locks is on, otherwise just ours
+def new_lock(name: str) -> Lock:
+    if Shared_Locks:
+        return RedisLock(name)
+    return LocalLock(name)
+
+
+# A fixed pool of locks handed out by key (a player's number, a conference id...), so everything about one key
+# takes turns and everything else runs side by side, without making (and cleaning up) a lock per key. Two keys
+# can hash to the same stripe and wait on each other now and then, which is what having lots of stripes is for.
+#
+# Stripes aren't reentrant: don't hold two keys from the same pool at once (see RequestContext.holding).
+class KeyedLocks(Logger):
+    # how many of the most recent waits we keep for stats
+    Keep_Waits = 1000
+
+    def __init__(self, name: str, stripes: int):
+        super(KeyedLocks, self).__init__()
+        self.name = name
+        self._stripes = [new_lock(f'{name}:{n}') for n in range(stripes)]
+        self._waits = deque(maxlen=self.Keep_Waits)
+        # for /debug/locks
+        self.acquired = 0
+        self.contended = 0
+        self.max_wait = 0
+
+    # crc32 rather than hash() so every process picks the same stripe for a key
+    def stripe(self, key) -> Lock:
+        return self._stripes[zlib.crc32(str(key).encode()) % len(self._stripes)]
+
+    def lock(self, key) -> 'KeyLock':
+        return KeyLock(self, key)
+
+    def record(self, waited: float, contended: bool):
+        self.acquired += 1
+        if contended:
+            self.contended += 1
+        self.max_wait = max(self.max_wait, waited)
+        self._waits.append(waited)
+
+    def _wait_ms(self, p: float) -> float:
+        if not self._waits:
+            return 0
+        ordered = sorted(self._waits)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'stripes': len(self._stripes),
+            'acquired': self.acquired,
+            # acquires that found their stripe already held
+            'contended': self.contended,
+            'wait_ms_p50': self._wait_ms(50),
+            'wait_ms_p99': self._wait_ms(99),
+            'wait_ms_max': self.max_wait * 1000,
+        }
+
+
+# The lock for one key in a KeyedLocks, which is whatever stripe it lands on
+class KeyLock(Lock):
+
+    def __init__(self, pool: KeyedLocks, key):
+        super(KeyLock, self).__init__(f'{pool.name}[{key}]')
+        self.pool = pool
+        self.stripe = pool.stripe(key)
+        # seconds the last acquire() waited
+        self.waited = 0
+
+    async def acquire(self) -> int:
+        contended = self.stripe.locked()
+        start = trio.current_time()
+        self.token = await self.stripe.acquire()
+        self.waited = trio.current_time() - start
+        self.pool.record(self.waited, contended)
+        return self.token
+
+    async def release(self):
+        self.token = None
+        await self.stripe.release()
+
+    def locked(self) -> bool:
+        return self.stripe.locked()
+
+
+# Held around anything that loads, changes and saves a player, and around changes to a conference
+Player_Locks = KeyedLocks('player', Player_Stripes)
+Conference_Locks = KeyedLocks('conference', Conference_Stripes)
+
+
+def lock_stats() -> dict:
+    return {pool.name: pool.stats for pool in [Player_Locks, Conference_Locks]}
+
+
+# KEYS[1]: the key to set, KEYS[2]: the highest token it has been written with
+# ARGV: token, value
+# returns: 1 if it was set, 0 if someone with a newer token has written it
+def _fenced_set(call, keys, args):
+    if int(call('GET', keys[1]) or 0) > int(args[0]):
+        return 0
+    call('SET', keys[1], args[0])
+    call('SET', keys[0], args[1])
+    return 1
+
+
+_fenced_set_script = RedisScript("""
+if tonumber(redis.call('GET', KEYS[2]) or 0) > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[1])
+redis.call('SET', KEYS[1], ARGV[2])
+return 1
+""", emulate=_fenced_set)
+
+
+async def _was_set(reply) -> bool:
+    return not isinstance(reply, Exception)
+
+
+# SETs `key` to `value`, unless it was already written by someone holding `lock` after us. LocalLock tokens start
+# over when we restart, so they aren't checked. Pass a batch to send it along with other commands.
+def fenced_set(lock: Lock, key: str, value: bytes, batch: Optional[RedisBatch] = None) -> Pending:
+    if batch is None:
+        batch = RedisBatch()
+
+    if isinstance(lock, KeyLock):
+        # the stripe's tokens go up across every key on it, so they still fence
+        lock = lock.stripe
+
+    if not isinstance(lock, RedisLock) or lock.token is None:
+        # not batch.set(): redio leaves the OK out of its replies, which throws off everything queued after it
+        return batch.command('SET', key, value, finish=_was_set)
+
+    token = lock.token
+
+    async def finish(reply):
+        if not reply:
+            lock.e(f'fenced_set(): {key} was written with a newer token than {token}, dropping our write')
+        return bool(reply)
+
+    return _fenced_set_script.queue(batch, [key, f'{key}:fence'], [token, value], finish=finish)
@@ -0,0 +1,649 @@
+from fnmatch import fnmatchcase
+from hashlib import sha1
+from time import monotonic, perf_counter
+from typing import Any, Callable, Dict, List, Optional, Set
+from urllib.parse import urlparse, parse_qs
+
+import trio
+from redio import conv
+from redio.exc import ServerError
+from redio.highlevel import DB, _handle_response
+
+from spins_halp_line.resources.redis import RedisStats, RedisScript
+
+# An in-process stand-in for redis, so the parts of the game that store things can be tested and benchmarked
+# without a server. Pick it with a "memory://" redis url (see redis_factory), optionally with a made up network
+# delay per round trip: "memory://?latency_ms=2".
+#
+# It only knows the commands we use (plus a few neighbours) and can't run lua, so every RedisScript we send to
+# it needs a python version passed in as `emulate`.
+#
+# Values are stored the way redis stores them: strings as bytes, hashes as dicts, sets, and lists. Replies look
+# like the ones redio gets off the wire (bulk strings are bytes, status replies are str, errors are returned as
+# ServerError objects) so everything above the DB behaves the same.
+
+_wrong_type = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+
+
+def _int(arg: bytes) -> int:
+    try:
+        return int(arg)
+    except ValueError:
+        raise ServerError('ERR value is not an integer or out of range')
+
+
+# Turns what an emulated script returns into what redis would send back for the equivalent lua value
+def _script_reply(value: Any):
+    if isinstance(value, bool):
+        return 1 if value else None
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, float):
+        return int(value)
+    if isinstance(value, (list, tuple)):
+        # lua tables stop at the first nil
+        result = []
+        for item in value:
+            if item is None:
+                break
+            result.append(_script_reply(item))
+        return result
+    return value
+
+
+# member -> score. Its own type so hash commands can't be used on it.
+class _SortedSet(dict):
+
+    def ordered(self) -> List[bytes]:
+        return sorted(self, key=lambda member: (self[member], member))
+
+
+def _score(value: float) -> bytes:
+    return (str(int(value)) if value == int(value) else repr(value)).encode()
+
+
+# [(id, [field, value, ...]), ...] in id order, ids are (ms, seq) tuples
+class _Stream(list):
+
+    @property
+    def last_id(self):
+        return self[-1][0] if self else (0, 0)
+
+
+def _stream_id(arg: bytes, missing_seq: int = 0):
+    ms, _, seq = arg.partition(b'-')
+    try:
+        return int(ms), int(seq) if seq else missing_seq
+    except ValueError:
+        raise ServerError('ERR Invalid stream ID specified as stream command argument')
+
+
+def _format_id(stream_id) -> bytes:
+    return f'{stream_id[0]}-{stream_id[1]}'.encode()
+
+
+class MemoryStore:
+
+    def __init__(self):
+        self.data: Dict[bytes, Any] = {}
+        # key -> monotonic() time it expires at
+        self.expires: Dict[bytes, float] = {}
+        # bumped on every write so WATCH can tell if a key changed
+        self.key_versions: Dict[bytes, int] = {}
+        # channel -> the MemoryPubSubs listening to it
+        self.subscribers: Dict[bytes, Set['MemoryPubSub']] = {}
+
+    # Runs a single command. Errors come back as ServerError objects, like they do from a server.
+    def execute(self, cmd: List[bytes]):
+        name = cmd[0].decode().upper() if isinstance(cmd[0], bytes) else str(cmd[0]).upper()
+        handler = getattr(self, f'_cmd_{name.lower()}', None)
+        if handler is None:
+            return ServerError(f"ERR unknown command '{name}' (memory redis doesn't support it)")
+        try:
+            return handler(*cmd[1:])
+        except ServerError as e:
+            return e
+        except TypeError:
+            return ServerError(f"ERR wrong number of arguments for '{name.lower()}' command")
+
+    # key helpers
+
+    def _alive(self, key: bytes) -> bool:
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= monotonic():
+            self._drop(key)
+        return key in self.data
+
+    def _get(self, key: bytes, kind: type, default: Callable = None):
+        if not self._alive(key):
+            if default is None:
+                return None
+            self.data[key] = default()
+        value = self.data[key]
+        if type(value) is not kind:
+            raise ServerError(_wrong_type)
+        return value
+
+    def _touch(self, key: bytes):
+        self.key_versions[key] = self.key_versions.get(key, 0) + 1
+
+    def _drop(self, key: bytes):
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+        self._touch(key)
+
+    def _cleanup(self, key: bytes):
+        # redis removes hashes / sets / lists when they're emptied
+        value = self.data.get(key)
+        if value is not None and not isinstance(value, bytes) and not value:
+            self._drop(key)
+
+    # connection / server
+
+    def _cmd_ping(self, message: bytes = None):
+        return message if message is not None else 'PONG'
+
+    def _cmd_flushdb(self, *args):
+        for key in list(self.data):
+            self._drop(key)
+        return 'OK'
+
+    _cmd_flushall = _cmd_flushdb
+
+    def _cmd_publish(self, channel: bytes, message: bytes):
+        listening = self.subscribers.get(channel, set())
+        for pubsub in listening:
+            pubsub.deliver(message)
+        return len(listening)
+
+    # keys
+
+    def _cmd_type(self, key: bytes):
+        if not self._alive(key):
+            return 'none'
+        return {bytes: 'string', dict: 'hash', set: 'set', list: 'list', _SortedSet: 'zset',
+                _Stream: 'stream'}[type(self.data[key])]
+
+    def _cmd_del(self, *keys: bytes):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                self._drop(key)
+                removed += 1
+        return removed
+
+    def _cmd_exists(self, *keys: bytes):
+        return sum(1 for key in keys if self._alive(key))
+
+    def _cmd_keys(self, pattern: bytes):
+        return [key for key in list(self.data) if self._alive(key) and fnmatchcase(key, pattern)]
+
+    def _cmd_scan(self, cursor: bytes, *args: bytes):
+        pattern, count = b'*', 10
+        for option, value in zip(args[::2], args[1::2]):
+            if option.upper() == b'MATCH':
+                pattern = value
+            elif option.upper() == b'COUNT':
+                count = _int(value)
+
+        keys = sorted(key for key in list(self.data) if self._alive(key))
+        start = _int(cursor)
+        end = start + count
+        found = [key for key in keys[start:end] if fnmatchcase(key, pattern)]
+        return [str(end if end < len(keys) else 0).encode(), found]
+
+    def _cmd_expire(self, key: bytes, seconds: bytes):
+        return self._cmd_pexpire(key, str(_int(seconds) * 1000).encode())
+
+    def _cmd_pexpire(self, key: bytes, ms: bytes):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = monotonic() + _int(ms) / 1000
+        return 1
+
+    def _cmd_pttl(self, key: bytes):
+        if not self._alive(key):
+            return -2
+        if key not in self.expires:
+            return -1
+        return int((self.expires[key] - monotonic()) * 1000)
+
+    # strings
+
+    def _cmd_get(self, key: bytes):
+        return self._get(key, bytes)
+
+    def _cmd_mget(self, *keys: bytes):
+        return [value if isinstance(value, bytes) else None
+                for value in (self.data.get(key) if self._alive(key) else None for key in keys)]
+
+    def _cmd_set(self, key: bytes, value: bytes, *options: bytes):
+        ttl_ms = None
+        only_new = only_existing = False
+        options = list(options)
+        while options:
+            option = options.pop(0).upper()
+            if option == b'NX':
+                only_new = True
+            elif option == b'XX':
+                only_existing = True
+            elif option == b'EX':
+                ttl_ms = _int(options.pop(0)) * 1000
+            elif option == b'PX':
+                ttl_ms = _int(options.pop(0))
+            else:
+                raise ServerError('ERR syntax error')
+
+        exists = self._alive(key)
+        if (only_new and exists) or (only_existing and not exists):
+            return None
+
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if ttl_ms is not None:
+            self.expires[key] = monotonic() + ttl_ms / 1000
+        self._touch(key)
+        return 'OK'
+
+    def _cmd_incrby(self, key: bytes, amount: bytes):
+        value = _int(self._get(key, bytes) or b'0') + _int(amount)
+        self.data[key] = str(value).encode()
+        self._touch(key)
+        return value
+
+    def _cmd_incr(self, key: bytes):
+        return self._cmd_incrby(key, b'1')
+
+    # hashes
+
+    def _cmd_hset(self, key: bytes, *pairs: bytes):
+        if not pairs or len(pairs) % 2:
+            raise ServerError("ERR wrong number of arguments for 'hset' command")
+        fields = self._get(key, dict, dict)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in fields
+            fields[field] = value
+        self._touch(key)
+        return added
+
+    def _cmd_hincrby(self, key: bytes, field: bytes, amount: bytes):
+        fields = self._get(key, dict, dict)
+        value = _int(fields.get(field, b'0')) + _int(amount)
+        fields[field] = str(value).encode()
+        self._touch(key)
+        return value
+
+    def _cmd_hget(self, key: bytes, field: bytes):
+        return (self._get(key, dict) or {}).get(field)
+
+    def _cmd_hmget(self, key: bytes, *fields: bytes):
+        values = self._get(key, dict) or {}
+        return [values.get(field) for field in fields]
+
+    def _cmd_hgetall(self, key: bytes):
+        result = []
+        for field, value in (self._get(key, dict) or {}).items():
+            result.extend([field, value])
+        return result
+
+    def _cmd_hdel(self, key: bytes, *fields: bytes):
+        values = self._get(key, dict)
+        if values is None:
+            return 0
+        removed = sum(1 for field in fields if values.pop(field, None) is not None)
+        self._touch(key)
+        self._cleanup(key)
+        return removed
+
+    def _cmd_hlen(self, key: bytes):
+        return len(self._get(key, dict) or {})
+
+    def _cmd_hkeys(self, key: bytes):
+        return list(self._get(key, dict) or {})
+
+    # sets
+
+    def _cmd_sadd(self, key: bytes, *members: bytes):
+        values: Set[bytes] = self._get(key, set, set)
+        before = len(values)
+        values.update(members)
+        self._touch(key)
+        return len(values) - before
+
+    def _cmd_srem(self, key: bytes, *members: bytes):
+        values = self._get(key, set)
+        if values is None:
+            return 0
+        before = len(values)
+        values.difference_update(members)
+        self._touch(key)
+        self._cleanup(key)
+        return before - len(values)
+
+    def _cmd_smembers(self, key: bytes):
+        return list(self._get(key, set) or set())
+
+    def _cmd_sismember(self, key: bytes, member: bytes):
+        return int(member in (self._get(key, set) or set()))
+
+    def _cmd_scard(self, key: bytes):
+        return len(self._get(key, set) or set())
+
+    # lists
+
+    def _cmd_rpush(self, key: bytes, *values: bytes):
+        items = self._get(key, list, list)
+        items.extend(values)
+        self._touch(key)
+        return len(items)
+
+    def _cmd_lpush(self, key: bytes, *values: bytes):
+        items = self._get(key, list, list)
+        for value in values:
+            items.insert(0, value)
+        self._touch(key)
+        return len(items)
+
+    @staticmethod
+    def _range(length: int, start: bytes, stop: bytes) -> slice:
+        start, stop = _int(start), _int(stop)
+        if start < 0:
+            start = max(length + start, 0)
+        if stop < 0:
+            stop = length + stop
+        return slice(start, stop + 1)
+
+    def _cmd_lrange(self, key: bytes, start: bytes, stop: bytes):
+        items = self._get(key, list) or []
+        return items[self._range(len(items), start, stop)]
+
+    def _cmd_ltrim(self, key: bytes, start: bytes, stop: bytes):
+        items = self._get(key, list)
+        if items is not None:
+            items[:] = items[self._range(len(items), start, stop)]
+            self._touch(key)
+            self._cleanup(key)
+        return 'OK'
+
+    def _cmd_llen(self, key: bytes):
+        return len(self._get(key, list) or [])
+
+    # sorted sets
+
+    def _cmd_zadd(self, key: bytes, *args: bytes):
+        args = list(args)
+        only_new = False
+        while args and args[0].upper() in (b'NX', b'XX', b'CH', b'GT', b'LT'):
+            option = args.pop(0).upper()
+            if option != b'NX':
+                raise ServerError('ERR memory redis only supports ZADD NX')
+            only_new = True
+        if not args or len(args) % 2:
+            raise ServerError('ERR syntax error')
+
+        members = self._get(key, _SortedSet, _SortedSet)
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            try:
+                score = float(score)
+            except ValueError:
+                raise ServerError('ERR value is not a valid float')
+            if member in members and only_new:
+                continue
+            added += member not in members
+            members[member] = score
+        self._touch(key)
+        return added
+
+    def _cmd_zrem(self, key: bytes, *members: bytes):
+        values = self._get(key, _SortedSet)
+        if values is None:
+            return 0
+        removed = sum(1 for member in members if values.pop(member, None) is not None)
+        self._touch(key)
+        self._cleanup(key)
+        return removed
+
+    def _cmd_zscore(self, key: bytes, member: bytes):
+        score = (self._get(key, _SortedSet) or {}).get(member)
+        return None if score is None else _score(score)
+
+    def _cmd_zcard(self, key: bytes):
+        return len(self._get(key, _SortedSet) or {})
+
+    def _cmd_zrange(self, key: bytes, start: bytes, stop: bytes, *options: bytes):
+        values = self._get(key, _SortedSet) or _SortedSet()
+        ordered = values.ordered()
+        ordered = ordered[self._range(len(ordered), start, stop)]
+        if [option.upper() for option in options] == [b'WITHSCORES']:
+            return [item for member in ordered for item in (member, _score(values[member]))]
+        if options:
+            raise ServerError('ERR memory redis only supports ZRANGE key start stop [WITHSCORES]')
+        return ordered
+
+    # streams
+
+    def _cmd_xadd(self, key: bytes, entry_id: bytes, *pairs: bytes):
+        if not pairs or len(pairs) % 2:
+            raise ServerError("ERR wrong number of arguments for 'xadd' command")
+        entries = self._get(key, _Stream, _Stream)
+        last = entries.last_id
+        if entry_id == b'*':
+            ms = int(monotonic() * 1000)
+            new_id = (ms, 0) if ms > last[0] else (last[0], last[1] + 1)
+        else:
+            new_id = _stream_id(entry_id)
+            if new_id == (0, 0):
+                raise ServerError('ERR The ID specified in XADD must be greater than 0-0')
+            if new_id <= last:
+                raise ServerError('ERR The ID specified in XADD is equal or smaller than the target stream top item')
+        entries.append((new_id, list(pairs)))
+        self._touch(key)
+        return _format_id(new_id)
+
+    def _cmd_xlen(self, key: bytes):
+        return len(self._get(key, _Stream) or [])
+
+    def _cmd_xrange(self, key: bytes, start: bytes, end: bytes, *options: bytes):
+        count = None
+        if options:
+            if len(options) != 2 or options[0].upper() != b'COUNT':
+                raise ServerError('ERR syntax error')
+            count = _int(options[1])
+
+        def bound(arg: bytes, low: bool):
+            if arg == b'-':
+                return (0, 0), False
+            if arg == b'+':
+                return (float('inf'), 0), False
+            exclusive = arg.startswith(b'(')
+            return _stream_id(arg.lstrip(b'('), 0 if low else float('inf')), exclusive
+
+        (low, low_open), (high, high_open) = bound(start, True), bound(end, False)
+        result = []
+        for entry_id, pairs in self._get(key, _Stream) or []:
+            if count is not None and len(result) >= count:
+                break
+            if entry_id < low or (low_open and entry_id == low):
+                continue
+            if entry_id > high or (high_open and entry_id == high):
+                break
+            result.append([_format_id(entry_id), list(pairs)])
+        return result
+
+    def _cmd_xtrim(self, key: bytes, strategy: bytes, *args: bytes):
+        # ~ lets redis trim less than asked, we always trim exactly
+        threshold = args[-1]
+        entries = self._get(key, _Stream)
+        if entries is None:
+            return 0
+        before = len(entries)
+        if strategy.upper() == b'MAXLEN':
+            keep = _int(threshold)
+            del entries[:max(len(entries) - keep, 0)]
+        elif strategy.upper() == b'MINID':
+            minimum = _stream_id(threshold)
+            entries[:] = [entry for entry in entries if entry[0] >= minimum]
+        else:
+            raise ServerError('ERR syntax error')
+        self._touch(key)
+        return before - len(entries)
+
+    # scripts
+
+    def _cmd_evalsha(self, sha: bytes, numkeys: bytes, *args: bytes):
+        emulate = RedisScript.emulations.get(sha.decode())
+        if emulate is None:
+            raise ServerError('NOSCRIPT No matching script. Please use EVAL.')
+
+        numkeys = _int(numkeys)
+        try:
+            return _script_reply(emulate(self._script_call, list(args[:numkeys]), list(args[numkeys:])))
+        except ServerError:
+            raise
+        except Exception as e:
+            raise ServerError(f'ERR Error running script: {e!r}')
+
+    def _cmd_eval(self, source: bytes, numkeys: bytes, *args: bytes):
+        sha = sha1(source).hexdigest().encode()
+        if sha.decode() not in RedisScript.emulations:
+            raise ServerError('ERR memory redis can only run scripts that have a python version (see RedisScript)')
+        return self._cmd_evalsha(sha, numkeys, *args)
+
+    # what redis.call does inside a script: errors are raised, not returned
+    def _script_call(self, name: str, *args):
+        result = self.execute([name.encode()] + [conv.encode(arg) for arg in args])
+        if isinstance(result, ServerError):
+            raise result
+        return result
+
+
+class MemoryDB(DB):
+
+    def __init__(self, redis: 'MemoryRedis'):
+        # skip DB.__init__, which grabs a connection
+        super(DB, self).__init__()
+        self.redis = redis
+        self.protocol = None
+        self.commands = []
+        # commands waiting for EXEC, or None when we're not in a MULTI
+        self._multi: Optional[list] = None
+        # key -> version when it was WATCHed
+        self._watched: Dict[bytes, int] = {}
+
+    def __del__(self):
+        pass
+
+    async def _run(self):
+        if not self.commands:
+            return None
+
+        redis = self.redis
+        if redis.latency:
+            await trio.sleep(redis.latency)
+
+        start = perf_counter()
+        commands, self.commands = self.commands, []
+        replies = [self._call([conv.encode(arg) for arg in cmd]) for _, cmd in commands]
+        redis.record(commands, (perf_counter() - start) * 1000, replies if len(replies) != 1 else replies[0])
+
+        result = self._decode(_handle_response([handler for handler, _ in commands], replies))
+        self.bytedecoder(None)
+        return result if len(result) != 1 else result[0]
+
+    # Transactions happen here because they're per connection. Everything else goes to the shared store.
+    def _call(self, cmd: List[bytes]):
+        store = self.redis.store
+        name = cmd[0].upper()
+        if name == b'MULTI':
+            self._multi = []
+            return 'OK'
+        if name == b'DISCARD':
+            self._multi = None
+            self._watched = {}
+            return 'OK'
+        if name == b'EXEC':
+            queued, self._multi = self._multi or [], None
+            watched, self._watched = self._watched, {}
+            if any(store.key_versions.get(key, 0) != version for key, version in watched.items()):
+                # someone changed a watched key, nothing runs
+                return False
+            return [store.execute(queued_cmd) for queued_cmd in queued]
+        if self._multi is not None:
+            self._multi.append(cmd)
+            return 'QUEUED'
+        if name == b'WATCH':
+            for key in cmd[1:]:
+                self._watched[key] = store.key_versions.get(key, 0)
+            return 'OK'
+        if name == b'UNWATCH':
+            self._watched = {}
+            return 'OK'
+
+        return store.execute(cmd)
+
+
+# Stands in for redio's PubSub: async iterate over it to get the messages published to its channels
+class MemoryPubSub:
+    # like a real subscriber that can't keep up, messages past this are dropped
+    Buffer = 1000
+
+    def __init__(self, store: MemoryStore, *channels: str):
+        self.store = store
+        self.channels = [c.encode() if isinstance(c, str) else c for c in channels]
+        self._send, self._receive = trio.open_memory_channel(self.Buffer)
+
+    async def connect(self) -> 'MemoryPubSub':
+        for channel in self.channels:
+            self.store.subscribers.setdefault(channel, set()).add(self)
+        return self
+
+    def close(self):
+        for channel in self.channels:
+            self.store.subscribers.get(channel, set()).discard(self)
+
+    def deliver(self, message: bytes):
+        try:
+            self._send.send_nowait(message)
+        except trio.WouldBlock:
+            pass
+
+    async def __aiter__(self):
+        await self.connect()
+        try:
+            while True:
+                yield await self._receive.receive()
+        finally:
+            self.close()
+
+
+class MemoryRedis(RedisStats):
+
+    def __init__(self, latency: float = 0):
+        super(MemoryRedis, self).__init__()
+        # seconds every round trip takes, to pretend there's a network
+        self.latency = latency
+        self.store = MemoryStore()
+
+    @classmethod
+    def from_url(cls, url: str) -> 'MemoryRedis':
+        query = parse_qs(urlparse(url).query)
+        latency_ms = float(query.get('latency_ms', ['0'])[0])
+        return cls(latency=latency_ms / 1000)
+
+    def __call__(self) -> MemoryDB:
+        return MemoryDB(self)
+
+    def pubsub(self, *channels: str) -> MemoryPubSub:
+        return MemoryPubSub(self.store, *channels)
+
+    @property
+    def data(self) -> dict:
+        return {
+            'backend': 'memory',
+            'latency_ms': self.latency * 1000,
+            'keys': len(self.store.data),
+            'round_trips': self.round_trips,
+            'commands': self.command_data
+        }
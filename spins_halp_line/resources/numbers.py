@@ -40,18 +40,8 @@ class PhoneNumber:
 
         return False
 
-    # todo: I keep fucking up and putting PhoneNumbers directly into dictionaries that will get serialized to JSON.
-    # todo: Now, this should be an easy thing to handle - a PhoneNumber has a simple way to be serialized (.e164),
-    # todo: but it doesn't seem like the standard `json` library has an interface on objects that it'll
-    # todo: use to serialize non-standard things.
-
-    # todo: So, we have three options:
-    # todo: - add a central json helper file which we route all json encode / decode calls through, and which
-    # todo:   has a subclass of JsonEncoder that will handle phone numbers properly
-    # todo: - find another JSON library that *does* have a standardized serialize call that
-    # todo:   it'll call on objects it doesn't know how to seralize
-    # todo: - add code that checks to make sure we aren't adding non-basic
-    # todo:   objects to states (probably the hardest solution)
+    # I kept putting PhoneNumbers directly into dictionaries that get serialized to JSON, so everything that
+    # gets persisted now goes through resources/codec.py, which knows to store these as their e164.
 
     def __hash__(self):
         return hash(self.e164)
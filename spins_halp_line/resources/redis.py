@@ -1,4 +1,16 @@
+from bisect import bisect_left
+from functools import partial
+from hashlib import sha1
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
 import redio
+import trio
+from redio.exc import RedisError, ProtocolError
+from redio.highlevel import DB
+from redio.protocol import Protocol
+
+from spins_halp_line.constants import Credentials
 
 
 # holds the class that manages the player info in redis
@@ -6,8 +18,267 @@ import redio
 # todo: we can detect if a player is getting race condition'd (i.e. there are two copies of them)
 # todo: out and they might get squashed
 
-def redis_factory() -> redio.Redis:
-    return redio.Redis("redis://localhost/")
+# Settings can be overridden with a "redis" section in creds.json
+_config = Credentials.get("redis", {})
+# "memory://" urls use the in-process stand-in in memory_redis.py, see redis_factory
+Redis_Url = _config.get("url", "redis://localhost/")
+# Most connections we'll have open to redis at once. Requests past this wait for a connection to free up.
+Max_Connections = _config.get("max_connections", 20)
+# Connections that have sat in the pool longer than this get PINGed before we use them
+Health_Check_After = _config.get("health_check_after", 30)
+# Connections that have sat in the pool longer than this get closed
+Max_Idle = _config.get("max_idle", 300)
+
+
+# Latency and error counts for a single redis command
+class CommandMetrics:
+    # upper bounds of the histogram buckets, in milliseconds
+    Buckets_Ms = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        # one more bucket than bounds, for everything slower than the last bound
+        self.histogram = [0] * (len(self.Buckets_Ms) + 1)
+
+    def record(self, ms: float, error: bool = False):
+        self.calls += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.histogram[bisect_left(self.Buckets_Ms, ms)] += 1
+        if error:
+            self.errors += 1
+
+    @property
+    def data(self) -> dict:
+        labels = [f'<={b}ms' for b in self.Buckets_Ms] + [f'>{self.Buckets_Ms[-1]}ms']
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'avg_ms': round(self.total_ms / self.calls, 3) if self.calls else 0,
+            'max_ms': round(self.max_ms, 3),
+            'histogram': dict(zip(labels, self.histogram))
+        }
+
+
+# Round trip and per command counts, shared by every kind of redis we can talk to
+class RedisStats:
+
+    def __init__(self):
+        self.round_trips = 0
+        self.commands: Dict[str, CommandMetrics] = {}
+
+    # Every command in a pipeline gets the time of the whole round trip. `results` is None if the round trip
+    # failed outright.
+    def record(self, commands: list, ms: float, results=None, failed=False):
+        self.round_trips += 1
+        if len(commands) == 1 or not isinstance(results, list):
+            results = [results]
+
+        for n, (_, cmd) in enumerate(commands):
+            name = cmd[0].decode() if isinstance(cmd[0], bytes) else str(cmd[0])
+            error = failed or (n < len(results) and isinstance(results[n], RedisError))
+            self.commands.setdefault(name.upper(), CommandMetrics()).record(ms, error)
+
+    @property
+    def command_data(self) -> dict:
+        return {name: metrics.data for name, metrics in sorted(self.commands.items())}
+
+
+# A redio.Redis that only holds on to a connection while commands are actually running.
+#
+# redio's DB objects take a connection when they are created and only give it back when they're garbage
+# collected. We make a DB for every Player and ScriptStateManager call, so a burst of requests would open a
+# connection per object. Our DBs borrow a connection for each round trip instead, and we cap how many can be
+# open at once.
+class RedisPool(redio.Redis, RedisStats):
+
+    def __init__(self,
+                 url: str = Redis_Url,
+                 max_connections: int = Max_Connections,
+                 health_check_after: float = Health_Check_After,
+                 max_idle: float = Max_Idle):
+        redio.Redis.__init__(self, url, pool_max=max_connections)
+        RedisStats.__init__(self)
+        self.max_connections = max_connections
+        self.health_check_after = health_check_after
+        self.max_idle = max_idle
+        self._limiter: Optional[trio.CapacityLimiter] = None
+        # (connection, time it was returned) - most recently used last
+        self._idle: List[tuple] = []
+        self.opened = 0
+        self.closed = 0
+        self.health_checks = 0
+
+    def __call__(self) -> 'PooledDB':
+        return PooledDB(self)
+
+    @property
+    def limiter(self) -> trio.CapacityLimiter:
+        # needs to be made inside trio
+        if self._limiter is None:
+            self._limiter = trio.CapacityLimiter(self.max_connections)
+        return self._limiter
+
+    async def _connection(self) -> Protocol:
+        now = trio.current_time()
+        while self._idle:
+            connection, returned = self._idle.pop()
+            idle_for = now - returned
+            if connection.closed or idle_for > self.max_idle:
+                await self._close(connection)
+                continue
+
+            if idle_for > self.health_check_after:
+                self.health_checks += 1
+                try:
+                    await connection.PING()
+                except Exception:
+                    await self._close(connection)
+                    continue
+
+            return connection
+
+        connection = Protocol(self.conninfo)
+        await connection.connect()
+        self.opened += 1
+        return connection
+
+    async def _release(self, connection: Protocol):
+        if connection.closed:
+            return
+
+        if len(self._idle) >= self.max_connections:
+            # only happens with connections pinned by transactions, which don't count against the limit
+            await self._close(connection)
+        else:
+            self._idle.append((connection, trio.current_time()))
+
+    async def _close(self, connection: Protocol):
+        self.closed += 1
+        await connection.aclose()
+
+    # _close for when we can't await (e.g. from __del__): closes the socket under the connection directly
+    def _drop(self, connection: Protocol):
+        stream, connection.sock = connection.sock, None
+        if stream is None:
+            return
+
+        self.closed += 1
+        # an ssl stream wraps the socket stream
+        stream = getattr(stream, 'transport_stream', stream)
+        stream.socket.close()
+
+    @property
+    def data(self) -> dict:
+        return {
+            'max_connections': self.max_connections,
+            'in_use': self.limiter.borrowed_tokens,
+            'waiting': self.limiter.statistics().tasks_waiting,
+            'idle': len(self._idle),
+            'opened': self.opened,
+            'closed': self.closed,
+            'health_checks': self.health_checks,
+            'round_trips': self.round_trips,
+            'commands': self.command_data
+        }
+
+
+class PooledDB(DB):
+
+    def __init__(self, redis: RedisPool):
+        # skip DB.__init__, which grabs a connection
+        super(DB, self).__init__()
+        # DB sets self.redis to None when it wants to stop pooling, so we keep our own reference
+        self.redis = self._pool = redis
+        self.protocol = None
+        self.commands = []
+        # transactions need every command on the same connection, so they keep theirs until they're done
+        self._pinned: Optional[Protocol] = None
+
+    def __del__(self):
+        # Connections go back to the pool after each round trip, not when we're collected. A connection that's
+        # still pinned here was left in the middle of a WATCH / MULTI, so it can't be reused: we close it, and
+        # redis throws the transaction away with it.
+        if self._pinned is not None:
+            self._pool._drop(self._pinned)
+            self._pinned = None
+
+    async def _run(self):
+        if not self.commands:
+            return None
+
+        if self._pinned is not None or self._transaction_state is not None:
+            return await self._run_pinned()
+
+        pool = self._pool
+        commands = self.commands
+        async with pool.limiter:
+            # A connection that redis closed while it sat in the pool is found before anything is sent,
+            # so it's safe to try again on a new one.
+            for attempt in range(2):
+                self.commands = list(commands)
+                self.protocol = await pool._connection()
+                start = perf_counter()
+                try:
+                    result = await self._execute()
+                except ProtocolError as e:
+                    pool.record(commands, (perf_counter() - start) * 1000, failed=True)
+                    await pool._close(self.protocol)
+                    if attempt or 'unexpected data' not in str(e):
+                        raise
+                    continue
+                except BaseException:
+                    pool.record(commands, (perf_counter() - start) * 1000, failed=True)
+                    await pool._close(self.protocol)
+                    raise
+                finally:
+                    connection, self.protocol = self.protocol, None
+
+                pool.record(commands, (perf_counter() - start) * 1000, result)
+                await pool._release(connection)
+                return result
+
+    async def _run_pinned(self):
+        pool = self._pool
+        if self._pinned is None:
+            self._pinned = Protocol(pool.conninfo)
+            await self._pinned.connect()
+            pool.opened += 1
+
+        commands = self.commands
+        self.protocol = self._pinned
+        start = perf_counter()
+        try:
+            result = await self._execute()
+        except BaseException:
+            pool.record(commands, (perf_counter() - start) * 1000, failed=True)
+            await pool._close(self._pinned)
+            self._pinned = None
+            raise
+        finally:
+            self.protocol = None
+
+        pool.record(commands, (perf_counter() - start) * 1000, result)
+        if self._transaction_state is None:
+            # transaction is over, the connection can go back in the pool
+            await pool._release(self._pinned)
+            self._pinned = None
+
+        return result
+
+
+# A "memory://" url (e.g. "memory://?latency_ms=2") gets the in-process stand-in from memory_redis.py instead
+# of a real server
+def redis_factory(url: Optional[str] = None):
+    url = url or Redis_Url
+    if url.startswith('memory://'):
+        from spins_halp_line.resources.memory_redis import MemoryRedis
+        return MemoryRedis.from_url(url)
+
+    return RedisPool(url)
 
 
 # global redis connection factory
@@ -22,7 +293,191 @@ def new_redis():
     return _redis()
 
 
+# A redio PubSub (or memory_redis's stand-in) for `channels`. Iterate over it to get messages as bytes.
+def new_pubsub(*channels: str):
+    global _redis
+    if _redis is None:
+        _redis = redis_factory()
+
+    return _redis.pubsub(*channels)
+
+
+def redis_stats() -> dict:
+    if _redis is None:
+        return {}
+
+    return _redis.data
+
+
 async def delete_key(key):
     db = new_redis()
 
     await db.delete(key)
+
+
+# The result of a command queued on a RedisBatch. Awaiting it sends everything queued on the batch so far.
+class Pending:
+
+    def __init__(self, batch: 'RedisBatch', finish: Optional[Callable[[Any], Awaitable[Any]]] = None):
+        self._batch = batch
+        # gets a chance to look at (and replace) the raw reply, e.g. to re-run a script redis didn't have cached
+        self._finish = finish
+        self._done = False
+        self._value = None
+        self._error: Optional[BaseException] = None
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    @property
+    def value(self):
+        if not self._done:
+            raise ValueError("Result read before its batch was sent")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    async def _resolve(self, reply):
+        try:
+            if self._finish is not None:
+                reply = await self._finish(reply)
+            self._value = reply
+        except Exception as e:
+            self._error = e
+        self._done = True
+
+    def _fail(self, error: BaseException):
+        self._error = error
+        self._done = True
+
+    def __await__(self):
+        return self._get().__await__()
+
+    async def _get(self):
+        if not self._done:
+            await self._batch.flush()
+        return self.value
+
+
+# Lets independent bits of code queue up redis commands and send them all in one round trip.
+#
+#   batch = RedisBatch()
+#   first = batch.get('a')
+#   second = batch.hgetall('b')
+#   await first  # sends both
+#   second.value
+#
+# Any redio command can be queued, except transactions, which need their own connection. Commands redio only
+# checks the reply of (SET -> "OK", PING -> "PONG") get that reply as their result.
+class RedisBatch:
+    _Transaction_Commands = frozenset(['watch', 'unwatch', 'multi', 'exec', 'discard'])
+
+    def __init__(self):
+        self._db = new_redis()
+        self._queued: List[Pending] = []
+        self._lock = trio.Lock()
+        self.flushes = 0
+
+    def queue(self, name: str, *args, finish=None) -> Pending:
+        if name in self._Transaction_Commands:
+            raise ValueError(f"{name} can't be batched, transactions need their own connection")
+
+        getattr(self._db, name)(*args)
+        # redio drops the reply of commands it only checks, which would hand every reply after it to the wrong
+        # Pending. We take the reply instead (and check it ourselves) so there's always one per Pending.
+        expected, cmd = self._db.commands[-1]
+        if isinstance(expected, str):
+            self._db.commands[-1] = (None, cmd)
+            finish = partial(self._check_status, expected, finish)
+
+        pending = Pending(self, finish)
+        self._queued.append(pending)
+        return pending
+
+    @staticmethod
+    async def _check_status(expected: str, finish, reply):
+        if isinstance(reply, RedisError):
+            raise reply
+        if reply != expected:
+            raise ProtocolError(f"Expected {expected}, got {reply}")
+        return reply if finish is None else await finish(reply)
+
+    # for commands redio doesn't have a method for, e.g. batch.command('HMGET', key, field)
+    def command(self, *cmd, finish=None) -> Pending:
+        return self.queue('_command', *cmd, finish=finish)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(DB, name):
+            raise AttributeError(name)
+        return partial(self.queue, name)
+
+    def __len__(self):
+        return len(self._queued)
+
+    async def flush(self):
+        async with self._lock:
+            # someone else may have sent our commands while we waited
+            if not self._queued:
+                return
+
+            queued, self._queued = self._queued, []
+            self.flushes += 1
+            try:
+                replies = await self._db
+            except Exception as e:
+                # everyone waiting on this round trip gets the error when they look at their result
+                for pending in queued:
+                    pending._fail(e)
+                raise
+
+            # redio unwraps single results
+            if len(queued) == 1:
+                replies = [replies]
+
+            for pending, reply in zip(queued, replies):
+                await pending._resolve(reply)
+
+
+# Wrapper around a lua script so that we can do check-and-set style operations in a single round trip.
+# Redis caches scripts by their sha, so we only send the full source the first time (or after a server
+# restart flushes the script cache).
+#
+# `emulate` is a python version of the script for MemoryRedis, which can't run lua. It's called with
+# (call, keys, args), where call(command, *args) works like redis.call and keys / args are bytes.
+class RedisScript:
+    # sha -> python version of the script
+    emulations: Dict[str, Callable] = {}
+
+    def __init__(self, source: str, emulate: Optional[Callable] = None):
+        self.source = source
+        self.sha = sha1(source.encode()).hexdigest()
+        if emulate is not None:
+            self.emulations[self.sha] = emulate
+
+    async def run(self, keys: list, args: list, db=None):
+        if db is None:
+            db = new_redis()
+
+        result = await db.evalsha(self.sha, len(keys), *keys, *args)
+        if isinstance(result, RedisError) and 'NOSCRIPT' in str(result):
+            result = await db.eval(self.source, len(keys), *keys, *args)
+
+        # redio hands server errors back instead of raising them
+        if isinstance(result, RedisError):
+            raise result
+
+        return result
+
+    # `finish` gets a look at the script's result, like it does for RedisBatch.command
+    def queue(self, batch: RedisBatch, keys: list, args: list, finish=None) -> Pending:
+        async def script_finish(result):
+            if isinstance(result, RedisError) and 'NOSCRIPT' in str(result):
+                # only happens the first time (or after redis restarts), so another round trip is fine
+                result = await new_redis().eval(self.source, len(keys), *keys, *args)
+
+            if isinstance(result, RedisError):
+                raise result
+            return result if finish is None else await finish(result)
+
+        return batch.queue('evalsha', self.sha, len(keys), *keys, *args, finish=script_finish)
@@ -0,0 +1,62 @@
+import zlib
+from typing import Any, List, Optional, Tuple
+
+from spins_halp_line.resources.redis import new_redis
+from spins_halp_line.resources import codec
+from spins_halp_line.util import Logger
+
+# A fixed number of slots in redis that we write to round and round, for things we want to keep the last N of
+# (and survive restarts) without anyone having to clean up after them.
+#
+# Every entry gets the next number from a counter and lands in slot `number % size`, overwriting whatever was
+# there `size` entries ago. Entries are stored compressed with their number inside, so a fetch for an entry
+# that has since been overwritten comes back empty instead of handing you its replacement.
+
+
+class RingBuffer(Logger):
+
+    def __init__(self, key: str, size: int):
+        super(RingBuffer, self).__init__()
+        self.key = key
+        self.size = size
+
+    @property
+    def counter_key(self):
+        return f'{self.key}:next'
+
+    def _slot_key(self, number: int) -> str:
+        return f'{self.key}:{number % self.size}'
+
+    @staticmethod
+    def _pack(number: int, entry: Any) -> bytes:
+        return zlib.compress(codec.encode([number, entry]))
+
+    @staticmethod
+    def _unpack(blob: Optional[bytes]) -> Optional[Tuple[int, Any]]:
+        if not blob:
+            return None
+        number, entry = codec.decode(zlib.decompress(blob))
+        return number, entry
+
+    # Stores the entry (anything codec can encode) and returns its number
+    async def push(self, entry: Any) -> int:
+        number = await new_redis().incr(self.counter_key)
+        blob = self._pack(number, entry)
+        await new_redis().set(self._slot_key(number), blob)
+        self.d(f'push(): {self.key} #{number} ({len(blob)} bytes)')
+        return number
+
+    # The entry numbered `number`, or None if it was never written or has been overwritten
+    async def get(self, number: int) -> Optional[Any]:
+        found = self._unpack(await new_redis().get(self._slot_key(number)))
+        if found is None or found[0] != number:
+            return None
+        return found[1]
+
+    # Everything still in the buffer as [(number, entry)...], newest first
+    async def entries(self) -> List[Tuple[int, Any]]:
+        blobs = await new_redis().mget(*[f'{self.key}:{slot}' for slot in range(self.size)])
+        if not isinstance(blobs, list):
+            blobs = [blobs]
+        found = [self._unpack(blob) for blob in blobs]
+        return sorted((f for f in found if f is not None), key=lambda f: f[0], reverse=True)
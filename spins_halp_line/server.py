@@ -14,12 +14,12 @@ from twilio.twiml.voice_response import VoiceResponse, Play
 from spins_halp_line.actions.conferences import (
     Conf_Twiml_Path,
     Conf_Status_Path,
-    conferences,
+    get_conference,
     load_conferences
 )
 from spins_halp_line.actions.twilio import make_call
-from spins_halp_line.constants import Root_Url
-from spins_halp_line.events import event_websocket, send_event
+from spins_halp_line.constants import Root_Url, Shared_Workers
+from spins_halp_line.events import event_websocket, send_event, EventRelay
 from spins_halp_line.media.common import All_Resources
 from spins_halp_line.media.common import (
     End_A, End_B, End_C, End_D, End_E,
@@ -28,18 +28,22 @@ from spins_halp_line.media.common import (
 from spins_halp_line.media.resource_space import RSResource
 from spins_halp_line.player import Player
 from spins_halp_line.resources.numbers import PhoneNumber, Global_Number_Library
+from spins_halp_line.resources.locks import lock_stats
+from spins_halp_line.resources.redis import redis_stats
 from spins_halp_line.stories.story_objects import (
     Script,
     Snapshot,
     confused_response
 )
+from spins_halp_line.stories.dispatch import Dispatcher
+from spins_halp_line.stories.request_context import RequestContext
 from spins_halp_line.stories.tele_constants import (
     Key_path, Path_Clavae, Path_Karen
 )
 from spins_halp_line.stories.tele_story_objects import TelePlayer
 from spins_halp_line.stories.tele_story_objects import TeleShard
 from spins_halp_line.stories.telemarketopia import telemarketopia
-from spins_halp_line.tasks import Trio_Task_Task_Object_Runner, GitUpdate, Task, add_task
+from spins_halp_line.tasks import Trio_Task_Task_Object_Runner, GitUpdate, Task, TaskPoller, add_task
 from spins_halp_line.twil import t_resp, TwilRequest
 from spins_halp_line.util import do_monkey_patches, get_logger
 
@@ -81,6 +85,7 @@ from spins_halp_line.util import do_monkey_patches, get_logger
 # todo: whatever.
 
 Script.add_script(telemarketopia)
+dispatcher = Dispatcher(Script.Active_Scripts)
 
 do_monkey_patches()
 
@@ -142,26 +147,20 @@ async def main_number():
     response = None
 
     await req.load()
+    ctx = RequestContext(req)
 
-    # players already in a game
-    # todo: improve this system
-    for script in Script.Active_Scripts:
-        if await script.request_made_by_active_player(req):
-            response = await script.play(req)
-            # await player.save()
-            break
-
-    # start a new game
-    if not response:
-        for script in Script.Active_Scripts:
-            if await script.call_could_start_game(req):
-                response = await script.play(req)
-                # await player.save()
-                break
+    # the caller is loaded to find their script, so hold their lock from here until the script has saved them
+    async with ctx.holding(req.caller):
+        # the game they're playing, or the one this number starts
+        script = await dispatcher.call_script(ctx)
+        if script is not None:
+            response = await script.play(req, ctx)
 
     if not response:
         response = confused_response()
 
+    log.debug(f'{ctx}: {ctx.stats}')
+
     # save any state changes we recorded
     # await req.player.save()
 
@@ -172,12 +171,14 @@ async def main_number():
 async def handle_text():
     req = TwilRequest(request)
     await req.load()
+    ctx = RequestContext(req)
 
-    for script in Script.Active_Scripts:
-        if await script.request_made_by_active_player(req):
-            await script.process_text(req)
-            break
+    async with ctx.holding(req.caller):
+        script = await dispatcher.active_script(ctx)
+        if script is not None:
+            await script.process_text(req, ctx)
 
+    log.debug(f'{ctx}: {ctx.stats}')
     return t_resp("")
 
 
@@ -270,11 +271,9 @@ async def get_conf_connection_twil(c_number):
     req = TwilRequest(request)
     await req.load()
 
-    confs = conferences()
-
-    for conf in confs:
-        if conf == c_number:
-            return t_resp(await conf.twiml_xml(req.num_called))
+    conf = await get_conference(c_number)
+    if conf is not None:
+        return t_resp(await conf.twiml_xml(req.num_called))
 
 
 @app.route(Conf_Status_Path, methods=["GET", "POST"])
@@ -282,11 +281,9 @@ async def conf_status_update(c_number):
     req = TwilRequest(request)
     await req.load()
 
-    confs = conferences()
-
-    for conf in confs:
-        if conf == c_number:
-            await conf.handle_conf_event(req.data)
+    conf = await get_conference(c_number)
+    if conf is not None:
+        await conf.handle_conf_event(req.data)
     # just 200-ok them
     return ""
 
@@ -401,11 +398,11 @@ async def reset_state():
     if code == '2501':
         await telemarketopia.reset()
 
-    for p in await Player.get_all_players():
-        await p.load()
-        result['players'][p.number.e164] = p.data
-        if code == '2501':
-            await p.reset(p)
+    for key, data in (await Player.get_all_json()).items():
+        result['players'][PhoneNumber(key).e164] = data
+
+    if code == '2501':
+        await Player.reset_all()
 
     return jsonify(result)
 
@@ -437,14 +434,48 @@ async def list_players():
     return jsonify(await Player.get_all_json())
 
 
+@app.route("/debug/redis", methods=['GET'])
+async def redis_metrics():
+    return jsonify(redis_stats())
+
+
+@app.route("/debug/locks", methods=['GET'])
+async def debug_locks():
+    return jsonify(lock_stats())
+
+
+@app.route("/debug/reducer", methods=['GET'])
+async def reducer_metrics():
+    return jsonify(telemarketopia.state_manager.reducer_stats)
+
+
+@app.route("/debug/matchmaker", methods=['GET'])
+async def matchmaker_metrics():
+    return jsonify(telemarketopia.state_manager.matchmaker.stats)
+
+
 @app.route("/debug/players/<p_num>", methods=['DELETE'])
 async def delete_player(p_num):
     return str(await Player.reset(Player.from_number(p_num)))
 
 
+@app.route("/debug/snapshots", methods=['GET'])
+async def list_snapshots():
+    return jsonify(await Snapshot.list_snapshots())
+
+
+@app.route("/debug/snapshot/<snap_num>", methods=['GET'])
+async def get_snapshot(snap_num):
+    snap = await Snapshot.get_snapshot(snap_num)
+    if not snap:
+        return "", 404
+
+    return jsonify(snap.data)
+
+
 @app.route("/debug/snapshot/<snap_num>", methods=['POST'])
 async def load_snapshot(snap_num):
-    snap = Snapshot.get_snapshot(snap_num)
+    snap = await Snapshot.get_snapshot(snap_num)
     if snap:
         await snap.restore(telemarketopia)
 
@@ -515,11 +546,20 @@ class ServerLoad(Task):
         await load_conferences()
         self.d("Conferences loaded!")
 
+        self.d("Indexing players")
+        await Player.rebuild_index()
+        self.d("Players indexed!")
+
         self.d("Loading script state from redis!")
         # in theory we should use the script index but we don't have the time for that
         await telemarketopia.load_state()
         self.d("State loaded!")
 
+        if Shared_Workers:
+            self.d("Picking up shared tasks and events from redis")
+            await add_task.send(TaskPoller())
+            await add_task.send(EventRelay())
+
         self.d("Starting Web Server")
         self._nurse.start_soon(self._serve)
 
@@ -0,0 +1,71 @@
+from typing import Dict, List, Optional
+
+from spins_halp_line.resources.numbers import PhoneNumber
+from spins_halp_line.stories.request_context import RequestContext
+from spins_halp_line.stories.story_objects import Script
+from spins_halp_line.util import Logger
+
+# Picks the script a webhook goes to.
+#
+# This used to be two walks over Script.Active_Scripts: load the caller and decode their info for each script to
+# see if they were playing it, then ask each script in turn if the number they called starts a game. Now:
+# - players carry a marker of the script they're playing (Player.active_script), so we read that instead
+# - the numbers that start each script are in a dict, built when the script is added
+#
+# Players saved before the marker existed don't have one. They get the old walk once, and the marker is saved
+# along with the rest of the request.
+
+
+class Dispatcher(Logger):
+
+    def __init__(self, scripts: Optional[List[Script]] = None):
+        super(Dispatcher, self).__init__()
+        self._scripts: Dict[str, Script] = {}
+        # number called -> script a new player starts by calling it
+        self._starts: Dict[str, Script] = {}
+        self._start_any: Optional[Script] = None
+        for script in scripts or []:
+            self.add(script)
+
+    # Scripts added first win if two start on the same number, like they did when we walked Active_Scripts
+    def add(self, script: Script):
+        self._scripts[script.name] = script
+        for number in script.start_numbers:
+            self._starts.setdefault(number, script)
+        if script.starts_on_any_number and self._start_any is None:
+            self._start_any = script
+
+    @property
+    def scripts(self) -> List[Script]:
+        return list(self._scripts.values())
+
+    # The script the caller is playing, if any
+    async def active_script(self, ctx: RequestContext) -> Optional[Script]:
+        if not self._scripts:
+            return None
+
+        # Loaded the way the first script loads players. A script using the same player class gets the same
+        # object from ctx when it plays, without another read.
+        player = await next(iter(self._scripts.values())).request_player(ctx)
+        name = player.active_script
+        if name is None:
+            name = ''
+            for script in self._scripts.values():
+                if script.player_is_playing(player):
+                    name = script.name
+                    break
+            self.d(f'active_script({player}): no marker yet, found "{name}"')
+            player.active_script = name
+
+        return self._scripts.get(name) if name else None
+
+    # The script a new player starts by calling `number_called`, if any
+    def start_script(self, number_called: PhoneNumber) -> Optional[Script]:
+        return self._starts.get(number_called.e164, self._start_any)
+
+    # Where a call goes: the caller's script if they're playing one, otherwise the one this number starts
+    async def call_script(self, ctx: RequestContext) -> Optional[Script]:
+        script = await self.active_script(ctx)
+        if script is None:
+            script = self.start_script(ctx.num_called)
+        return script
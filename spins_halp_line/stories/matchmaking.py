@@ -0,0 +1,103 @@
+from collections import deque
+from datetime import datetime, timedelta
+from time import monotonic
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from spins_halp_line.util import Logger
+
+# Pairs up players waiting on two sides of something (e.g. Clavae and Karen players waiting for a conference).
+#
+# Every pair that can be made is made in one pass. On each side, players go in this order:
+# - players we've heard from in the last Active_Window, ahead of anyone who has been quiet for longer (or hasn't
+#   said anything)
+# - then whoever has been waiting longest, which is their place in the queue: the waiting lists are in the order
+#   people joined, and people who are put back after a conference that didn't happen go to the front if they
+#   were around for it
+#
+# The order only decides who gets left waiting on the side with more people, and who is paired with who.
+
+
+class Matchmaker(Logger):
+    Active_Window = timedelta(minutes=10)
+    # how many of the most recent wait times we keep for stats
+    Keep_Waits = 1000
+
+    def __init__(self, clock: Callable[[], float] = monotonic):
+        super(Matchmaker, self).__init__()
+        self._clock = clock
+        # when we first saw each waiting player, so we can say how long they waited
+        self._seen: Dict[str, float] = {}
+        self._waits = deque(maxlen=self.Keep_Waits)
+        # for /debug/matchmaker
+        self.passes = 0
+        self.pairs = 0
+        self.largest_pass = 0
+
+    # Notes when we first saw everyone in `queues`, and forgets anyone we've seen who isn't in them anymore
+    def observe(self, *queues: Iterable[str]):
+        now = self._clock()
+        waiting = set()
+        for queue in queues:
+            for player in queue:
+                waiting.add(player)
+                self._seen.setdefault(player, now)
+
+        for player in [p for p in self._seen if p not in waiting]:
+            del self._seen[player]
+
+    # `queue` in the order players should be paired. `last_active` is when we last heard from each player (or an
+    # isoformat string of it); players who aren't in it haven't been heard from.
+    def rank(self, queue: Sequence[str], last_active: Optional[Dict[str, object]] = None,
+             now: Optional[datetime] = None) -> List[str]:
+        if not last_active:
+            return list(queue)
+
+        now = now or datetime.now()
+
+        def quiet(player: str) -> bool:
+            active = last_active.get(player)
+            if isinstance(active, str):
+                active = datetime.fromisoformat(active)
+            return active is None or now - active > self.Active_Window
+
+        # sorted() is stable, so everyone keeps their place in the queue among players who are as active as them
+        return sorted(queue, key=quiet)
+
+    # Every pair we can make from the two queues, as [(left player, right player)...]
+    def match(self, left: Sequence[str], right: Sequence[str], last_active: Optional[Dict[str, object]] = None,
+              now: Optional[datetime] = None) -> List[Tuple[str, str]]:
+        self.observe(left, right)
+        self.passes += 1
+        pairs = list(zip(self.rank(left, last_active, now), self.rank(right, last_active, now)))
+        if not pairs:
+            return pairs
+
+        now_clock = self._clock()
+        for pair in pairs:
+            for player in pair:
+                self._waits.append(now_clock - self._seen.pop(player, now_clock))
+
+        self.pairs += len(pairs)
+        self.largest_pass = max(self.largest_pass, len(pairs))
+        self.d(f'match(): paired {len(pairs)}, {len(left) - len(pairs)} + {len(right) - len(pairs)} still waiting')
+        return pairs
+
+    @staticmethod
+    def percentile(values: Sequence[float], p: float) -> float:
+        if not values:
+            return 0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'passes': self.passes,
+            'pairs': self.pairs,
+            'largest_pass': self.largest_pass,
+            'waiting': len(self._seen),
+            # seconds between us first seeing a player waiting and pairing them, for the last Keep_Waits players
+            'wait_p50': self.percentile(self._waits, 50),
+            'wait_p90': self.percentile(self._waits, 90),
+            'wait_p99': self.percentile(self._waits, 99),
+        }
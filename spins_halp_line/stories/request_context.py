@@ -0,0 +1,100 @@
+import inspect
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Set, Union, Callable
+
+from spins_halp_line.player import Player
+from spins_halp_line.resources.locks import Player_Locks
+from spins_halp_line.resources.numbers import PhoneNumber
+from spins_halp_line.twil import TwilRequest
+from spins_halp_line.util import Logger, RequestStats, LockManager
+
+
+# Everything we've loaded while handling a single webhook.
+#
+# Before this existed, /tipline/start would load the caller once per script to see if they were playing,
+# then the script would load them again to play, and text handlers would load any partner they needed.
+# Now the first load of a player is kept here and handed to everyone else who asks for that number
+# during the same request, so each webhook does at most one redis read per player.
+#
+# It also holds the player locks for the request (see holding), so two webhooks from the same caller can't both
+# load, change and save them at the same time.
+class RequestContext(Logger):
+
+    def __init__(self, request: TwilRequest):
+        super(RequestContext, self).__init__()
+        self.request = request
+        self.stats = RequestStats()
+        self._players: Dict[str, Player] = {}
+        self._shards: Dict[str, 'Shard'] = {}
+        # players whose lock we hold
+        self._held: Set[str] = set()
+
+    @property
+    def caller(self) -> Optional[PhoneNumber]:
+        return self.request.caller
+
+    @property
+    def num_called(self) -> Optional[PhoneNumber]:
+        return self.request.num_called
+
+    # `create` is either a Player class or a coroutine that makes one (like ScriptStateManager.create_player)
+    async def player(self, number: Union[str, PhoneNumber], create: Callable = Player) -> Player:
+        key = PhoneNumber(number).e164
+        player = self._players.get(key)
+
+        if player is None or not isinstance(player, self._player_class(create, player)):
+            if player is not None:
+                self.w(f'player({key}): have {player.__class__.__name__} but need a different class, reloading')
+
+            player = create(key)
+            if inspect.isawaitable(player):
+                player = await player
+
+            player.stats = self.stats
+            await player.load()
+            self._players[key] = player
+
+        return player
+
+    @staticmethod
+    def _player_class(create: Callable, cached: Player) -> type:
+        # coroutines can't tell us what they'll make ahead of time so we trust the cached copy
+        if inspect.isclass(create):
+            return create
+        return type(cached)
+
+    async def caller_player(self, create: Callable = Player) -> Player:
+        return await self.player(self.caller, create)
+
+    # Holds `number`'s player lock for the block. If this request already holds it (e.g. the server took it
+    # before handing the request to a script) it just carries on.
+    # Only one player at a time: two numbers can share a lock stripe, and stripes aren't reentrant.
+    @asynccontextmanager
+    async def holding(self, number: Union[str, PhoneNumber]):
+        key = PhoneNumber(number).e164
+        if key in self._held:
+            yield
+            return
+
+        if self._held:
+            raise ValueError(f'holding({key}): already holding {self._held}, only one player lock at a time')
+
+        lock = Player_Locks.lock(key)
+        async with LockManager(lock):
+            self.stats.lock_wait_ms += lock.waited * 1000
+            self._held.add(key)
+            try:
+                yield
+            finally:
+                self._held.discard(key)
+
+    # One shard per script per request. Anything that wants to record changes to the shared script
+    # state during this request should use this one so they all get integrated together.
+    def shard(self, script) -> 'Shard':
+        if script.name not in self._shards:
+            self._shards[script.name] = script.state_manager.shard
+
+        return self._shards[script.name]
+
+    def __str__(self):
+        return f'ReqCtx[{self.request}]'
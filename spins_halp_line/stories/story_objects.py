@@ -1,26 +1,33 @@
-from typing import List, Optional, Dict, Union, Tuple, Callable, Any
-from dataclasses import dataclass, field, asdict
-import json
+from typing import List, Optional, Dict, Union, Tuple, Callable, Any, Awaitable
+from dataclasses import dataclass, field, fields, asdict
+from copy import copy, deepcopy
 import traceback
 
 from twilio.twiml.voice_response import VoiceResponse
 import trio
 
-from spins_halp_line.util import Logger, StateCopy, LockManager
+from spins_halp_line.util import Logger, UndoLog, LockManager, OrderedSet
 from spins_halp_line.resources.numbers import PhoneNumber
 from spins_halp_line.twil import TwilRequest
 from spins_halp_line.player import Player
-from spins_halp_line.tasks import Task, add_task
-from spins_halp_line.resources.redis import new_redis
+from spins_halp_line.tasks import Task, add_task, send_task
+from spins_halp_line.resources.redis import new_redis, RedisBatch, RedisScript
+from spins_halp_line.resources.journal import Journal
+from spins_halp_line.resources.locks import Lock, LocalLock, new_lock
+from spins_halp_line.resources.ring_buffer import RingBuffer
+from spins_halp_line.resources import codec
 from spins_halp_line.constants import (
     Script_Any_Number,
-    Script_Ignore_Change
+    Script_Ignore_Change,
+    Script_New_State,
+    Shared_Workers
 )
 from spins_halp_line.player import SceneInfo, ScriptInfo, RoomInfo
 from spins_halp_line.events import send_event
-from spins_halp_line.errors import StoryNavigationException
+from spins_halp_line.errors import StoryNavigationException, SaveConflict
 from spins_halp_line.actions.errors import error_sms
 from spins_halp_line.debug import Restoreable, Restoreer
+from spins_halp_line.stories.request_context import RequestContext
 
 
 @dataclass
@@ -38,8 +45,8 @@ class Change:
     # Key: str = None
     At_Front: bool = False
 
-    def _remove(self, field: Union[List, dict], val):
-        if isinstance(field, list):
+    def _remove(self, field: Union[List, OrderedSet, dict], val):
+        if isinstance(field, (list, OrderedSet)):
             for v in val:
                 field.remove(v)
         else:
@@ -65,11 +72,14 @@ class Change:
             frm = self._remove(frm, self.Value)
             setattr(target, self.From, frm)
 
-        if isinstance(to, list):
+        if isinstance(to, (list, OrderedSet)):
             # todo: figure out if we want this
             for v in self.Value:
                 if v not in to:
-                    to.append(v)
+                    if self.At_Front:
+                        to.insert(0, v)
+                    else:
+                        to.append(v)
         else:
             print(f'Target value is {type(to)}, only lists supported')
             return
@@ -78,6 +88,10 @@ class Change:
 
         setattr(target, self.To, to)
 
+    @classmethod
+    def from_dict(cls, d: dict) -> 'Change':
+        return cls(**d)
+
     def set_value(self, val):
         self.Value = []
         if isinstance(val, list):
@@ -165,6 +179,17 @@ class Shard:
             await self._parent.integrate(self._changes)
             self._changes = []
 
+    # Catches the script state up with changes other processes have made. Fields we've already read aren't
+    # updated, so do this first.
+    async def refresh(self):
+        if self._parent is not None:
+            await self._parent.refresh()
+
+    # hands our changes over to whoever is going to apply them
+    def take_changes(self) -> List['Change']:
+        changes, self._changes = self._changes, []
+        return changes
+
 #
 #  _____       _                        _             _
 # |  __ \     | |                      | |           | |
@@ -177,43 +202,81 @@ class Shard:
 
 
 class Snapshot(Logger):
+    # Snapshots used to be built in full for every request and then kept in a dict here forever. Now a request's
+    # snapshot just holds on to what it needs to build one, and only builds it (and stores it in redis, compressed,
+    # in a ring of the last `Keep`) if save() is called.
+    Key = 'snapshots'
+    Keep = 100
 
-    _index = {
+    @classmethod
+    def _saved(cls) -> RingBuffer:
+        return RingBuffer(cls.Key, cls.Keep)
 
-    }
-    _num = 0
+    @classmethod
+    async def get_snapshot(cls, index) -> Optional['Snapshot']:
+        data = await cls._saved().get(int(index))
+        if data is None:
+            return None
 
+        snap = Snapshot.from_json(data)
+        snap.index = str(index)
+        return snap
+
+    # What's in the ring, newest first, without the (big) states themselves
     @classmethod
-    def get_snapshot(cls, index) -> Optional['Snapshot']:
-        index = str(index)
-        return cls._index.get(index, None)
+    async def list_snapshots(cls) -> List[dict]:
+        return [
+            {'index': index, 'script': data['script'][0], 'players': list(data['players'].keys())}
+            for index, data in await cls._saved().entries()
+        ]
 
     def __init__(self, script: Optional[Restoreable], players: Optional[List[Restoreable]]):
         super(Snapshot, self).__init__()
         self.script_name: Optional[str] = None
         self.script_snap = None
         self.players: Dict[str, dict] = {}
-        self.index = str(Snapshot._num)
-        Snapshot._num += 1
+        # set once we're saved
+        self.index: Optional[str] = None
+        # things that build the states above, if we ever need them
+        self._later: Dict[Optional[str], Callable[[], dict]] = {}
 
         self._from_objects(script, players)
 
+    # Objects can hand us a snapshot_later() that captures what get_snapshot() would return right now without doing
+    # the work. Otherwise we ask for get_snapshot() when (if) we get saved.
+    @staticmethod
+    def _snapshot_later(obj: Restoreable) -> Callable[[], dict]:
+        later = getattr(obj, 'snapshot_later', None)
+        return later() if later else obj.get_snapshot
+
     def _from_objects(self, script: Optional[Restoreable], players: Optional[Union[List[Restoreable], Restoreable]]):
         if script:
             self.script_name = script.get_snapshot_name()
-            self.script_snap = script.get_snapshot()
+            self._later[None] = self._snapshot_later(script)
         if players:
             if not isinstance(players, list):
                 players = [players]
 
-            self.players = {
-                p.get_snapshot_name(): p.get_snapshot() for p in players
-            }
+            for p in players:
+                self._later[p.get_snapshot_name()] = self._snapshot_later(p)
+
+    def _capture(self):
+        for name, later in self._later.items():
+            if name is None:
+                self.script_snap = later()
+            else:
+                self.players[name] = later()
+        self._later = {}
 
-    def save(self):
+    async def save(self):
         # called when a snapshot is used
-        self._index[self.index] = self.json
-        self.e(f"Snapshot {self.index} saved!:\n{self.json}")
+        try:
+            self.index = str(await self._saved().push(self.data))
+        except Exception as e:
+            # we're usually here because something already went wrong, don't make it worse
+            self.e(f"Could not save snapshot: {e}")
+            return
+        self.e(f"Snapshot {self.index} saved! (GET /debug/snapshot/{self.index} to see it)")
 
     async def restore(self, script: Restoreer):
         await script.restore_states(
@@ -224,6 +287,7 @@ class Snapshot(Logger):
 
     @property
     def data(self):
+        self._capture()
         return {
             'script': [self.script_name, self.script_snap],
             'players': self.players
@@ -231,14 +295,14 @@ class Snapshot(Logger):
 
     @property
     def json(self):
-        return json.dumps(self.data)
+        return codec.to_json(self.data)
 
     @staticmethod
     def from_json(jsn: Union[str, dict]):
         ss = Snapshot(None, None)
 
         if isinstance(jsn, str):
-            jsn = json.loads(jsn)
+            jsn = codec.decode(jsn)
 
         ss.script_name = jsn['script'][0]
         ss.script_snap = jsn['script'][1]
@@ -254,7 +318,8 @@ class RoomContext(dict):
                  shard: Shard,
                  script_state: ScriptInfo,
                  scene_state: SceneInfo,
-                 room_state: Union[RoomInfo, dict]):
+                 room_state: Union[RoomInfo, dict],
+                 request_context: Optional[RequestContext] = None):
         # fill with our info
         self_data = {}
         if isinstance(room_state, RoomInfo):
@@ -266,6 +331,8 @@ class RoomContext(dict):
 
         self.player = player
         self.shard = shard
+        # use this to get any other players the room needs so they are only loaded once per request
+        self.request_context = request_context
         self.script = script_state.data
         self.scene = scene_state.data
         self.choices = room_state.choices
@@ -279,7 +346,8 @@ class RoomContext(dict):
             script_state: ScriptInfo,
             scene_state: SceneInfo,
             room_state: Union[RoomInfo, dict],
-            spoil_state: bool = True):
+            spoil_state: bool = True,
+            undo: Optional[UndoLog] = None):
         # In theory we should not need to pass the shard back here
         # because its structure prevents any objects being replaced
         # and so all of its references will be appropriate.
@@ -287,12 +355,15 @@ class RoomContext(dict):
         # context.script = {}
         # which would be a new dictionary; the old script_state.data would not be replaced
         # unless we did it here
+        # Everything goes through `undo` so the caller can take it back if something fails.
+        if undo is None:
+            undo = UndoLog()
 
-        script_state.data = self.script
-        scene_state.data = self.scene
+        undo.set(script_state, 'data', self.script)
+        undo.set(scene_state, 'data', self.scene)
 
         # record if this room ended the scene early
-        scene_state.ended_early = self._ended
+        undo.set(scene_state, 'ended_early', self._ended)
         # don't copy choices back
         # also don't copy state_is_new back
 
@@ -300,16 +371,16 @@ class RoomContext(dict):
         if spoil_state:
             if self._start_state == self.state:
                 # no state change
-                room_state.fresh_state = False
+                undo.set(room_state, 'fresh_state', False)
             else:
                 # state change!
-                room_state.state = self.state
-                room_state.fresh_state = True
+                undo.set(room_state, 'state', self.state)
+                undo.set(room_state, 'fresh_state', True)
 
         if isinstance(room_state, RoomInfo):
-            room_state.data.update(self)
+            undo.update(room_state.data, self)
         elif isinstance(room_state, dict):
-            room_state.update(self)
+            undo.update(room_state, self)
 
         return script_state, scene_state, room_state
 
@@ -357,7 +428,7 @@ class TextHandler(Logger):
     Name = "Base Text Handler"
 
     # Must add choice to room state outside of this
-    async def new_text(self, text_request: TwilRequest, shard: Shard, player: Player):
+    async def new_text(self, text_request: TwilRequest, shard: Shard, player: Player, ctx: RequestContext = None):
         return player
 
     # load any resources that we need
@@ -422,6 +493,116 @@ class Room(Logger):
         return str(self)
 
 
+# A room's choices for one path: {digit: queue of room names}, and the queue for any other digit (the '*' choice,
+# None if there isn't one)
+ChoiceTable = Tuple[Dict[str, List[str]], Optional[List[str]]]
+
+
+# A scene's Start and Choices compiled into tables indexed by room number (see Scene.compile), so routing a
+# request is a couple of list / dict lookups instead of walking Choices and turning rooms into names every time.
+# Rooms are equal by name, so a name is one room however many copies of it Choices has.
+class SceneGraph(Logger):
+    Any = '*'
+
+    def __init__(self, scene: 'Scene'):
+        super(SceneGraph, self).__init__()
+        self.scene_name = scene.Name
+        # room number -> room, and back by name
+        self.rooms: List[Room] = []
+        self.room_ids: Dict[str, int] = {}
+        self.start: List[str] = []
+        # room number -> {path -> ChoiceTable}, or None for rooms without choices. The scene is done after those.
+        self.choices: List[Optional[Dict[Optional[str], ChoiceTable]]] = []
+        # room number -> its '*' path, for rooms where that's the only one. Any path that isn't listed uses it.
+        self.any_path: List[Optional[ChoiceTable]] = []
+        # rooms with choices that nothing leads to
+        self.unreachable: List[str] = []
+
+        self._build(scene)
+        self._validate()
+
+    def _add(self, room) -> int:
+        if not isinstance(room, Room):
+            # only rooms we already have can be referred to by name
+            if room not in self.room_ids:
+                raise StoryNavigationException(f'{self.scene_name}: choice leads to {room!r}, which is not a room')
+            return self.room_ids[room]
+
+        room_id = self.room_ids.get(room.Name)
+        if room_id is None:
+            room_id = self.room_ids[room.Name] = len(self.rooms)
+            self.rooms.append(room)
+            self.choices.append(None)
+            self.any_path.append(None)
+        return room_id
+
+    def _queue(self, target) -> List[str]:
+        targets = target if isinstance(target, list) else [target]
+        return [self.rooms[self._add(room)].Name for room in targets]
+
+    def _build(self, scene: 'Scene'):
+        self.start = self._queue(scene.Start)
+
+        # every room first, so choices can name rooms that only show up as a key later on
+        for room in scene.Choices:
+            self._add(room)
+
+        for room, choices in scene.Choices.items():
+            room_id = self._add(room)
+            tables = {}
+            for path, room_choices in scene.paths_for(choices).items():
+                if not isinstance(room_choices, dict):
+                    raise StoryNavigationException(
+                        f'{self.scene_name}: choices for {room} (path {path}) should be a dict, got {room_choices!r}'
+                    )
+                digits = {digit: self._queue(target) for digit, target in room_choices.items() if digit != self.Any}
+                fallback = self._queue(room_choices[self.Any]) if self.Any in room_choices else None
+                tables[path] = (digits, fallback)
+
+            self.choices[room_id] = tables
+            if len(tables) == 1:
+                self.any_path[room_id] = tables.get(self.Any)
+
+    def _validate(self):
+        reachable = set(self.start)
+        frontier = list(self.start)
+        while frontier:
+            tables = self.choices[self.room_ids[frontier.pop()]]
+            for digits, fallback in (tables or {}).values():
+                for queue in [*digits.values(), fallback or []]:
+                    for name in queue:
+                        if name not in reachable:
+                            reachable.add(name)
+                            frontier.append(name)
+
+        self.unreachable = [room.Name for room in self.rooms if room.Name not in reachable]
+        if self.unreachable:
+            self.w(f'{self.scene_name}: nothing leads to {self.unreachable}')
+
+    def room(self, name: str) -> Room:
+        return self.rooms[self.room_ids[name]]
+
+    # if the scene is done once the player has been through this room
+    def is_terminal(self, name: str) -> bool:
+        return self.choices[self.room_ids[name]] is None
+
+    # The rooms to queue when the player presses `digits` in room `name`, on `path`.
+    # Raises KeyError if the room has choices, but none for the player's path.
+    def next_rooms(self, name: str, digits: str, path: Optional[str] = None) -> List[str]:
+        room_id = self.room_ids[name]
+        tables = self.choices[room_id]
+        if tables is None:
+            return []
+
+        table = tables.get(path, self.any_path[room_id])
+        if table is None:
+            raise KeyError(f'{self.scene_name}: {name} has no choices for path {path}')
+
+        room_choices, fallback = table
+        queue = room_choices.get(digits, fallback)
+        return list(queue) if queue is not None else []
+
+
 class Scene(Logger):
     Name = "Base scene"
     Start: List[Room] = []
@@ -434,34 +615,34 @@ class Scene(Logger):
 
     def __init__(self):
         super(Scene, self).__init__()
-        # because Name and Rooms are class variables this is basically static
-        # We use the room index so we can use room names as indexes that we save to redis
-        self._index_rooms()
+        # built by compile(), which Script.load_state calls. Scenes that are used before that compile themselves.
+        self._graph: Optional[SceneGraph] = None
 
-    def _index_rooms(self):
-        self._room_index: Dict[str, Room] = {}
-        for r in self.Start:
-            self._add_to_index(r)
-        for r, choice_info in self.Choices.items():
-            self._add_to_index(r)
+    # Turns Start and Choices into a SceneGraph, and checks them. Raises StoryNavigationException if a choice
+    # leads somewhere that isn't a room.
+    def compile(self) -> SceneGraph:
+        self._graph = SceneGraph(self)
+        return self._graph
 
-            for _, room_choice in choice_info.items():
-                self._add_to_index(room_choice)
+    @property
+    def graph(self) -> SceneGraph:
+        if self._graph is None:
+            self.compile()
+        return self._graph
+
+    # {path: {digit: room(s)}} for one room's entry in Choices. Plain scenes don't have paths.
+    def paths_for(self, room_choices: dict) -> Dict[Optional[str], dict]:
+        return {None: room_choices}
+
+    # the path to route this player by, see PathScene
+    def _path(self, script_state: ScriptInfo) -> Optional[str]:
+        return None
 
     async def load(self):
-        for room in self._room_index.values():
+        for room in self.graph.rooms:
             print(f'loading {room}')
             await room.load()
 
-    def _add_to_index(self, room_list: Union[Room, List[Room]]):
-        if not isinstance(room_list, list):
-            room_list = [room_list]
-
-        for room in room_list:
-            if room.Name not in self._room_index:
-                print(f"Adding room to index: {room}")
-                self._room_index[room.Name] = room
-
     def done(self, info: ScriptInfo) -> bool:
         done = False
         self.d(f"done?")
@@ -476,15 +657,14 @@ class Scene(Logger):
             # if the room_queue has rooms we are not done and can return
             elif not our_info.room_queue:
                 # since we have no rooms in queue we continue...
-                prev_room = self._name_to_room(our_info.prev_room)
-                if not prev_room:
+                if not our_info.prev_room:
                     # no queue and no previous room
                     # this should be impossible, but we'd be in an end state anyway
                     done = True
                     self.d(f"done! - no previous room {done}")
                 else:
                     # we are done if there are no choices associated with this
-                    done = self.choices_for_room(prev_room) is None
+                    done = self.graph.is_terminal(our_info.prev_room)
                     self.d(f"done? {done}")
             else:
                 self.d(f"not done - have rooms in queue {done}")
@@ -493,12 +673,13 @@ class Scene(Logger):
 
         return done
 
-    def choices_for_room(self, room):
-        choices = self.Choices.get(room, None)
-        self.d(f"Choices_for_room({room}) -> {choices}")
-        return choices
-
-    async def play(self, request: TwilRequest, player: Player, shard: Shard, script_state: ScriptInfo):
+    async def play(
+            self,
+            request: TwilRequest,
+            player: Player,
+            shard: Shard,
+            script_state: ScriptInfo,
+            ctx: RequestContext = None):
         self.d(f'play({request}, {script_state})')
         scene_state = self._get_state(script_state)
         self.d(f'play({request}, {script_state}): {scene_state}')
@@ -510,7 +691,8 @@ class Scene(Logger):
             player,
             shard,
             script_state,
-            scene_state
+            scene_state,
+            ctx
         )
 
         # handles either finishing the tunnel we are in or
@@ -536,7 +718,7 @@ class Scene(Logger):
         room_state = scene_state.room_state(room.Name)
         self.d(f"room state: {room_state}")
         # make whole context object
-        context = RoomContext(player, shard, script_state, scene_state, room_state)
+        context = RoomContext(player, shard, script_state, scene_state, room_state, ctx)
 
         await send_event(f"{player} entering {room}!")
         try:
@@ -544,8 +726,8 @@ class Scene(Logger):
         except Exception as e:
             raise StoryNavigationException("Failed while trying to take room action", e)
 
-        # backup
-        script_state_snap = StateCopy(script_state)
+        # backup - only what we change below is recorded, a big history costs nothing
+        undo = UndoLog()
         try:
             # post room updates
             # I am now paranoid about state not getting written and am done fucking around
@@ -553,19 +735,20 @@ class Scene(Logger):
                 script_state,
                 scene_state,
                 room_state,
-                spoil_state=True  # the room state stops being fresh now
+                spoil_state=True,  # the room state stops being fresh now
+                undo=undo
             )
 
-            scene_state.rooms_visited.append(room.Name)
+            undo.append(scene_state.rooms_visited, room.Name)
             self.d(f"play({request}): state.rooms_visited: {scene_state.rooms_visited}")
             # update room queue
-            scene_state.room_queue = room_queue
+            undo.set(scene_state, 'room_queue', room_queue)
 
             # more paranoia about failures to write
-            scene_state.room_states[room.Name] = room_state
-            script_state.scene_states[self.Name] = scene_state
+            undo.set_item(scene_state.room_states, room.Name, room_state)
+            undo.set_item(script_state.scene_states, self.Name, scene_state)
         except Exception as e:
-            script_state_snap.restore()  # undo any changes, though we generally won't save anything
+            undo.rollback()  # undo any changes, though we generally won't save anything
             raise StoryNavigationException("Failed while trying to save state", e)
 
         return twilio_action
@@ -576,12 +759,12 @@ class Scene(Logger):
             self.d(f"Creating new state")
             # init state
             scene_state = info.add_scene(self.Name)
-            scene_state.room_queue = self._item_to_room_name_list(self.Start)
+            scene_state.room_queue = list(self.graph.start)
 
         return scene_state
 
     def _name_to_room(self, room_name: str) -> Optional[Room]:
-        return self._room_index[room_name]
+        return self.graph.room(room_name)
 
     async def _notify_last_room_of_choice(
             self,
@@ -589,7 +772,8 @@ class Scene(Logger):
             player: Player,
             shard: Shard,
             script_state: ScriptInfo,
-            our_info: SceneInfo) -> Tuple[ScriptInfo, SceneInfo]:
+            our_info: SceneInfo,
+            ctx: RequestContext = None) -> Tuple[ScriptInfo, SceneInfo]:
         # check that there's a previous room
         if our_info.prev_room and request.digits:
             player_choice = str(request.digits)
@@ -597,7 +781,7 @@ class Scene(Logger):
             room_state = our_info.room_state(prev_room.Name)
 
             # room)state.choice will NOT have the new choice in it
-            context = RoomContext(player, shard, script_state, our_info, room_state)
+            context = RoomContext(player, shard, script_state, our_info, room_state, ctx)
             await prev_room.new_player_choice(player_choice, context)
 
             script_state, our_info, room_state = context._pass_back_changes(script_state, our_info, room_state)
@@ -614,56 +798,14 @@ class Scene(Logger):
             # already strings, from a previous call
             return our_info.room_queue
 
-        # no existing queue
-        queue = []
-        # need to turn the previous room into a room object:
-        prev_room = self._name_to_room(our_info.prev_room)
+        # no existing queue, so it's whatever the previous room's choices say
         number = str(request.digits)
-        self.d(f"_get_queue() {number=} previous room: {prev_room}")
-        if self.choices_for_room(prev_room) is not None:
-            queue = self._get_choice_for_request(number, prev_room, script_state)
-
         # todo: add a default option that tells the user we didn't understand their choice and
         # todo: replays the previous room
-        return self._item_to_room_name_list(queue)
-
-    def _get_choice_for_request(self, number: str, room: Room, script_state: ScriptInfo) -> List[Optional[Room]]:
-        room_choices = self.Choices.get(room)  # dictionary of choice to room
-        self.d(f"_get_choice_for_request({number}) choices: {room_choices}")
-        # todo: standardize digits as a string?
-        queue = []
-        if number in room_choices:
-            queue = room_choices[number]
-            self.d(f"Choice #{number}: {queue}")
-        elif '*' in room_choices:  # default
-            queue = room_choices['*']
-            self.d(f"Choice *: {queue}")
-
-        if not isinstance(queue, list):
-            queue = [queue]
-
+        queue = self.graph.next_rooms(our_info.prev_room, number, self._path(script_state))
+        self.d(f"_get_queue() {number=} previous room: {our_info.prev_room} -> {queue}")
         return queue
 
-    @staticmethod
-    def _item_to_room_name_list(obj) -> List[str]:
-        # make into one item list if not a list
-        if not isinstance(obj, list):
-            obj = [obj]
-
-        result = []
-        warn = False
-        for item in obj:
-            if isinstance(item, Room):
-                result.append(item.Name)
-            else:
-                warn = True
-                result.append(item)
-
-        if warn:
-            print(f'Warning Flag: _item_to_room_name_list({obj})')
-        # transform to strings for serializing
-        return result
-
     def __str__(self):
         return f'Scene[{self.Name}]'
 
@@ -712,7 +854,99 @@ class StateShard(ScriptState, Shard):
         ScriptState.__init__(self, *args, **kwargs)
 
 
+# The shard managers hand out by default. Instead of copying the whole state when it's made, each field is
+# copied from the manager's current state the first time it's read, so a request that only checks a list or
+# two doesn't pay for copying everything. Changes are recorded the same as any other shard.
+class StateView(Shard):
+    def __init__(self, manager: 'ScriptStateManager'):
+        super(StateView, self).__init__()
+        object.__setattr__(self, '_manager', manager)
+        object.__setattr__(self, '_field_names', {f.name for f in fields(manager._state)})
+
+    # only called for things we don't have yet
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._field_names:
+            raise AttributeError(f'{self.__class__.__name__} has no attribute {name}')
+
+        value = getattr(self._manager._state, name)
+        # our copy of an OrderedSet doesn't share the state's membership index
+        value = copy(value) if isinstance(value, (list, OrderedSet)) else deepcopy(value)
+        object.__setattr__(self, name, value)
+        return value
+
+    def _check_to(self, to):
+        # no need to copy the field to see if it's there
+        if to not in self._field_names:
+            raise ValueError(f"It seems like {self} does not contain {to}")
+
+    def __str__(self):
+        return f'StateView[{self._manager}]'
+
+
+# Check-and-set for script state saves, so a save is one round trip and can't silently overwrite a newer
+# copy. Versions live in a small hash next to the state so we never have to decode the state to check them.
+# KEYS[1]: state key, KEYS[2]: version hash
+# ARGV: our generation, the version we have, the encoded state (already holding version + 1)
+# returns: {saved (1/0), reason, db generation, db version, <the state in redis, if we didn't save>}
+def _save_state(call, keys, args):
+    generation, version = int(args[0]), int(args[1])
+    meta = call('HMGET', keys[1], 'generation', 'version')
+    # state saved before the version hash existed doesn't get checked
+    if meta[1] is not None:
+        db_generation, db_version = int(meta[0] or 0), int(meta[1])
+        if db_generation > generation:
+            return [0, 'generation', db_generation, db_version, call('GET', keys[0])]
+        if db_generation == generation and db_version > version:
+            return [0, 'version', db_generation, db_version, call('GET', keys[0])]
+
+    call('SET', keys[0], args[2])
+    call('HSET', keys[1], 'generation', generation, 'version', version + 1)
+    return [1, 'saved', generation, version + 1]
+
+
+_save_state_script = RedisScript("""
+local generation = tonumber(ARGV[1])
+local version = tonumber(ARGV[2])
+local meta = redis.call('HMGET', KEYS[2], 'generation', 'version')
+if meta[2] then
+    local db_generation = tonumber(meta[1]) or 0
+    local db_version = tonumber(meta[2])
+    if db_generation > generation then
+        return {0, 'generation', db_generation, db_version, redis.call('GET', KEYS[1])}
+    end
+    if db_generation == generation and db_version > version then
+        return {0, 'version', db_generation, db_version, redis.call('GET', KEYS[1])}
+    end
+end
+redis.call('SET', KEYS[1], ARGV[3])
+redis.call('HSET', KEYS[2], 'generation', generation, 'version', version + 1)
+return {1, 'saved', generation, version + 1}
+""", emulate=_save_state)
+
+
+# for asdict(), so state dicts only have plain lists in them and anything can serialize them
+def _plain_dict(items: List[Tuple[str, Any]]) -> dict:
+    return {key: value.to_list() if isinstance(value, OrderedSet) else value for key, value in items}
+
+
 class ScriptStateManager(Logger):
+    # Shard changes from requests go into a journal (a redis stream, see resources/journal.py) as soon as the
+    # request is done, and the reducer applies them from there. So a crash between a request and its reduce
+    # doesn't lose anything, and a manager that's behind only replays the entries it hasn't seen.
+    # Every state we save is a checkpoint: it records the last journal entry it includes. Entries more than
+    # Journal_Keep behind the checkpoint get trimmed.
+    Journal_Changes = True
+    Journal_Keep = 1000
+    # Requests hand their shards to a single reducer (see StateReducer), which waits up to Reduce_Delay seconds
+    # for more to show up and reduces them all at once, or stops waiting at Reduce_Batch_Max shards.
+    Reduce_Delay = 0.05
+    Reduce_Batch_Max = 500
+    # If set, the reducer also reduces after this many seconds without any shards, so do_reduce gets to run while
+    # nobody is making requests. The reducer is started at load_state() instead of with the first shard.
+    Reduce_Every: Optional[float] = None
+    # With shared workers, other processes change the state too. Requests and tasks reload it from redis before
+    # reading it (see refresh), at most every Sync_Every seconds.
+    Sync_Every = 1
 
     def __init__(self):
         super(ScriptStateManager, self).__init__()
@@ -720,24 +954,48 @@ class ScriptStateManager(Logger):
         self._state = self._make_new_state()
         self._version = 0
         self._generation = 0
+        # set when _state has changes redis doesn't have yet
+        self._dirty = False
+        # last journal entry applied to _state, and the last one in the checkpoint in redis
+        self._journal_seq = 0
+        self._saved_seq = 0
+        self._reducer: Optional[StateReducer] = None
         # self._state.update(initial_state)
-        self._lock = trio.Lock()
+        # replaced with one named after our key (and shared with other processes if locks are) in set_key
+        self._lock: Lock = LocalLock('script_state')
+        # trio time of our last refresh from redis
+        self._synced_at: Optional[float] = None
+        # tasks the do_reduce that's running wants sent once its changes are saved, see after_save
+        self._after_save: List[Task] = []
 
     def _make_new_state(self, base: dict = None) -> ScriptState:
         if base is None:
             base = {}
         return ScriptState()
 
-    def _make_shard(self) -> StateShard:
-        d = self._state_dict
-        d.pop('version', None)  # remove version
-        d.pop('generation', None)  # remove version
-        ss = StateShard(**d)
-        ss.set_parent(self)
-        return ss
+    # Override to hand out copies of the whole state instead (e.g. a StateShard subclass) if you need them
+    def _make_shard(self) -> Shard:
+        view = StateView(self)
+        view.set_parent(self)
+        return view
 
     def set_key(self, key):
         self._key = key
+        self._lock = new_lock(key)
+
+    @property
+    def _version_key(self):
+        return f'{self._key}:version'
+
+    @property
+    def journal(self) -> Journal:
+        # the counter lives in the version hash so it goes away with everything else
+        return Journal(f'{self._key}:journal', self._version_key)
+
+    # Anything that changes _state outside of the change / reduce helpers below needs to call this, or the change
+    # won't be saved
+    def mark_dirty(self):
+        self._dirty = True
 
     # This is a callback used by shards to 'ship' their changes back to the script state
     async def integrate(self, changes: List[Change]):
@@ -745,15 +1003,98 @@ class ScriptStateManager(Logger):
         if changes == []:
             return
 
+        async def apply_changes(state):
+            self._apply(changes)
+
         async with LockManager(self._lock):
-            await self.sync_redis(True)
-            for change in changes:
-                change.apply(self._state)
+            await self.update(apply_changes, locked=True)
 
-            await self.save_to_redis(True)
+    def _apply(self, changes: List[Change]):
+        for change in changes:
+            change.apply(self._state)
+        if changes:
+            self._dirty = True
 
     async def integrate_shard(self, shard: Shard):
-        await add_task.send(AfterRequestActions(shard, self))
+        if self.Journal_Changes:
+            changes = shard.take_changes()
+            if changes:
+                seq = await self.journal.append(changes)
+                self.d(f'Journaled {changes} as entry {seq}')
+
+        reducer = await self.start_reducer()
+        reducer.submit(shard)
+
+    async def start_reducer(self) -> 'StateReducer':
+        if self._reducer is None:
+            self._reducer = StateReducer(self)
+            await add_task.send(self._reducer)
+        return self._reducer
+
+    @property
+    def reducer_stats(self) -> dict:
+        return self._reducer.stats if self._reducer is not None else {}
+
+    # Applies the journal entries _state doesn't have yet. `entries` is a journal.read_after() that was already
+    # sent, if there is one.
+    async def _catch_up(self, entries: Optional[List[Tuple[int, list]]] = None):
+        if not self.Journal_Changes:
+            return
+
+        if entries is None:
+            entries = await self.journal.read_after(self._journal_seq)
+        entries = [(seq, changes) for seq, changes in entries if seq > self._journal_seq]
+        if entries and entries[0][0] != self._journal_seq + 1:
+            # the entries we need were trimmed, which means a checkpoint has them
+            self.w(f'_catch_up: journal entries {self._journal_seq + 1}-{entries[0][0] - 1} are gone, reloading')
+            await self._load_checkpoint()
+            entries = [(seq, changes) for seq, changes in entries if seq > self._journal_seq]
+            if entries and entries[0][0] != self._journal_seq + 1:
+                self.e(f'_catch_up: checkpoint is at {self._journal_seq}, journal starts at {entries[0][0]}')
+
+        for seq, changes in entries:
+            changes = [Change.from_dict(change) for change in changes]
+            self.d(f'_catch_up: replaying {seq}: {changes}')
+            for change in changes:
+                try:
+                    change.apply(self._state)
+                except ValueError as e:
+                    # e.g. moving a player someone else already moved. Skip it rather than getting stuck on it.
+                    self.w(f'_catch_up: skipping {change} from entry {seq}: {e}')
+            self._journal_seq = seq
+            self._dirty = True
+
+    async def _replay(self, state):
+        await self._catch_up()
+
+    # trims the journal each time the checkpoint passes another Journal_Keep entries
+    async def _checkpointed(self, previous_seq: int):
+        self._saved_seq = self._journal_seq
+        if self._journal_seq // self.Journal_Keep > previous_seq // self.Journal_Keep:
+            await self.journal.trim(self._journal_seq - self.Journal_Keep)
+
+    # Runs `mutate` on our state and saves it, in one round trip. If someone else saved first, redis hands us
+    # their copy, and we run `mutate` again on top of it.
+    # `mutate` is an async function that takes the state. It has to call mark_dirty() if it changes anything
+    # (it's already set if it uses _apply), and may be run more than once.
+    async def update(self, mutate: Callable[[ScriptState], Awaitable], attempts: int = 3, locked=False):
+        if attempts < 1:
+            raise ValueError(f"update() needs at least one attempt, got {attempts}")
+
+        async with LockManager(self._lock, already_locked=locked):
+            conflict = None
+            for _ in range(attempts):
+                await mutate(self._state)
+                if not self._dirty:
+                    return
+
+                conflict = await self._write()
+                if conflict is None:
+                    return
+                if not conflict.retryable:
+                    break
+
+            raise conflict
 
     # primaraly used for debugging to overwrite old versions
     async def set_new_generation(self):
@@ -764,6 +1105,8 @@ class ScriptStateManager(Logger):
             await self.sync_redis(True)
             # make sure we will, at worst, collide with another parallel process
             latest_generation = self._generation
+            our_state.pop('version', None)
+            our_state.pop('generation', None)
             self._state = self._make_new_state(our_state)
             # this version will override any other
             self._generation = latest_generation + 1
@@ -786,17 +1129,30 @@ class ScriptStateManager(Logger):
 
     @property
     def dict(self):
-        return asdict(self._state)
+        return asdict(self._state, dict_factory=_plain_dict)
 
     @property
     def _state_dict(self) -> dict:
-        d = asdict(self._state)
+        d = asdict(self._state, dict_factory=_plain_dict)
         d['version'] = self._version
         d['generation'] = self._generation
         return d
 
+    # Replaces our state with one from redis
+    def _adopt(self, state_data: dict, generation: int = None, version: int = None):
+        state_data = dict(state_data)
+        db_version = state_data.pop('version', 0)
+        db_generation = state_data.pop('generation', 0)
+        self._journal_seq = self._saved_seq = state_data.pop('journal_seq', 0)
+        self._state = self._make_new_state(state_data)
+        self._version = db_version if version is None else version
+        self._generation = db_generation if generation is None else generation
+        self._dirty = False
+
     # This function is what should be overridden in child classes.
     # Then the child class should be passed into the script when you construct it.
+    # Call self.mark_dirty() if you change the state. This can be called again with a fresher state if someone
+    # else saved while we were reducing, so start things with after_save() rather than directly.
     async def do_reduce(self, state: ScriptState, shard: StateShard):
         return state
 
@@ -810,95 +1166,522 @@ class ScriptStateManager(Logger):
         return Player(number)
 
     # This is used to check if our version is out of date
-    async def sync_redis(self, locked=False):
-        db = new_redis()
+    # Pass a batch to send the read along with other commands
+    async def sync_redis(self, locked=False, batch: Optional[RedisBatch] = None):
+        db = batch if batch is not None else new_redis()
         async with LockManager(self._lock, already_locked=locked):
-            db_version = await db.get(self._key).autodecode
+            db_version = codec.decode(await db.get(self._key))
             if db_version:
                 # check if either version or generation are newer
                 if db_version['version'] > self.version or db_version['generation'] > self._generation:
-                    self._state = self._make_new_state(db_version)
+                    self._adopt(db_version)
+
+    # Picks up state saved by other processes, if there are any
+    async def refresh(self):
+        if not Shared_Workers:
+            return
+
+        now = trio.current_time()
+        if self._synced_at is not None and now - self._synced_at < self.Sync_Every:
+            return
+        self._synced_at = now
+        await self.sync_redis()
+
+    # For do_reduce: sends `task` once the changes do_reduce made are saved. do_reduce can run more than once in
+    # a reduce (see update), so it mustn't start anything itself: only the tasks from the run that got saved are
+    # sent, and none if the save fails.
+    def after_save(self, task: Task):
+        self._after_save.append(task)
+
+    # Runs the reduce in `reduce_cycle` through update(), and returns the tasks it asked for with after_save
+    async def _run_reduce(self, reduce_cycle: Callable[[ScriptState], Awaitable], locked=False) -> List[Task]:
+        async def cycle(state):
+            # anything from a run that didn't get saved is forgotten
+            self._after_save = []
+            await reduce_cycle(state)
+
+        try:
+            await self.update(cycle, locked=locked)
+        finally:
+            tasks, self._after_save = self._after_save, []
+        return tasks
+
+    @staticmethod
+    async def _send_tasks(tasks: List[Task]):
+        for task in tasks:
+            await send_task(task)
 
     # This calls the static do_reduce that will make any changes to the state in a
     # way that's safe and save the results into redis.
-    async def reduce(self):
-        # sync with DB
-        async with LockManager(self._lock):
-            await self.sync_redis(True)
+    # Any changes passed in (from a shard) are applied first, so that a request's changes and the reduce that
+    # follows them are saved together.
+    async def reduce(self, changes: Optional[List[Change]] = None):
+        async def reduce_cycle(state):
+            await self._catch_up()
+            if changes:
+                self.d(f'Integrating: {changes}')
+                self._apply(changes)
             self.d('Starting do_reduce_cycle')
             self._state = await self.do_reduce(self._state, self.shard)
 
-            await self.save_to_redis(True)
-
-    # save the state to redis, called frequently
-    async def save_to_redis(self, locked=False):
-        db = new_redis()
+        await self._send_tasks(await self._run_reduce(reduce_cycle))
+
+    # Writes our state to redis. Returns None if it saved, or the conflict if redis had a newer copy, in which case
+    # we've swapped to that copy.
+    async def _write(self, batch: Optional[RedisBatch] = None) -> Optional[SaveConflict]:
+        state_dict = self._state_dict
+        state_dict['version'] = self._version + 1
+        state_dict['journal_seq'] = self._journal_seq
+        keys = [self._key, self._version_key]
+        args = [self._generation, self._version, codec.encode(state_dict)]
+        if batch is None:
+            result = await _save_state_script.run(keys, args)
+        else:
+            result = await _save_state_script.queue(batch, keys, args)
+
+        saved, reason, db_generation, db_version, *current = result
+        if saved:
+            self.d(f'save_to_redis: saved version {db_version}')
+            self._version = db_version
+            self._dirty = False
+            await self._checkpointed(self._saved_seq)
+            return None
+
+        conflict = SaveConflict(self._key, reason.decode(), db_generation, db_version, self._generation, self._version)
+        self.w(f'save_to_redis: {conflict}, using the copy in redis')
+        if current:
+            self._adopt(codec.decode(current[0]), db_generation, db_version)
+        return conflict
+
+    # save the state to redis. If redis has a newer copy, we switch to it and our changes are dropped.
+    # Pass a batch to send the write along with other commands.
+    async def save_to_redis(self, locked=False, batch: Optional[RedisBatch] = None):
         async with LockManager(self._lock, already_locked=locked):
-            db_data = await db.get(self._key).autodecode
-            if isinstance(db_data, dict):
-                self.d(f'Save_to_redis: state_dict: {self._state_dict}')
-                self.d(f'Save_to_redis:    db_dict: {db_data}')
-                self.d(f'Save_to_redis: state_dict == db_data ? {self._state_dict == db_data}')
-                if self._state_dict == db_data:
-                    self.d(f'save_to_redis: no changes from version in database')
-                    # there are no changes to save, no need to increase the verson
-                    return
-            self._version += 1
-            payload = json.dumps(self._state_dict)
-            self.d(f'save_to_redis: saving new version to redis: {payload}')
-            await db.set(self._key, payload)
+            await self._write(batch)
 
     # load from redis - called once
     async def load_from_redis(self):
-        db = new_redis()
         async with LockManager(self._lock):
-            db_data = await db.get(self._key)
-            if db_data:
-                version = -1
-                generation = -1
-                try:
-                    state_data = json.loads(db_data)
-                    # definately throw an exception here if these keys don't exist
-                    version = state_data['version']
-                    generation = state_data['generation']
-                    del state_data['version']
-                    del state_data['generation']
-
-                    self._state = self._make_new_state(state_data)
-                except Exception as e:
-                    self.e(f'Encountered exception {e} while trying to load state')
-                    version = self._version
-                    generation = self._generation
-
-                self._version = version
-                self._generation = generation
+            await self._load_checkpoint()
+            self.d(f'load_from_redis: loaded state dict {self._state}')
+            await self.update(self._replay, locked=True)
+
+    # Goes back to the copy in redis, throwing away anything a failed reduce left half applied to our state.
+    async def reload(self):
+        async with LockManager(self._lock):
+            await self._load_checkpoint()
+            self._dirty = False
+
+    async def _load_checkpoint(self):
+        db_data = await new_redis().get(self._key)
+        if db_data:
+            try:
+                # definately throw an exception here if these keys don't exist
+                state_data = codec.decode(db_data)
+                version = state_data['version']
+                generation = state_data['generation']
+                self._adopt(state_data, generation, version)
+            except Exception as e:
+                self.e(f'Encountered exception {e} while trying to load state')
+
+
+# Applies shard changes to state lists stored as sorted sets (see FieldStateManager) and bumps their versions.
+# Adding a member that's already there does nothing, like Change.apply. Members added to the back get increasing
+# scores, members added to the front get decreasing ones, so a sorted set reads back in list order.
+# KEYS[1]: version hash, KEYS[2...]: one sorted set per state list
+# ARGV: the journal entry the lists have to be at ('' to not check), the journal entry they'll be at after this
+#       ('' to leave it), # of checks, <key #, version the list has to be at>...,
+#       then <op ('add' / 'front' / 'rem'), key #, member>...
+#       key # is an index into KEYS
+# returns: {saved (1/0), state version, <version of each list in KEYS[2...]>...}
+def _state_ops(call, keys, args):
+    if args[0] != b'' and int(call('HGET', keys[0], 'applied') or 0) != int(args[0]):
+        return [0, int(call('HGET', keys[0], 'version') or 0)] + _list_versions(call, keys)
+    checks = int(args[2])
+    for n in range(checks):
+        key, expected = keys[int(args[3 + n * 2]) - 1], int(args[4 + n * 2])
+        if int(call('HGET', keys[0], key) or 0) != expected:
+            return [0, int(call('HGET', keys[0], 'version') or 0)] + _list_versions(call, keys)
+
+    ops = args[3 + checks * 2:]
+    for op, index, member in zip(ops[::3], ops[1::3], ops[2::3]):
+        key = keys[int(index) - 1]
+        if op == b'rem':
+            if call('ZREM', key, member) == 1:
+                call('HINCRBY', keys[0], key, 1)
+        elif call('ZSCORE', key, member) is None:
+            seq = call('HINCRBY', keys[0], 'seq', 1)
+            call('ZADD', key, -seq if op == b'front' else seq, member)
+            call('HINCRBY', keys[0], key, 1)
+
+    if args[1] != b'':
+        call('HSET', keys[0], 'applied', args[1])
+    return [1, call('HINCRBY', keys[0], 'version', 1)] + _list_versions(call, keys)
+
+
+def _list_versions(call, keys):
+    return [int(call('HGET', keys[0], key) or 0) for key in keys[1:]]
+
+
+_state_ops_script = RedisScript("""
+local function list_versions(result)
+    for k = 2, #KEYS do
+        table.insert(result, tonumber(redis.call('HGET', KEYS[1], KEYS[k])) or 0)
+    end
+    return result
+end
+
+local function conflict()
+    return list_versions({0, tonumber(redis.call('HGET', KEYS[1], 'version')) or 0})
+end
+
+if ARGV[1] ~= '' and (tonumber(redis.call('HGET', KEYS[1], 'applied')) or 0) ~= tonumber(ARGV[1]) then
+    return conflict()
+end
+local checks = tonumber(ARGV[3])
+for n = 0, checks - 1 do
+    local key = KEYS[tonumber(ARGV[4 + n * 2])]
+    if (tonumber(redis.call('HGET', KEYS[1], key)) or 0) ~= tonumber(ARGV[5 + n * 2]) then
+        return conflict()
+    end
+end
+
+for i = 4 + checks * 2, #ARGV, 3 do
+    local op, key, member = ARGV[i], KEYS[tonumber(ARGV[i + 1])], ARGV[i + 2]
+    if op == 'rem' then
+        if redis.call('ZREM', key, member) == 1 then
+            redis.call('HINCRBY', KEYS[1], key, 1)
+        end
+    elseif not redis.call('ZSCORE', key, member) then
+        local seq = redis.call('HINCRBY', KEYS[1], 'seq', 1)
+        if op == 'front' then
+            seq = -seq
+        end
+        redis.call('ZADD', key, seq, member)
+        redis.call('HINCRBY', KEYS[1], key, 1)
+    end
+end
+
+if ARGV[2] ~= '' then
+    redis.call('HSET', KEYS[1], 'applied', ARGV[2])
+end
+return list_versions({1, redis.call('HINCRBY', KEYS[1], 'version', 1)})
+""", emulate=_state_ops)
+
+
+# A ScriptStateManager that keeps every list in its state in its own sorted set (`<key>:<list name>`) instead
+# of one blob, so a shard change is a few ZADD / ZREMs no matter how many players there are.
+#
+# - integrate() sends changes straight to redis without checking anything, adding and removing are safe to do
+#   on top of whatever is there
+# - reduce() re-reads the lists in Reduce_Fields before running do_reduce, and its writes only go through if
+#   those lists haven't changed since
+# - anything else that changes the state (update(), save_to_redis()) is diffed against what we last saw in redis
+# - replayed journal entries are saved the same way, along with the last entry applied ('applied' in the version
+#   hash), and only if nobody else has saved them first
+#
+# List members have to be strings (they're phone numbers). do_reduce can add and remove members, but moving
+# a member inside a list it already was in isn't saved.
+class FieldStateManager(ScriptStateManager):
+    # the lists do_reduce looks at, re-read before every reduce
+    Reduce_Fields: List[str] = []
+
+    def __init__(self):
+        super(FieldStateManager, self).__init__()
+        # the lists as redis had them the last time we talked to it, and each list's version at that point
+        self._known = self._make_new_state()
+        self._list_versions: Dict[str, int] = {}
+
+    @property
+    def _lists(self) -> List[str]:
+        return [f.name for f in fields(self._state) if isinstance(getattr(self._state, f.name), (list, OrderedSet))]
+
+    def _list_key(self, name: str) -> str:
+        return f'{self._key}:{name}'
+
+    # `journal` is (entry redis has to be at, entry it'll be at), or None to leave the journal out of it
+    def _script_args(
+            self,
+            ops: List[Tuple[str, str, str]],
+            checks: List[str],
+            journal: Optional[Tuple[int, int]] = None) -> Tuple[List[str], list, List[str]]:
+        names = sorted({name for _, name, _ in ops} | set(checks))
+        # lua is 1 indexed and KEYS[1] is the version hash
+        index = {name: n + 2 for n, name in enumerate(names)}
+        args = list(journal or ('', '')) + [len(checks)]
+        for name in checks:
+            args.extend([index[name], self._list_versions.get(name, 0)])
+        for op, name, member in ops:
+            args.extend([op, index[name], member])
+
+        return [self._version_key] + [self._list_key(name) for name in names], args, names
+
+    @staticmethod
+    def _change_ops(changes: List[Change]) -> List[Tuple[str, str, str]]:
+        ops = []
+        for change in changes:
+            if change.From:
+                ops.extend(('rem', change.From, value) for value in change.Value)
+            ops.extend(('front' if change.At_Front else 'add', change.To, value) for value in change.Value)
+        return ops
+
+    # what has to be sent to get redis from _known to _state
+    def _diff_ops(self) -> List[Tuple[str, str, str]]:
+        ops = []
+        for name in self._lists:
+            known, now = getattr(self._known, name), getattr(self._state, name)
+            if known == now:
+                continue
+            known_set, now_set = set(known), set(now)
+            ops.extend(('rem', name, member) for member in known if member not in now_set)
+            ops.extend(('add', name, member) for member in now if member not in known_set)
+        return ops
+
+    def _record_versions(self, names: List[str], reply: list):
+        self._version = reply[1]
+        self._list_versions.update(zip(names, reply[2:]))
+
+    # Sends `changes` to redis and reads back the lists in `names`, in one round trip.
+    # With `journal`, the journal entries after ours are read too and returned.
+    async def _sync_lists(self, names: List[str], changes: Optional[List[Change]] = None, journal=False):
+        batch = RedisBatch()
+        pushed = None
+        if changes:
+            keys, args, pushed_names = self._script_args(self._change_ops(changes), [])
+            pushed = _state_ops_script.queue(batch, keys, args)
+        if names:
+            versions = batch.command('HMGET', self._version_key, 'version', 'applied',
+                                     *[self._list_key(name) for name in names])
+            members = [batch.zrange(self._list_key(name), 0, -1) for name in names]
+        entries = self.journal.read_after(self._journal_seq, batch) if journal else None
+        await batch.flush()
+
+        if pushed is not None:
+            self.d(f'Integrated: {changes}')
+            self._record_versions(pushed_names, pushed.value)
+            for change in changes:
+                change.apply(self._state)
+                change.apply(self._known)
+
+        if names:
+            version, applied, *list_versions = versions.value
+            self._version = int(version or 0)
+            self._journal_seq = self._saved_seq = int(applied or 0)
+            for name, list_version, listed in zip(names, list_versions, members):
+                values = [member.decode() for member in listed.value]
+                setattr(self._state, name, values)
+                setattr(self._known, name, list(values))
+                self._list_versions[name] = int(list_version or 0)
+
+        return entries.value if entries is not None else None
+
+    async def integrate(self, changes: List[Change]):
+        self.d(f'Integrating: {changes}')
+        if changes == []:
+            return
+
+        async with LockManager(self._lock):
+            await self._sync_lists([], changes)
+
+    async def reduce(self, changes: Optional[List[Change]] = None):
+        entries = None
+
+        async def reduce_cycle(state):
+            nonlocal entries
+            # the first time through we already have the journal, after a conflict we need to read it again
+            await self._catch_up(entries)
+            entries = None
+            self.d('Starting do_reduce_cycle')
+            self._state = await self.do_reduce(self._state, self.shard)
+
+        async with LockManager(self._lock):
+            entries = await self._sync_lists(self.Reduce_Fields, changes, journal=self.Journal_Changes)
+            tasks = await self._run_reduce(reduce_cycle, locked=True)
+        await self._send_tasks(tasks)
+
+    async def _write(self, batch: Optional[RedisBatch] = None) -> Optional[SaveConflict]:
+        ops = self._diff_ops()
+        replayed = self._journal_seq != self._saved_seq
+        if not ops and not replayed:
+            self._dirty = False
+            return None
+
+        checks = sorted({name for _, name, _ in ops} | set(self.Reduce_Fields))
+        keys, args, names = self._script_args(ops, checks, (self._saved_seq, self._journal_seq) if replayed else None)
+        if batch is None:
+            result = await _state_ops_script.run(keys, args)
+        else:
+            result = await _state_ops_script.queue(batch, keys, args)
+
+        if result[0]:
+            self.d(f'save_to_redis: saved version {result[1]}')
+            self._record_versions(names, result)
+            for name in names:
+                setattr(self._known, name, list(getattr(self._state, name)))
+            self._dirty = False
+            if replayed:
+                await self._checkpointed(self._saved_seq)
+            return None
+
+        conflict = SaveConflict(self._key, SaveConflict.Reason_Version, self._generation, result[1],
+                                self._generation, self._version)
+        self.w(f'save_to_redis: {conflict}, re-reading lists')
+        await self._sync_lists(self._lists)
+        self._dirty = False
+        return conflict
+
+    async def sync_redis(self, locked=False, batch: Optional[RedisBatch] = None):
+        async with LockManager(self._lock, already_locked=locked):
+            await self._sync_lists(self._lists)
+
+    async def load_from_redis(self):
+        async with LockManager(self._lock):
+            await self._sync_lists(self._lists)
+            if self._version == 0:
+                # nothing stored as lists yet, move over anything saved as a blob
+                blob = codec.decode(await new_redis().get(self._key))
+                if blob:
+                    self.w(f'load_from_redis: moving {self._key} from a blob to lists')
+                    blob.pop('version', None)
+                    self._generation = blob.pop('generation', 0)
+                    self._journal_seq = blob.pop('journal_seq', 0)
+                    self._state = self._make_new_state(blob)
+                    await self._write()
 
             self.d(f'load_from_redis: loaded state dict {self._state}')
+            await self.update(self._replay, locked=True)
+
+    async def _load_checkpoint(self):
+        await self._sync_lists(self._lists)
+
+
+# The one long running task that reduces a ScriptStateManager. Shards from requests queue up here and get
+# reduced in batches: one lock, one sync, one do_reduce and one save no matter how many requests are in it.
+class StateReducer(Task):
+    # If a reduce fails, changes that aren't in the journal are tried again with the next one, which happens
+    # within Retry_After seconds. After Retry_Attempts tries they're dropped.
+    Retry_After = 1
+    Retry_Attempts = 3
 
-class AfterRequestActions(Task):
-
-    # This *should* work for synchronization because each copy of the state will do its own
-    # lock on the shared lock. So changes will be ordered and will block any additions to the
-    # state from people going through their rooms.
-    #
-    # It's totally possible that these reduce loops happen out of order, but that is *fine*
-    # because we don't care about order. This is about reaching threshold values to move people
-    # out of waiting states.
-    #
-    # If we ever need this to be fair and ordered, we need to implement more strict ordering!
-    #
-    def __init__(self, shard: Shard, state: ScriptStateManager):
-        super(AfterRequestActions, self).__init__()
-        # remember that Task supports a delay arg if we need it
+    def __init__(self, state: ScriptStateManager):
+        super(StateReducer, self).__init__()
         self.state = state
-        self.shard = shard
+        self._send, self._receive = trio.open_memory_channel(float('inf'))
+        # changes from reduces that failed, and how many times they've been tried
+        self._failed: List[Change] = []
+        self._failed_attempts = 0
+        # for /debug/reducer
+        self.batches = 0
+        self.shards = 0
+        self.largest_batch = 0
+        self.last_batch = 0
+        # seconds between a shard being queued and the reduce it's in starting
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        # reduces that happened because nothing came in for Reduce_Every seconds
+        self.timed = 0
+
+    def submit(self, shard: Shard):
+        self._send.send_nowait((trio.current_time(), shard))
+
+    @property
+    def waiting(self) -> int:
+        return self._receive.statistics().current_buffer_used
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'shards': self.shards,
+            'waiting': self.waiting,
+            'average_batch': self.shards / self.batches if self.batches else 0,
+            'largest_batch': self.largest_batch,
+            'last_batch': self.last_batch,
+            'average_lag_ms': self.total_lag / self.shards * 1000 if self.shards else 0,
+            'max_lag_ms': self.max_lag * 1000,
+            'last_lag_ms': self.last_lag * 1000,
+            'timed': self.timed,
+            'failed_changes': len(self._failed),
+        }
+
+    # takes whatever is already queued without yielding, receive() gives everyone else a turn for every shard
+    def _drain(self, batch: list):
+        while len(batch) < self.state.Reduce_Batch_Max:
+            try:
+                batch.append(self._receive.receive_nowait())
+            except trio.WouldBlock:
+                return
+
+    # empty if Reduce_Every passed without anything showing up
+    async def _next_batch(self) -> List[Tuple[float, Shard]]:
+        batch = []
+        wait = self.state.Reduce_Every or float('inf')
+        if self._failed:
+            wait = min(wait, self.Retry_After)
+        with trio.move_on_after(wait):
+            batch.append(await self._receive.receive())
+        if not batch:
+            return batch
+
+        with trio.move_on_after(self.state.Reduce_Delay):
+            while len(batch) < self.state.Reduce_Batch_Max:
+                self._drain(batch)
+                if len(batch) < self.state.Reduce_Batch_Max:
+                    batch.append(await self._receive.receive())
+        self._drain(batch)
+        return batch
 
     async def execute(self):
-        self.d(f'ARATask[{self.state}]')
-        await self.shard.integrate()
-        self.d(f'ARATask[{self.state}]: integration done')
-        await self.state.reduce()
-        self.d(f'ARATask[{self.state}]: reduction done')
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                if not self._failed:
+                    self.timed += 1
+                await self._reduce([])
+                continue
+
+            started = trio.current_time()
+            lags = [started - queued for queued, _ in batch]
+            self.batches += 1
+            self.shards += len(batch)
+            self.last_batch = len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.total_lag += sum(lags)
+            self.last_lag = max(lags)
+            self.max_lag = max(self.max_lag, self.last_lag)
+
+            changes = [change for _, shard in batch for change in shard.take_changes()]
+            self.d(f'Reducing {len(batch)} shards ({len(changes)} changes not in the journal)')
+            await self._reduce(changes)
+
+    async def _reduce(self, changes: List[Change]):
+        # what failed last time goes first, so changes are applied in the order they were made
+        changes = self._failed + changes
+        try:
+            await self.state.reduce(changes)
+        except Exception as e:
+            # keep going. The next reduce picks up anything in the journal this one didn't get to, and we hand it
+            # the changes that aren't in the journal (with Journal_Changes off) ourselves.
+            self.e(f'reduce failed: {e}')
+            self.e("\n".join(traceback.extract_tb(e.__traceback__).format()))
+            try:
+                # so the changes aren't applied twice when we try them again
+                await self.state.reload()
+            except Exception as reload_error:
+                self.e(f'reload after a failed reduce failed: {reload_error}')
+            self._failed_attempts = self._failed_attempts + 1 if self._failed else 1
+            if changes and self._failed_attempts < self.Retry_Attempts:
+                self._failed = changes
+            else:
+                if changes:
+                    self.e(f'dropping {len(changes)} changes after {self._failed_attempts} failed reduces: {changes}')
+                self._failed = []
+                self._failed_attempts = 0
+        else:
+            self._failed = []
+            self._failed_attempts = 0
+
 
 class Script(Logger):
     # todo: maybe switch to static approach like with scenes
@@ -916,6 +1699,10 @@ class Script(Logger):
         #   }
         # }
         self.structure: Dict[str, Dict[str, SceneAndState]] = structure
+        # structure flattened for lookups, see compile_routes
+        self._routes: Dict[Tuple[str, str], SceneAndState] = {}
+        self._any_number: Dict[str, SceneAndState] = {}
+        self.compile_routes()
         # got to give it the key
         state_object.set_key(self.db_key)
         self.state_manager = state_object
@@ -927,6 +1714,27 @@ class Script(Logger):
 
     # Methods for dealing with making the basic structure
 
+    # (script state, number called) -> SceneAndState, plus the wildcard for each state, so finding a scene is a
+    # dict lookup. Call again if you change structure.
+    def compile_routes(self):
+        self._routes = {}
+        self._any_number = {}
+        for state, numbers in self.structure.items():
+            for number, scene_state in numbers.items():
+                if number == Script_Any_Number:
+                    self._any_number[state] = scene_state
+                else:
+                    self._routes[(state, number)] = scene_state
+
+    # Numbers a new player can call to start this script, and whether any number will do
+    @property
+    def start_numbers(self) -> List[str]:
+        return [number for state, number in self._routes if state == Script_New_State]
+
+    @property
+    def starts_on_any_number(self) -> bool:
+        return Script_New_State in self._any_number
+
     @classmethod
     def add_script(cls, script):
         cls.Active_Scripts.append(script)
@@ -963,21 +1771,38 @@ class Script(Logger):
     async def reset(self):
         await self.state_manager.reset()
 
+    # Compiles every scene in the script (see Scene.compile), so a broken scene stops us at startup instead of
+    # when someone calls it
+    def compile_scenes(self) -> Dict[str, SceneGraph]:
+        graphs = {}
+        for choices in self.structure.values():
+            for scene_set in choices.values():
+                if scene_set.scene.Name not in graphs:
+                    graphs[scene_set.scene.Name] = scene_set.scene.compile()
+        return graphs
+
     async def load_state(self):
+        self.compile_scenes()
         await self.state_manager.load_from_redis()
         await self.state_manager.on_startup()
+        if self.state_manager.Reduce_Every:
+            await self.state_manager.start_reducer()
 
         for choices in self.structure.values():
             for scene_set in choices.values():
                 await scene_set.scene.load()
 
     async def integrate_shard(self, shard: Shard):
-        await add_task.send(AfterRequestActions(shard, self.state_manager))
+        await self.state_manager.integrate_shard(shard)
 
     # return true if player is going t
-    async def request_made_by_active_player(self, request: TwilRequest):
+    async def request_made_by_active_player(self, request: TwilRequest, ctx: RequestContext = None):
+        if ctx is None:
+            ctx = RequestContext(request)
 
-        player = await self.create_player(request.caller)
+        player = await self.request_player(ctx)
+        if player.active_script is not None:
+            return player.active_script == self.name
 
         return self.player_is_playing(player)
 
@@ -994,17 +1819,24 @@ class Script(Logger):
     async def call_could_start_game(self, request: TwilRequest):
         await request.load()  # load player
 
-        # check by seeing if this a new player, with a new ScriptInfo, calling this number,
-        # would get a scene
-        scene_state = self._get_scene_state(ScriptInfo(), request.num_called)
+        # check by seeing if this a new player calling this number would get a scene
+        scene_state = self._routes.get((Script_New_State, request.num_called.e164),
+                                       self._any_number.get(Script_New_State))
 
         self.d(f"Can {request} start a new game? -> {scene_state is not None}")
         return scene_state is not None
 
-    async def process_text(self, request: TwilRequest):
+    async def process_text(self, request: TwilRequest, ctx: RequestContext = None):
         self.d(f'process_text({request})')
+        if ctx is None:
+            ctx = RequestContext(request)
 
-        player = await self.create_player(request.caller)
+        # the player is loaded, changed and saved under their lock
+        async with ctx.holding(request.caller):
+            return await self._process_text(request, ctx)
+
+    async def _process_text(self, request: TwilRequest, ctx: RequestContext):
+        player = await self.request_player(ctx)
         snapshot: Snapshot = Snapshot(self, [player])
 
         try:
@@ -1018,14 +1850,14 @@ class Script(Logger):
                 self.d(f'Player {player} is not on our script, returning!')
                 return
 
+            await self.state_manager.refresh()
+            shard: StateShard = ctx.shard(self)
             for handler in self.text_handlers:
-                shard: StateShard = self.state_manager.shard
-
-                player = await handler.new_text(request, shard, player)
+                player = await handler.new_text(request, shard, player, ctx)
 
-                await self.integrate_shard(shard)
+            await self.integrate_shard(shard)
 
-            await player.save()
+            await self._save_player(player)
 
             return
         except Exception as e:
@@ -1035,6 +1867,7 @@ class Script(Logger):
         self.d(f'start_game_for_player({player})')
         script_info = ScriptInfo()  # fresh!
         player.set_script(self.name, script_info)
+        player.active_script = self.name
 
         await self.state_manager.player_added(player, script_info, args)
 
@@ -1049,15 +1882,27 @@ class Script(Logger):
         await player.load()
         return player
 
-    async def play(self, request: TwilRequest):
+    # the player who made this request, loaded at most once per request
+    async def request_player(self, ctx: RequestContext) -> Player:
+        return await ctx.caller_player(self.state_manager.create_player)
+
+    async def play(self, request: TwilRequest, ctx: RequestContext = None):
         self.d(f'play({request})')
+        if ctx is None:
+            ctx = RequestContext(request)
 
+        # the player is loaded, changed and saved under their lock
+        async with ctx.holding(request.caller):
+            return await self._play(request, ctx)
+
+    async def _play(self, request: TwilRequest, ctx: RequestContext):
         # note: some sloppy planning has resulted in confusing naming. There is the script state [for the player],
         # which we frequently call the script state, and then there is the script state [for the script] that is
         # shared and used by all players going through a script
-        player = await self.create_player(request.caller)
+        player = await self.request_player(ctx)
         script_info: ScriptInfo = player.script(self.name)
-        shard: StateShard = self.state_manager.shard
+        await self.state_manager.refresh()
+        shard: StateShard = ctx.shard(self)
         snapshot: Snapshot = Snapshot(self, [player])
 
         if not self.player_is_playing(player):
@@ -1069,7 +1914,7 @@ class Script(Logger):
 
         if scene_state is None:
             self.e(f'!!!\n!!!\nCould not get Scene for: {request.num_called} by {player.number}')
-            snapshot.save()
+            await snapshot.save()
             return error_response()
 
         scene = scene_state.scene
@@ -1077,7 +1922,7 @@ class Script(Logger):
         # if something goes wrong
         result = error_response()
         try:
-            result = await scene.play(request, player, shard, script_info)
+            result = await scene.play(request, player, shard, script_info, ctx)
 
             await self.integrate_shard(shard)
             # apply changes
@@ -1089,33 +1934,46 @@ class Script(Logger):
                     self.d(f'play({request}) - scene is done. Script state: {script_info.state} -> {scene_state.next_state}')
                     script_info.scene_history.append(scene.Name)
                     script_info.state = scene_state.next_state
+                    if script_info.is_complete and player.active_script == self.name:
+                        player.active_script = ''
 
             player.set_script(self.name, script_info)  # should not be needed
-            await player.save()
+            await self._save_player(player)
         except Exception as e:
             await self._handle_exception(request, e, snapshot)
 
         return result
 
+    async def _save_player(self, player: Player):
+        try:
+            await player.save()
+        except SaveConflict as conflict:
+            if not conflict.retryable:
+                self.w(f'{conflict} - player was restored to a newer generation, dropping our changes')
+                return
+
+            # The player has already heard the response for this request, so its changes have to make it in. Put
+            # them on top of whatever the other save wrote (a conference event, a task...) instead of over it.
+            self.w(f'{conflict} - reloading and saving our changes on top')
+            await player.save_over()
+
     async def _handle_exception(self, request, exception: Exception, snapshot: Snapshot):
         self.e(f'Got exception from scene.play: {exception}: {traceback.extract_tb(exception.__traceback__).format()}')
         self.e(f'Returning generic confused response.')
         # save snap to restore state
-        snapshot.save()
+        await snapshot.save()
         await error_sms(f'Player {request.caller} in Scene {self} encountered an exception: {exception}')
 
     def _get_scene_state(self, info: ScriptInfo, number_called: PhoneNumber) -> Optional[SceneAndState]:
-        self.d(f'_get_scene_set(info, {number_called.e164})')
-        current_structure = self.structure.get(info.state, {})
-
-        if number_called.e164 in current_structure:
+        scene_state = self._routes.get((info.state, number_called.e164))
+        if scene_state is not None:
             self.d(f'_get_scene_set(info, {number_called.e164}): Specific number matched')
-            return current_structure.get(number_called.e164)
-        elif Script_Any_Number in current_structure:
-            self.d(f'_get_scene_set(info, {number_called.e164}): Matching wildcard')
-            return current_structure.get(Script_Any_Number)
+            return scene_state
 
-        return None
+        scene_state = self._any_number.get(info.state)
+        if scene_state is not None:
+            self.d(f'_get_scene_set(info, {number_called.e164}): Matching wildcard')
+        return scene_state
 
     def __str__(self):
         return f'Script[{self.name}]'
@@ -1,7 +1,7 @@
 import json
 from datetime import datetime, timedelta
 from dataclasses import dataclass, field, asdict
-from typing import List, Dict, Union, Optional
+from typing import List, Dict, Union, Optional, Set
 
 from twilio.twiml.voice_response import VoiceResponse, Gather
 
@@ -9,6 +9,7 @@ from spins_halp_line.media.resource_space import RSResource
 from spins_halp_line.resources.numbers import PhoneNumber
 from spins_halp_line.player import ScriptInfo, Player
 from spins_halp_line.stories.story_objects import Room, RoomContext, Scene, Shard
+from spins_halp_line.util import OrderedSet, Membership
 from spins_halp_line.stories.tele_constants import (
     Telemarketopia_Name, Key_path, Key_ready_for_conf
 )
@@ -108,41 +109,11 @@ class PathScene(Scene):
     # <path> can be a string (stored in the players' script data object
     # or it can be '*' meaning it doesn't matter
 
-    def _index_rooms(self):
-        self._room_index: Dict[str, Room] = {}
-        for r in self.Start:
-            self._add_to_index(r)
-        for r, paths in self.Choices.items():
-            self._add_to_index(r)
-
-            for path, room_dict in paths.items():
-                for choice, room_choice in room_dict.items():
-                    self._add_to_index(room_choice)
-
-    def _get_choice_for_request(self, number: str, room: Room, script_state: ScriptInfo):
-        path = script_state.data.get('path')
-        # select path
-        path_options = self.Choices.get(room)  # dictionary path choices
-        if len(path_options.keys()) == 1:
-            # We just are using '*'
-            room_choices = path_options.get(path, path_options.get('*'))
-        else:
-            # This could throw an exception, which is fine
-            room_choices = path_options[path]
-
-        self.d(f"_get_choice_for_request({number}) choices: {room_choices}")
-        queue = []
-        if number in room_choices:
-            queue = room_choices[number]
-            self.d(f"Choice #{number}: {queue}")
-        elif '*' in room_choices:  # default
-            queue = room_choices['*']
-            self.d(f"Choice *: {queue}")
+    def paths_for(self, room_choices: dict) -> Dict[Optional[str], dict]:
+        return room_choices
 
-        if not isinstance(queue, list):
-            queue = [queue]
-
-        return queue
+    def _path(self, script_state: ScriptInfo) -> Optional[str]:
+        return script_state.data.get('path')
 
 
 class TelePlayer(Player):
@@ -232,10 +203,12 @@ class TelePlayer(Player):
         self.d(f'clear({keys})')
         if not isinstance(keys, list):
             keys = [keys]
-        for k in keys:
-            self.telemarketopia.pop(k, None)
 
-        await self.save()
+        def pop_keys(player: TelePlayer):
+            for k in keys:
+                player.telemarketopia.pop(k, None)
+
+        await self.update(pop_keys)
 
     async def reset_conference_flags(self):
         await self.clear([
@@ -278,30 +251,54 @@ class TelePlayer(Player):
 
 @dataclass
 class TeleState:
-    clavae_players: List[str] = field(default_factory=list)
-    karen_players: List[str] = field(default_factory=list)
-    clavae_waiting_for_conf: List[str] = field(default_factory=list)
-    karen_waiting_for_conf: List[str] = field(default_factory=list)
-    clavae_in_conf: List[str] = field(default_factory=list)
-    karen_in_conf: List[str] = field(default_factory=list)
-    clavae_final_conf: List[str] = field(default_factory=list)
-    karen_final_conf: List[str] = field(default_factory=list)
+    clavae_players: OrderedSet = field(default_factory=OrderedSet)
+    karen_players: OrderedSet = field(default_factory=OrderedSet)
+    clavae_waiting_for_conf: OrderedSet = field(default_factory=OrderedSet)
+    karen_waiting_for_conf: OrderedSet = field(default_factory=OrderedSet)
+    clavae_in_conf: OrderedSet = field(default_factory=OrderedSet)
+    karen_in_conf: OrderedSet = field(default_factory=OrderedSet)
+    clavae_final_conf: OrderedSet = field(default_factory=OrderedSet)
+    karen_final_conf: OrderedSet = field(default_factory=OrderedSet)
+
+    List_Names = (
+        'clavae_players',
+        'karen_players',
+        'clavae_waiting_for_conf',
+        'karen_waiting_for_conf',
+        'clavae_in_conf',
+        'karen_in_conf',
+        'clavae_final_conf',
+        'karen_final_conf'
+    )
+
+    # Whatever gets assigned to one of our lists (a list from redis, a shard's copy...) is turned into an
+    # OrderedSet that keeps our membership index up to date, so lists_with() doesn't have to look through them all
+    def __setattr__(self, key, value):
+        if key in self.List_Names:
+            old = self.__dict__.get(key)
+            if value is not old:
+                if isinstance(old, OrderedSet):
+                    old.detach()
+                value = OrderedSet(value, key, self.membership)
+        super(TeleState, self).__setattr__(key, value)
+
+    @property
+    def membership(self) -> Membership:
+        if '_membership' not in self.__dict__:
+            # the shard's __setattr__ doesn't let us set things
+            object.__setattr__(self, '_membership', Membership())
+        return self.__dict__['_membership']
+
+    # names of the lists a number is in
+    def lists_with(self, number: str) -> Set[str]:
+        return self.membership.lists_with(number)
 
     @property
     def all_lists(self):
-        return [
-            self.clavae_players,
-            self.karen_players,
-            self.clavae_waiting_for_conf,
-            self.karen_waiting_for_conf,
-            self.clavae_in_conf,
-            self.karen_in_conf,
-            self.clavae_final_conf,
-            self.karen_final_conf
-        ]
+        return [getattr(self, name) for name in self.List_Names]
 
     def __str__(self):
-        return f'TeleState: {json.dumps(asdict(self))}'
+        return f'TeleState: {json.dumps(asdict(self), default=list)}'
 
 
 class TeleShard(TeleState, Shard):
@@ -1,4 +1,4 @@
-from typing import Set, List
+from typing import Dict, List
 
 from twilio.twiml.voice_response import VoiceResponse
 
@@ -16,13 +16,16 @@ from .story_objects import (
     Script,
     SceneAndState,
     RoomContext,
-    ScriptStateManager,
+    FieldStateManager,
     ScriptInfo,
     TextHandler
 )
+from .request_context import RequestContext
+from .matchmaking import Matchmaker
 
-from spins_halp_line.util import Logger, LockManager
-from spins_halp_line.tasks import add_task
+from spins_halp_line.util import Logger, LockManager, OrderedSet
+from spins_halp_line.tasks import send_task
+from spins_halp_line.resources.locks import Player_Locks
 from spins_halp_line.resources.numbers import PhoneNumber, Global_Number_Library
 from spins_halp_line.media.common import (
     Puppet_Master, AI_Password, Look_At_You_Hacker, Database_Menu, Database_File_Corrupted
@@ -45,18 +48,17 @@ class ConferenceChecker(TextHandler):
         caller.timestamp(Key_ready_for_conf)
         return caller
 
-    async def first_conf_choice(self, text_request: TwilRequest, caller: TelePlayer):
+    async def first_conf_choice(self, text_request: TwilRequest, caller: TelePlayer, ctx: RequestContext):
         self.d(f'new_text({text_request.caller}, {text_request.text_body})')
 
         caller.final_choice = text_request.text_body.strip()
 
-        partner = TelePlayer(caller.partner)
-        await partner.load()
+        partner = await ctx.player(caller.partner, TelePlayer)
 
         # check if we have a choice
         if partner.final_choice is not None:
             if caller.path == Path_Clavae:
-                await add_task.send(
+                await send_task(
                     MakeClimaxCallsTask(caller.number,
                                         caller.final_choice,
                                         partner.number,
@@ -64,7 +66,7 @@ class ConferenceChecker(TextHandler):
                                         )
                 )
             else:
-                await add_task.send(
+                await send_task(
                     MakeClimaxCallsTask(partner.number,
                                         partner.final_choice,
                                         caller.number,
@@ -77,7 +79,7 @@ class ConferenceChecker(TextHandler):
     async def final_answer_text(self, text_request: TwilRequest, caller: TelePlayer):
         self.d(f'text[{caller}] final answer? {text_request.text_body})')
         partner = PhoneNumber(caller.partner)
-        await add_task.send(SendFinalFinalResult(
+        await send_task(SendFinalFinalResult(
             caller.number,
             partner,
             text_request.text_body.strip() == '462'
@@ -85,15 +87,17 @@ class ConferenceChecker(TextHandler):
 
         return caller
 
-    async def new_text(self, text_request: TwilRequest, shard: TeleShard, caller: TelePlayer):
+    async def new_text(self, text_request: TwilRequest, shard: TeleShard, caller: TelePlayer, ctx: RequestContext = None):
         self.d(f'new_text({text_request.caller}, {text_request.text_body})')
+        if ctx is None:
+            ctx = RequestContext(text_request)
 
         if text_request.num_called == Global_Number_Library.from_label('conference'):
             if not caller.player_in_first_conference:
                 return await self.first_conf_text(text_request, caller)
 
             if caller.was_sent_final_decision_text:
-                return await self.first_conf_choice(text_request, caller)
+                return await self.first_conf_choice(text_request, caller, ctx)
 
         elif text_request.num_called == Global_Number_Library.from_label('final'):
             return await self.final_answer_text(text_request, caller)
@@ -110,11 +114,13 @@ class ConferenceEventHandler(Logger):
 
     @staticmethod
     async def save_state_for_start(participant: PhoneNumber, partner: PhoneNumber):
-        player = TelePlayer(participant.e164)
-        await player.load()
-        player.player_in_first_conference = True
-        player.partner = partner.e164
-        await player.save()
+        def start_conference(player: TelePlayer):
+            player.player_in_first_conference = True
+            player.partner = partner.e164
+
+        async with LockManager(Player_Locks.lock(participant.e164)):
+            player = TelePlayer(participant.e164)
+            await player.update(start_conference)
 
     async def event(self, conference: TwilConference, event: str, participant: str):
         self.d(f"Got conference event: {conference}:{event}!")
@@ -129,19 +135,21 @@ class ConferenceEventHandler(Logger):
                 return True
 
             if event == TwilConference.Event_Participant_Leave:
-                player_left = TelePlayer(participant)
-                await player_left.load()
-                self.d(f"Player {participant}({player_left.path}) left the first conference!")
-                msg = KPostConfOptions
-                if player_left.path == Path_Clavae:
-                    msg = CPostConfOptions
+                async with LockManager(Player_Locks.lock(participant)):
+                    player_left = TelePlayer(participant)
+                    await player_left.load(scripts=[Telemarketopia_Name])
+                    self.d(f"Player {participant}({player_left.path}) left the first conference!")
+                    msg = KPostConfOptions
+                    if player_left.path == Path_Clavae:
+                        msg = CPostConfOptions
 
-                self.d(f'Texting {msg} to {player_left}')
-                await send_text(msg, player_left.number)
+                    self.d(f'Texting {msg} to {player_left}')
+                    await send_text(msg, player_left.number)
 
-                player_left.was_sent_final_decision_text = True
+                    def mark_text_sent(player: TelePlayer):
+                        player.was_sent_final_decision_text = True
 
-                await player_left.save()
+                    await player_left.update(mark_text_sent)
                 return True
 
         return False
@@ -153,55 +161,29 @@ class ConferenceEventHandler(Logger):
 TwilConference._custom_handlers.append(ConferenceEventHandler())
 
 
-class TeleStateManager(ScriptStateManager):
+class TeleStateManager(FieldStateManager):
+    # do_reduce matches up players waiting for a conference
+    Reduce_Fields = ['clavae_waiting_for_conf', 'karen_waiting_for_conf']
+    # and checks for new matches this often even if nobody is calling or texting
+    Reduce_Every = 10
+
+    def __init__(self):
+        super(TeleStateManager, self).__init__()
+        self.matchmaker = Matchmaker()
 
     def _make_new_state(self, base: dict = None) -> TeleState:
         if not base:
             base = {}
         return TeleState(**base)
 
-    def _make_shard(self) -> TeleShard:
-        d = self._state_dict
-        d.pop('version', None)  # remove version
-        d.pop('generation', None)  # remove version
-        ts = TeleShard(**d)
-        ts.set_parent(self)
-
-        return ts
-
     @property
     def state(self) -> TeleState:
         return self._state
 
+    # only keep players who are on the whitelist (the lists can't have anyone twice)
     @staticmethod
-    def filter_list(player_list: List, player_set: Set):
-        result = []
-        added = set()
-
-        # updated to both:
-        # only add players who are on the whitelist
-        # and also only add them once to each list
-        for p in player_list:
-            if p not in added and p in player_set:
-                added.add(p)
-                result.append(p)
-
-        return result
-
-    def remove_dupes(self, player_list, player_set=None):
-        if not player_set:
-            player_set = set()
-        clean_list = []
-
-        for player in player_list:
-            if player not in player_set:
-                player_set.add(player)
-                clean_list.append(player)
-
-        return {
-            'set': player_set,
-            'list': clean_list
-        }
+    def filter_list(player_list: OrderedSet, players: OrderedSet) -> List[str]:
+        return [p for p in player_list if p in players]
 
     async def create_player(self, number: str) -> TelePlayer:
         return TelePlayer(number)
@@ -228,43 +210,35 @@ class TeleStateManager(ScriptStateManager):
             self.d(f'on_startup(): Removing dupes')
             self.d(f'on_startup(): {state.clavae_players}')
             self.d(f'on_startup(): {state.karen_players}')
-            clav_uniques = self.remove_dupes(state.clavae_players)
-            kare_uniques = self.remove_dupes(state.karen_players)
-
-            # find intersection
-            shared_players = clav_uniques['set'].intersection(kare_uniques['set'])
+            # the lists are OrderedSets so nobody is in one twice, but they can be on both paths
+            shared_players = [p for p in state.clavae_players if p in state.karen_players]
             if shared_players:
                 self.d(f'shared: {shared_players}')
                 for shared_player in shared_players:
                     # nuke it from orbit
-                    clav_uniques['set'].remove(shared_player)
-                    kare_uniques['set'].remove(shared_player)
-                    clav_uniques['list'].remove(shared_player)
-                    kare_uniques['list'].remove(shared_player)
+                    state.clavae_players.remove(shared_player)
+                    state.karen_players.remove(shared_player)
                     # also delete player state
                     await TelePlayer.reset(shared_player)
 
             # now filter all lists
-            state.clavae_players = clav_uniques['list']
-            state.karen_players = kare_uniques['list']
+            state.clavae_waiting_for_conf = self.filter_list(state.clavae_waiting_for_conf, state.clavae_players)
+            state.clavae_final_conf = self.filter_list(state.clavae_final_conf, state.clavae_players)
 
-            clav_set = clav_uniques['set']
-            state.clavae_waiting_for_conf = self.filter_list(state.clavae_waiting_for_conf, clav_set)
-            state.clavae_final_conf = self.filter_list(state.clavae_final_conf, clav_set)
-
-            kare_set = kare_uniques['set']
-            state.karen_waiting_for_conf = self.filter_list(state.karen_waiting_for_conf, kare_set)
-            state.karen_final_conf = self.filter_list(state.karen_final_conf, kare_set)
+            state.karen_waiting_for_conf = self.filter_list(state.karen_waiting_for_conf, state.karen_players)
+            state.karen_final_conf = self.filter_list(state.karen_final_conf, state.karen_players)
             self.d(f'on_startup(): >>>>>>>>')
             self.d(f'on_startup(): {state.clavae_players}')
             self.d(f'on_startup(): {state.karen_players}')
 
             await self.save_to_redis(True)
 
-    async def do_reduce(self, state: TeleState, shard: TeleShard):
-        # todo: think about doing something about how recently players have been active?
-        # todo: players who have been out for a while might not want to play
+    # When each of `numbers` last told us they were ready for a conference, for the ones who have
+    async def _last_ready(self, numbers: List[str]) -> Dict[str, str]:
+        data = await TelePlayer.script_data(numbers, Telemarketopia_Name)
+        return {number: d[Key_ready_for_conf] for number, d in data.items() if d.get(Key_ready_for_conf)}
 
+    async def do_reduce(self, state: TeleState, shard: TeleShard):
         self.d('do_reduce()')
         self.d(f'do_reduce():{state}')
 
@@ -273,19 +247,27 @@ class TeleStateManager(ScriptStateManager):
 
         self.d(f'clav_waiting:{clave_waiting}({len(clave_waiting)})')
         self.d(f'karen_waiting:{karen_waiting}({len(karen_waiting)})')
-        if len(clave_waiting) >= 1 and len(karen_waiting) >= 1:
-            # conference time baby!
-            clav_p = state.clavae_waiting_for_conf.pop(0)
-            karen_p = state.karen_waiting_for_conf.pop(0)
+        if not clave_waiting or not karen_waiting:
+            self.matchmaker.observe(clave_waiting, karen_waiting)
+            return state
+
+        # everyone on the shorter side gets paired, so we only need to know how active the longer side has been
+        last_ready = {}
+        if len(clave_waiting) != len(karen_waiting):
+            longer = clave_waiting if len(clave_waiting) > len(karen_waiting) else karen_waiting
+            last_ready = await self._last_ready(list(longer))
+
+        # conference time baby!
+        pairs = self.matchmaker.match(clave_waiting, karen_waiting, last_ready)
+        for clav_p, karen_p in pairs:
             self.d(f'Starting conf with {[clav_p, karen_p]}')
+            state.clavae_waiting_for_conf.remove(clav_p)
+            state.karen_waiting_for_conf.remove(karen_p)
             state.clavae_in_conf.append(clav_p)
             state.karen_in_conf.append(karen_p)
-
-            await add_task.send(
-                ConfStartFirst(
-                    StoryInfo(clav_p, karen_p, shard)
-                )
-            )
+            # started once this is saved, this might not be the run that gets saved
+            self.after_save(ConfStartFirst(StoryInfo(clav_p, karen_p, shard)))
+        self.mark_dirty()
 
         return state
 
@@ -294,16 +276,14 @@ class TeleStateManager(ScriptStateManager):
 
         if args is None:
             args = {}
-        async with LockManager(self._lock):
 
-            state: TeleState = self._state
+        async def add(state: TeleState):
             number_str = player.number.e164
 
             # get rid of any stale references
-            for state_list in state.all_lists:
-                if number_str in state_list:
-                    self.d(f'Stale reference to "{player}" found in {state_list}! - removing')
-                    state_list.remove(number_str)
+            for name in state.lists_with(number_str):
+                self.d(f'Stale reference to "{player}" found in {name}! - removing')
+                getattr(state, name).remove(number_str)
 
             if Key_path in args:
                 path = args[Key_path]
@@ -317,15 +297,16 @@ class TeleStateManager(ScriptStateManager):
                 state.clavae_players.append(number_str)
             else:
                 state.karen_players.append(number_str)
+            self.mark_dirty()
 
             # set path!
             self.d(f'Assigning {player} to path {path}!')
             script_info.data[Key_path] = path
 
-            if 'state' in args:
-                script_info.state = args['state']
+        await self.update(add)
 
-            await self.save_to_redis(True)
+        if 'state' in args:
+            script_info.state = args['state']
 
     def __str__(self):
         return f'TeleSM'
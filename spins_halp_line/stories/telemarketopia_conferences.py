@@ -11,12 +11,13 @@ from spins_halp_line.constants import Root_Url, Credentials
 from spins_halp_line.media.common import Conference_Nudge, Clavae_Conference_Intro, Karen_Conference_Info
 from spins_halp_line.resources.numbers import PhoneNumber, Global_Number_Library
 from spins_halp_line.stories.tele_constants import (
+    Telemarketopia_Name,
     Key_ready_for_conf,
     ConfUnReadyIfReply, ConfUnReadyIfNoReply, ConfReady, ConfReadyTwo,
     CFinalPuzzle1, KFinalPuzzle1, CFinalPuzzle2, KFinalPuzzle2
 )
 from spins_halp_line.stories.tele_story_objects import TeleShard, TelePlayer
-from spins_halp_line.tasks import Task, add_task
+from spins_halp_line.tasks import SharedTask, send_task
 
 
 #   _____             __                                    _             _
@@ -40,15 +41,26 @@ class StoryInfo:
         self.shard = shard
         self._loaded = False
 
+    # For tasks rebuilt from the shared queue: a shard of the running telemarketopia script
+    @classmethod
+    def for_players(cls, clavae_player: str, karen_player: str) -> 'StoryInfo':
+        # telemarketopia imports us
+        from spins_halp_line.stories.telemarketopia import telemarketopia
+        return cls(clavae_player, karen_player, telemarketopia.state_manager.shard)
+
     async def load(self):
         if not self._loaded:
-            await self.clv_p.load()
-            await self.kar_p.load()
-            self._loaded = True
+            await self.refresh()
+
+    # always goes back to redis, both players come back in one round trip
+    async def refresh(self):
+        await TelePlayer.load_all([self.clv_p, self.kar_p], scripts=[Telemarketopia_Name])
+        # and the script state, in case other processes have changed it
+        await self.shard.refresh()
+        self._loaded = True
 
     async def save(self):
-        await self.clv_p.save()
-        await self.kar_p.save()
+        await TelePlayer.save_all([self.clv_p, self.kar_p])
 
     @property
     def c_num(self) -> PhoneNumber:
@@ -62,16 +74,29 @@ class StoryInfo:
         return f'SI[{self.clv_p},{self.kar_p}]'
 
 
-class ConferenceTask(Task):
+class ConferenceTask(SharedTask):
     def __init__(self, info: StoryInfo, delay: int = 0, conf: TwilConference = None):
         super(ConferenceTask, self).__init__(delay)
         self.info = info
         self.conference: Optional[TwilConference] = conf
+        # set when we're rebuilt from the shared queue, the conference is loaded when we run
+        self._conference_id: Optional[int] = None
+
+    def shared_args(self) -> dict:
+        return {
+            'clavae': self.info.c_num.e164,
+            'karen': self.info.k_num.e164,
+            'conference': self.conference.id if self.conference else None
+        }
+
+    @classmethod
+    def from_shared_args(cls, args: dict) -> 'ConferenceTask':
+        task = cls(StoryInfo.for_players(args['clavae'], args['karen']))
+        task._conference_id = args.get('conference')
+        return task
 
     async def refresh_players(self):
-        await self.info.load()
-        await self.info.clv_p.load()
-        await self.info.kar_p.load()
+        await self.info.refresh()
 
     async def check_player_status(self):
         await self.refresh_players()
@@ -87,9 +112,11 @@ class ConferenceTask(Task):
 
     @staticmethod
     async def start_child_task(task):
-        await add_task.send(task)
+        await send_task(task)
 
     async def execute(self):
+        if self.conference is None and self._conference_id is not None:
+            self.conference = await TwilConference.get(self._conference_id)
         await self.info.load()
         await self.execute_conference_action()
 
@@ -103,8 +130,7 @@ class ConferenceTask(Task):
         self.d(f"ConfWaitForPlayers({self.info}): Starting conference")
         await self.conference.add_participant(
             self.info.c_num,
-            play_first=clav_media,
-
+            play_first=clav_media
         )
 
         await self.conference.add_participant(
@@ -176,13 +202,16 @@ class ConnectFirstConference(ConferenceTask):
         # todo: get a notification until they have finished listening to the audio on that call.
         await trio.sleep(self._sleep_time)
         self.d(f"e_c_a(): Checking if players connected...")
+        # the callbacks may have gone to another process
+        await self.conference.sync()
 
         if not self.conference.started:
             # todo: end conference through twilio conference interface here
             self.d(f"e_c_a(): Someone didn't pick up, returning")
-            return await add_task.send(ReturnPlayers(self.info))
+            return await send_task(ReturnPlayers(self.info))
 
         await trio.sleep(60 * 5)
+        await self.conference.sync()
         if self.conference.is_active > 1:
             await self.conference.play_sound(Conference_Nudge)
 
@@ -203,6 +232,17 @@ class ConfWaitForPlayers(ConferenceTask):
         self.state: ConfWaitForPlayers.ConfWaitForPlayersState = ongoing_state
         self.state.time_elapsed += delay
 
+    def shared_args(self) -> dict:
+        args = super(ConfWaitForPlayers, self).shared_args()
+        args['state'] = {'time_elapsed': self.state.time_elapsed, 'text_counts': self.state.text_counts}
+        return args
+
+    @classmethod
+    def from_shared_args(cls, args: dict) -> 'ConfWaitForPlayers':
+        # the delay was already added to time_elapsed when we were queued
+        state = cls.ConfWaitForPlayersState(**args['state'])
+        return cls(StoryInfo.for_players(args['clavae'], args['karen']), ongoing_state=state)
+
     async def maybe_send_text(self, ready: bool, number: PhoneNumber):
         text_count = self.state.text_counts[number.e164]
         if not ready and self.state.time_elapsed > self._wait_before_retext and text_count == 1:
@@ -256,12 +296,19 @@ class ConfStartFirst(ConferenceTask):
         await self.start_child_task(wait_task)
 
 
-class DestroyTelemarketopia(Task):
+class DestroyTelemarketopia(SharedTask):
     def __init__(self, clavae_num: PhoneNumber, karen_num: PhoneNumber):
         super(DestroyTelemarketopia, self).__init__()
         self.clavae_num = clavae_num
         self.karen_num = karen_num
 
+    def shared_args(self) -> dict:
+        return {'clavae_num': self.clavae_num.e164, 'karen_num': self.karen_num.e164}
+
+    @classmethod
+    def from_shared_args(cls, args: dict) -> 'DestroyTelemarketopia':
+        return cls(PhoneNumber(args['clavae_num']), PhoneNumber(args['karen_num']))
+
     async def execute(self):
         self.d(f"DestroyTelemarketopia({self.clavae_num}, {self.karen_num}): Let's go!")
         await send_text(CFinalPuzzle1, self.clavae_num)
@@ -276,20 +323,14 @@ class DestroyTelemarketopia(Task):
 
         await conference.add_participant(self.karen_num)
 
-        clave_p = TelePlayer(self.clavae_num)
-        karen_p = TelePlayer(self.karen_num)
-
-        await clave_p.load()
-        await karen_p.load()
+        def enter_final_conference(player: TelePlayer):
+            player.in_final_conference = True
 
-        clave_p.in_final_conference = True
-        karen_p.in_final_conference = True
+        await TelePlayer(self.clavae_num).update(enter_final_conference)
+        await TelePlayer(self.karen_num).update(enter_final_conference)
 
-        await clave_p.save()
-        await karen_p.save()
 
-
-class MakeClimaxCallsTask(Task):
+class MakeClimaxCallsTask(SharedTask):
 
     def __init__(self, clavae_num: PhoneNumber, clav_choice: str, karen_num: PhoneNumber, karen_choice: str):
         super(MakeClimaxCallsTask, self).__init__()
@@ -298,6 +339,19 @@ class MakeClimaxCallsTask(Task):
         self.karen_num = karen_num
         self.karen_choice = karen_choice
 
+    def shared_args(self) -> dict:
+        return {
+            'clavae_num': self.clavae_num.e164,
+            'clav_choice': self.clav_choice,
+            'karen_num': self.karen_num.e164,
+            'karen_choice': self.karen_choice
+        }
+
+    @classmethod
+    def from_shared_args(cls, args: dict) -> 'MakeClimaxCallsTask':
+        return cls(PhoneNumber(args['clavae_num']), args['clav_choice'],
+                   PhoneNumber(args['karen_num']), args['karen_choice'])
+
     @property
     def status_callback(self):
         return '/'.join([Root_Url, 'climax', self.clav_choice, self.karen_choice])
@@ -323,16 +377,27 @@ class MakeClimaxCallsTask(Task):
         )
 
         if self.start_second_conference:
-            await add_task.send(DestroyTelemarketopia(self.clavae_num, self.karen_num))
+            await send_task(DestroyTelemarketopia(self.clavae_num, self.karen_num))
 
 
-class SendFinalFinalResult(Task):
+class SendFinalFinalResult(SharedTask):
     def __init__(self, clavae_num: PhoneNumber, karen_num: PhoneNumber, got_right_answer: bool):
         super(SendFinalFinalResult, self).__init__()
         self.got_right_answer = got_right_answer
         self.clavae_num = clavae_num
         self.karen_num = karen_num
 
+    def shared_args(self) -> dict:
+        return {
+            'clavae_num': self.clavae_num.e164,
+            'karen_num': self.karen_num.e164,
+            'got_right_answer': self.got_right_answer
+        }
+
+    @classmethod
+    def from_shared_args(cls, args: dict) -> 'SendFinalFinalResult':
+        return cls(PhoneNumber(args['clavae_num']), PhoneNumber(args['karen_num']), args['got_right_answer'])
+
     async def execute(self):
         self.d(f"SendFinalFinalResult({self.clavae_num}, {self.karen_num}): !!!!!!!!!!!!!!!!!\n!!!!!!!!!!!!!!!!")
         twilio_client: rest.Client = rest.Client(Credentials["twilio"]["sid"], Credentials["twilio"]["token"])
@@ -1,7 +1,13 @@
 import traceback
+from time import time
+from typing import Dict, List, Type
+from uuid import uuid4
 
 import trio
 
+from spins_halp_line.constants import Shared_Workers
+from spins_halp_line.resources.redis import new_redis, RedisScript
+from spins_halp_line.resources import codec
 from spins_halp_line.util import Logger
 
 
@@ -49,6 +55,99 @@ class GitUpdate(Task):
 add_task, _get_task = trio.open_memory_channel(50)
 
 
+# A task that any worker can run. With shared workers, send_task() puts these in redis instead of our own queue,
+# and whichever worker's TaskPoller gets to it first runs it once it's due.
+#
+# Subclasses say what they need to be rebuilt somewhere else: shared_args() is a dict codec can encode, and
+# from_shared_args() gets that dict back. The delay is taken care of by the queue, so they're rebuilt without one.
+class SharedTask(Task):
+    # 'module.Class' -> class, for rebuilding tasks we read from redis
+    _registry: Dict[str, Type['SharedTask']] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        SharedTask._registry[cls.task_name()] = cls
+
+    @classmethod
+    def task_name(cls) -> str:
+        return f'{cls.__module__}.{cls.__qualname__}'
+
+    def shared_args(self) -> dict:
+        raise NotImplementedError()
+
+    @classmethod
+    def from_shared_args(cls, args: dict) -> 'SharedTask':
+        return cls(**args)
+
+
+_task_queue_key = 'spins_tasks'
+
+
+# KEYS[1]: the queue (a sorted set scored by when each task is due)
+# ARGV: now, most to take
+# returns: the tasks that are due, which are now ours
+def _claim(call, keys, args):
+    now, limit = float(args[0]), int(args[1])
+    scored = call('ZRANGE', keys[0], 0, -1, 'WITHSCORES')
+    due = [member for member, score in zip(scored[::2], scored[1::2]) if float(score) <= now][:limit]
+    if due:
+        call('ZREM', keys[0], *due)
+    return due
+
+
+_claim_script = RedisScript("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+""", emulate=_claim)
+
+
+# Queues a task: in redis if it's a SharedTask and workers are shared, otherwise for our own runner
+async def send_task(task: Task):
+    if Shared_Workers and isinstance(task, SharedTask):
+        await TaskPoller.push(task)
+    else:
+        await add_task.send(task)
+
+
+# Moves shared tasks that are due from redis to our own runner
+class TaskPoller(Task):
+    Poll_Every = 0.5
+    Claim_Max = 20
+
+    @staticmethod
+    async def push(task: SharedTask):
+        entry = codec.encode({'id': uuid4().hex, 'task': task.task_name(), 'args': task.shared_args()})
+        await new_redis().zadd(_task_queue_key, time() + task.delay, entry)
+
+    # the tasks that are due (taking them off the queue)
+    async def claim(self) -> List[Task]:
+        tasks = []
+        for entry in await _claim_script.run([_task_queue_key], [time(), self.Claim_Max]):
+            entry = codec.decode(entry)
+            cls = SharedTask._registry.get(entry['task'])
+            if cls is None:
+                self.e(f'claim(): dropping {entry["task"]}, we do not know how to run it')
+                continue
+            tasks.append(cls.from_shared_args(entry['args']))
+        return tasks
+
+    async def execute(self):
+        while True:
+            try:
+                tasks = await self.claim()
+            except Exception as e:
+                self.e(f'Could not read shared tasks: {e}')
+                tasks = []
+
+            for task in tasks:
+                await add_task.send(task)
+            if len(tasks) < self.Claim_Max:
+                await trio.sleep(self.Poll_Every)
+
+
 async def Trio_Task_Task_Object_Runner():
     global _get_task
     # this is a work queue that fans out
@@ -86,6 +86,9 @@ class TwilRequest(object):
         self.req: Request = request
         self._loaded = False
         self._data = {}
+        # parsing numbers isn't free and these get asked for all over the place
+        self._caller: Optional[PhoneNumber] = None
+        self._num_called: Optional[PhoneNumber] = None
         # self.player: Optional[Player] = None
 
     async def load(self):
@@ -122,17 +125,18 @@ class TwilRequest(object):
 
     @property
     def caller(self) -> Optional[PhoneNumber]:
-        if "From" in self.data:
-            return PhoneNumber(self.data.get("From"))
-        return None
+        if self._caller is None and "From" in self.data:
+            self._caller = PhoneNumber(self.data.get("From"))
+        return self._caller
 
     @property
     def num_called(self) -> Optional[PhoneNumber]:
-        if "Called" in self.data:
-            return PhoneNumber(self.data.get("Called"))
-        if "To" in self.data:
-            return PhoneNumber(self.data.get("To"))
-        return None
+        if self._num_called is None:
+            if "Called" in self.data:
+                self._num_called = PhoneNumber(self.data.get("Called"))
+            elif "To" in self.data:
+                self._num_called = PhoneNumber(self.data.get("To"))
+        return self._num_called
 
     @property
     def digits(self):
@@ -1,6 +1,7 @@
 import logging
+from collections import OrderedDict
 from copy import deepcopy
-from typing import Union, Optional, IO, Any
+from typing import Union, Optional, IO, Any, Dict, Set, Iterable, List, Callable
 
 import hypercorn.logging as hyplog
 import trio
@@ -135,6 +136,22 @@ async def pretty_print_request(r, label=""):
     print("\n".join(s))
 
 
+# Counters for the work we did while handling one request
+class RequestStats:
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        # saves we skipped because nothing had changed
+        self.saves_elided = 0
+        # time spent waiting for player locks
+        self.lock_wait_ms = 0
+
+    def __str__(self):
+        return (f'Stats[reads:{self.reads}|writes:{self.writes}|elided:{self.saves_elided}'
+                f'|lock_wait:{self.lock_wait_ms:.1f}ms]')
+
+
 class SynchedCache(Logger):
 
     def __init__(self):
@@ -153,13 +170,13 @@ class SynchedCache(Logger):
             return value
 
 
-# Helper class to ease the demands on trio.Lock state tracking
+# Helper class to ease the demands on lock state tracking. Takes any Lock from resources/locks.py.
 class LockManager(Logger):
 
-    def __init__(self, lock, already_locked=False):
+    def __init__(self, lock: 'Lock', already_locked=False):
         super(LockManager, self).__init__()
 
-        self.lock: trio.Lock = lock
+        self.lock: 'Lock' = lock
         self.expect_locked = already_locked
 
     def __enter__(self):
@@ -176,7 +193,7 @@ class LockManager(Logger):
 
     async def __aexit__(self, exc_type, exc, tb):
         if not self.expect_locked:
-            self.lock.release()
+            await self.lock.release()
 
 
 # Helper class to restore a reference to a previous set of values (used to create pseudo-transactions)
@@ -191,5 +208,216 @@ class StateCopy:
         self._snap = deepcopy(snap_of)
 
     def restore(self):
-        for key, value in vars(self._snap).items():
+        for key, value in self._fields(self._snap).items():
             setattr(self._ref, key, value)
+
+    @staticmethod
+    def _fields(obj) -> dict:
+        if hasattr(obj, '__dict__'):
+            return vars(obj)
+
+        # __slots__ classes like the player infos
+        return {
+            name: getattr(obj, name)
+            for cls in type(obj).__mro__
+            for name in getattr(cls, '__slots__', ())
+            if hasattr(obj, name)
+        }
+
+
+# Which OrderedSets each member is in, shared by all the sets in one object (see TeleState)
+class Membership:
+    def __init__(self):
+        self._lists: Dict[Any, Set[str]] = {}
+
+    def add(self, member, name: str):
+        self._lists.setdefault(member, set()).add(name)
+
+    def discard(self, member, name: str):
+        names = self._lists.get(member)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del self._lists[member]
+
+    def lists_with(self, member) -> Set[str]:
+        return set(self._lists.get(member, ()))
+
+
+# A list of unique items with O(1) `in`, remove, append, and pop / insert at either end. Used for the lists of
+# players in script state, which get checked and shuffled around a lot.
+#
+# It only looks like a list: other positions are O(n), and adding something that's already there does nothing.
+# It compares equal to a list with the same items in the same order and is encoded as one (see to_list).
+#
+# `name` and `membership` are optional, if they're set the set keeps `membership` up to date as things come and go.
+class OrderedSet:
+    __hash__ = None
+
+    def __init__(self, items: Iterable = (), name: str = None, membership: Membership = None):
+        self._items: OrderedDict = OrderedDict()
+        self._name = name
+        self._membership = membership
+        self.extend(items)
+
+    def _added(self, item):
+        if self._membership is not None:
+            self._membership.add(item, self._name)
+
+    def _removed(self, item):
+        if self._membership is not None:
+            self._membership.discard(item, self._name)
+
+    # stop updating membership, e.g. because we've been replaced
+    def detach(self):
+        if self._membership is not None:
+            for item in self._items:
+                self._membership.discard(item, self._name)
+        self._membership = None
+
+    def append(self, item):
+        if item not in self._items:
+            self._items[item] = None
+            self._added(item)
+
+    def extend(self, items: Iterable):
+        for item in items:
+            self.append(item)
+
+    def insert(self, index: int, item):
+        if item in self._items:
+            return
+        if index == 0:
+            self._items[item] = None
+            self._items.move_to_end(item, last=False)
+        elif index >= len(self._items):
+            self._items[item] = None
+        else:
+            items = list(self._items)
+            items.insert(index, item)
+            self._items = OrderedDict.fromkeys(items)
+        self._added(item)
+
+    def remove(self, item):
+        try:
+            del self._items[item]
+        except KeyError:
+            raise ValueError(f'{item!r} not in OrderedSet')
+        self._removed(item)
+
+    def discard(self, item):
+        if item in self._items:
+            self.remove(item)
+
+    def pop(self, index: int = -1):
+        if not self._items:
+            raise IndexError('pop from empty OrderedSet')
+        if index == 0:
+            item, _ = self._items.popitem(last=False)
+        elif index == -1 or index == len(self._items) - 1:
+            item, _ = self._items.popitem()
+        else:
+            item = self[index]
+            del self._items[item]
+        self._removed(item)
+        return item
+
+    def clear(self):
+        for item in self._items:
+            self._removed(item)
+        self._items.clear()
+
+    def index(self, item) -> int:
+        for n, value in enumerate(self._items):
+            if value == item:
+                return n
+        raise ValueError(f'{item!r} not in OrderedSet')
+
+    def to_list(self) -> list:
+        return list(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.to_list()[index]
+        if index == 0 and self._items:
+            return next(iter(self._items))
+        if index == -1 and self._items:
+            return next(reversed(self._items))
+        return self.to_list()[index]
+
+    def __contains__(self, item) -> bool:
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __reversed__(self):
+        return reversed(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, OrderedSet):
+            return self.to_list() == other.to_list()
+        if isinstance(other, (list, tuple)):
+            return self.to_list() == list(other)
+        return NotImplemented
+
+    # copies don't share our membership
+    def __copy__(self) -> 'OrderedSet':
+        return OrderedSet(self._items)
+
+    def __deepcopy__(self, memo) -> 'OrderedSet':
+        return OrderedSet(deepcopy(item, memo) for item in self._items)
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+
+# Remembers how to undo each change made through it, so a block that might fail halfway can be rolled back
+# without deep copying everything it could touch up front (which is what StateCopy does).
+#
+#   undo = UndoLog()
+#   try:
+#       undo.set(info, 'state', 'new')
+#       undo.append(info.rooms_visited, 'room')
+#   except Exception:
+#       undo.rollback()
+class UndoLog:
+    _Missing = object()
+
+    def __init__(self):
+        self._undo: List[Callable[[], Any]] = []
+
+    def set(self, obj: Any, name: str, value: Any):
+        old = getattr(obj, name, self._Missing)
+        setattr(obj, name, value)
+        if old is self._Missing:
+            self._undo.append(lambda: delattr(obj, name))
+        else:
+            self._undo.append(lambda: setattr(obj, name, old))
+
+    def set_item(self, mapping: dict, key: Any, value: Any):
+        old = mapping.get(key, self._Missing)
+        mapping[key] = value
+        if old is self._Missing:
+            self._undo.append(lambda: mapping.pop(key, None))
+        else:
+            self._undo.append(lambda: mapping.__setitem__(key, old))
+
+    def update(self, mapping: dict, other: dict):
+        for key, value in other.items():
+            self.set_item(mapping, key, value)
+
+    def append(self, items: list, value: Any):
+        items.append(value)
+        self._undo.append(items.pop)
+
+    # undoes everything, newest first
+    def rollback(self):
+        while self._undo:
+            self._undo.pop()()
+
+    def __len__(self):
+        return len(self._undo)
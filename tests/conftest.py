@@ -1,6 +1,8 @@
 import pytest
 import trio_asyncio
 
+import spins_halp_line.resources.redis as redis_resource
+
 # With thanks to the trio-asyncio testing code
 # https://github.com/python-trio/trio-asyncio/blob/master/tests/conftest.py
 
@@ -10,4 +12,20 @@ async def loop():
         try:
             yield loop
         finally:
-            await loop.stop().wait()
\ No newline at end of file
+            await loop.stop().wait()
+
+
+# Each test gets its own trio run, so pooled redis connections from an earlier test can't be reused
+@pytest.fixture(autouse=True)
+def fresh_redis():
+    redis_resource._redis = None
+    yield
+    redis_resource._redis = None
+
+
+# For tests that should run without a redis server. Replaces the shared redis with an empty in-memory one.
+@pytest.fixture
+def memory_redis():
+    redis_resource._redis = redis_resource.redis_factory('memory://')
+    yield redis_resource._redis
+    redis_resource._redis = None
@@ -5,7 +5,10 @@ import spins_halp_line.actions.conferences
 from spins_halp_line.actions import twilio
 from spins_halp_line.actions import twilio
 from spins_halp_line.media.common import Conference_Hold_Music
+from spins_halp_line.actions import conferences
+from spins_halp_line.resources import codec
 from spins_halp_line.resources.numbers import PhoneNumber, Global_Number_Library
+from spins_halp_line.resources.redis import new_redis
 
 
 @pytest.mark.trio
@@ -33,3 +36,65 @@ async def test_number_index():
     await Global_Number_Library.load()
 
     print(Global_Number_Library.random())
+
+
+async def test_conference_ids(memory_redis, monkeypatch):
+    monkeypatch.setattr(conferences, '_conferences', {})
+    db = new_redis()
+    # saved the old way, in one list
+    await db.set('spins_conference_list', codec.encode([
+        {'id': 7, 'from': '+14155550100', 'participants': {}, 'sid': '', 'started': '', 'intros': {'+14155550101': 3}}
+    ]))
+    await conferences.load_conferences()
+    assert await new_redis().exists('spins_conference_list') == 0
+
+    # ids carry on from the ones we loaded
+    conf = await conferences.new_conference(PhoneNumber('+14155550100'))
+    assert conf.id == 8
+
+    # another process only has redis to go on
+    monkeypatch.setattr(conferences, '_conferences', {})
+    old = await conferences.get_conference('7')
+    assert old.intros == {'+14155550101': 3}
+    assert (await conferences.get_conference('8')).from_number == PhoneNumber('+14155550100')
+    assert await conferences.get_conference('9') is None
+    assert await conferences.get_conference('nope') is None
+
+
+async def test_add_participant_saves_first(memory_redis, monkeypatch):
+    monkeypatch.setattr(conferences, '_conferences', {})
+    conf = await conferences.new_conference(PhoneNumber('+14155550100'))
+    key = conferences.TwilConference._key(conf.id).encode()
+    seen = []
+
+    class Calls:
+        fail = False
+
+        @staticmethod
+        def create(url, to, from_):
+            if Calls.fail:
+                raise RuntimeError('twilio is down')
+            # the twiml callback can go anywhere as soon as the call is placed, so redis has to know already
+            seen.append(codec.decode(memory_redis.store.data[key])['intros'])
+
+    class Client:
+        calls = Calls
+
+    monkeypatch.setattr(conferences, '_twilio_client', Client)
+
+    class Intro:
+        id = 5
+
+    number = PhoneNumber('+14155550101')
+    await conf.add_participant(number, play_first=Intro())
+    assert seen == [{number.e164: 5}]
+    monkeypatch.setattr(conferences, '_conferences', {})
+    assert (await conferences.get_conference(str(conf.id))).intros == {number.e164: 5}
+
+    # nobody was called, so nobody's invited
+    Calls.fail = True
+    other = PhoneNumber('+14155550102')
+    with pytest.raises(RuntimeError):
+        await conf.add_participant(other)
+    monkeypatch.setattr(conferences, '_conferences', {})
+    assert other not in (await conferences.get_conference(str(conf.id))).invited
@@ -0,0 +1,20 @@
+import json
+from datetime import datetime
+
+from spins_halp_line.resources import codec
+from spins_halp_line.resources.numbers import PhoneNumber
+
+
+async def test_codec_round_trip():
+    when = datetime(2021, 3, 14, 12, 34, 56)
+    blob = codec.encode({'number': PhoneNumber("4156864014"), 'when': when, 'list': [1, 2]})
+
+    assert blob.startswith(b'~1')
+    assert codec.decode(blob) == {'number': '+14156864014', 'when': when.isoformat(), 'list': [1, 2]}
+
+
+async def test_codec_reads_legacy_json():
+    legacy = json.dumps({'version': 1, 'generation': 0})
+    assert codec.decode(legacy) == {'version': 1, 'generation': 0}
+    assert codec.decode(legacy.encode()) == {'version': 1, 'generation': 0}
+    assert codec.decode(None) is None
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+import trio
+
+import spins_halp_line.resources.redis as redis_resource
+from spins_halp_line.errors import SaveConflict
+from spins_halp_line.player import ScriptInfo, Player
+from spins_halp_line.resources.redis import new_redis, RedisBatch
+
+
+async def test_memory_redis_commands(memory_redis):
+    db = new_redis()
+    await db.set('a', 'one').hset('h', {'x': 1}).sadd('s', 'm1', 'm2').rpush('l', 'i1', 'i2', 'i3')
+
+    assert await db.get('a') == b'one'
+    assert await db.type('h') == 'hash'
+    assert await db.hgetall('h') == {'x': b'1'}
+    assert sorted(await db.smembers('s')) == [b'm1', b'm2']
+    assert await db.lrange('l', 1, -1) == [b'i2', b'i3']
+    assert await db.get('missing') is None
+    assert await db.incr('counter').incr('counter') == [1, 2]
+    # errors come back the way redio hands them over, not raised
+    assert 'WRONGTYPE' in str(await db.get('h'))
+
+    scan = await db.scan(0, 'MATCH', '*', 'COUNT', 1000)
+    assert scan[0] == b'0'
+    assert sorted(scan[1]) == [b'a', b'counter', b'h', b'l', b's']
+
+    assert await db.delete('a', 'h', 'nope') == 2
+    assert await db.exists('a') == 0
+
+
+async def test_memory_redis_latency(autojump_clock):
+    redis_resource._redis = redis_resource.redis_factory('memory://?latency_ms=50')
+
+    start = trio.current_time()
+    batch = RedisBatch()
+    pending = [batch.incr('k') for _ in range(10)]
+    await batch.flush()
+    assert trio.current_time() - start == pytest.approx(0.05)
+    assert [p.value for p in pending] == list(range(1, 11))
+    assert redis_resource.redis_stats()['round_trips'] == 1
+
+
+async def test_player_scripts_in_memory(memory_redis):
+    number = "+14155550150"
+    # stored before the hash layout
+    await new_redis().set(Player(number).key, json.dumps({
+        'version': 3, 'generation': 0,
+        'scripts': {'old': ScriptInfo(state='Legacy').to_dict()}
+    }))
+
+    first = Player(number)
+    second = Player(number)
+    await Player.load_all([first, second])
+    assert first.script('old').state == 'Legacy'
+
+    first.set_script('first', ScriptInfo())
+    await first.save()
+    assert await new_redis().type(first.key) == 'hash'
+
+    second.set_script('second', ScriptInfo())
+    with pytest.raises(SaveConflict):
+        await second.save()
+
+    check = Player(number)
+    await check.load()
+    assert set(check.scripts.keys()) == {'old', 'first'}
+    assert await Player._get_player_keys() == [first.key]
@@ -1,6 +1,12 @@
-from spins_halp_line.player import ScriptInfo
-from spins_halp_line.util import StateCopy
+import json
+
+import pytest
+
+from spins_halp_line.errors import SaveConflict
+from spins_halp_line.player import ScriptInfo, Player, HistoryPolicy, RoomInfo
+from spins_halp_line.util import StateCopy, RequestStats, UndoLog
 from spins_halp_line.resources.numbers import PhoneNumber
+from spins_halp_line.resources.redis import new_redis
 
 
 async def test_player_object():
@@ -16,6 +22,25 @@ async def test_player_object():
     snap.restore()
     assert si.state_manager == old_value
 
+async def test_undo_log():
+    si = ScriptInfo.from_dict({})
+    scene = si.add_scene('scene')
+    scene.room_state('room').data['seen'] = 1
+    before = si.to_dict()
+
+    undo = UndoLog()
+    undo.set(si, 'state', 'changed')
+    undo.append(scene.rooms_visited, 'room')
+    undo.set(scene, 'room_queue', ['next'])
+    undo.update(scene.room_state('room').data, {'seen': 2, 'new': True})
+    undo.set_item(scene.room_states, 'other', RoomInfo('other'))
+    assert si.to_dict() != before
+
+    undo.rollback()
+    assert si.to_dict() == before
+    assert len(undo) == 0
+
+
 async def test_phone_number():
     p1 = PhoneNumber("4156864014")
     p2 = PhoneNumber("+14156864014")
@@ -23,4 +48,236 @@ async def test_phone_number():
 
     assert p1.friendly == "(415) 686-4014"
     assert p2.friendly == "(415) 686-4014"
-    assert p3.friendly == "+55 11 2222-3333"
\ No newline at end of file
+    assert p3.friendly == "+55 11 2222-3333"
+
+
+async def test_save_conflict():
+    number = "+14155550100"
+    first = Player(number)
+    second = Player(number)
+    try:
+        await first.load()
+        await second.load()
+
+        first.set_script("first", ScriptInfo())
+        await first.save()
+
+        second.set_script("second", ScriptInfo())
+        with pytest.raises(SaveConflict) as conflict:
+            await second.save()
+        assert conflict.value.retryable
+
+        await second.update(lambda p: p.set_script("second", ScriptInfo()))
+
+        check = Player(number)
+        await check.load()
+        assert set(check.scripts.keys()) == {"first", "second"}
+    finally:
+        await Player.reset(number)
+
+
+async def test_save_over(memory_redis):
+    number = "+14155550108"
+    player = Player(number)
+    await player.load()
+    info = ScriptInfo()
+    info.data["from_request"] = 0
+    player.set_script("s", info)
+    await player.save()
+
+    ours = Player(number)
+    await ours.load()
+    # e.g. a conference event lands while we're handling a request
+    other = Player(number)
+    await other.load()
+    other.script("s").data["from_event"] = True
+    await other.save()
+
+    ours.script("s").state = "next"
+    ours.script("s").data["from_request"] = 1
+    with pytest.raises(SaveConflict):
+        await ours.save()
+    await ours.save_over()
+    assert ours.script("s").data == {"from_request": 1, "from_event": True}
+
+    check = Player(number)
+    await check.load()
+    assert check.script("s").state == "next"
+    assert check.script("s").data == {"from_request": 1, "from_event": True}
+
+    # forcing a save over a newer version still moves the version forward
+    stale = Player(number)
+    await stale.load()
+    await check.update(lambda p: p.script("s").data.update(again=True))
+    stale.script("s").state = "forced"
+    await stale.save(force=True)
+    assert stale._version == check._version + 1
+
+
+async def test_legacy_player_migration():
+    number = "+14155550101"
+    player = Player(number)
+    db = new_redis()
+    try:
+        legacy = {"version": 2, "scripts": {"old": {"data": {"a": 1}, "scene_states": {"s": {"data": {"b": 2}}}}}}
+        await db.set(player.key, json.dumps(legacy))
+
+        await player.load()
+        assert player.script("old").scene_states["s"].data == {"b": 2}
+        await player.save()
+
+        fields = await db.hgetall(player.key)
+        assert set(fields.keys()) == {"generation", "version", "old:position", "old:reg"}
+
+        check = Player(number)
+        await check.load()
+        assert check.script("old").data == {"a": 1}
+        assert check.script("old").scene_states["s"].data == {"b": 2}
+    finally:
+        await Player.reset(number)
+
+
+async def test_rebuild_index_once(memory_redis):
+    db = new_redis()
+    first, second = Player("+14155550111"), Player("+14155550112")
+    # players from before the index, only findable by scanning
+    await db.set(first.key, json.dumps({"version": 1}))
+    assert await Player.rebuild_index() == 1
+    assert await Player._get_player_keys() == [first.key]
+
+    # later startups don't scan
+    await db.set(second.key, json.dumps({"version": 1}))
+    assert await Player.rebuild_index() is None
+    assert await Player._get_player_keys() == [first.key]
+
+    assert await Player.rebuild_index(force=True) == 2
+    assert await Player._get_player_keys() == [first.key, second.key]
+
+
+async def test_unchanged_save_is_elided():
+    number = "+14155550102"
+    player = Player(number)
+    try:
+        await player.load()
+        player.set_script("s", ScriptInfo())
+        await player.save()
+
+        check = Player(number)
+        check.stats = RequestStats()
+        await check.load()
+        assert check.script("s") == ScriptInfo()
+        await check.save()
+        assert check.stats.writes == 0
+        assert check.stats.saves_elided == 1
+
+        check.script("s").add_scene("scene").room_state("room").data["flag"] = True
+        await check.save()
+        assert check.stats.writes == 1
+
+        final = Player(number)
+        await final.load()
+        assert final.script("s").scene("scene").room_state("room").data == {"flag": True}
+    finally:
+        await Player.reset(number)
+
+
+async def test_nested_changes_are_saved(memory_redis):
+    number = "+14155550109"
+    player = Player(number)
+    await player.load()
+    info = ScriptInfo()
+    info.data["nested"] = {"a": 1, "items": [1]}
+    player.set_script("s", info)
+    await player.save()
+
+    check = Player(number)
+    check.stats = RequestStats()
+    await check.load()
+    check.script("s").data["nested"]["a"] = 2
+    await check.save()
+    assert check.stats.writes == 1
+
+    # and dicts put in are kept as they are, not copied, so changing them afterwards counts too
+    again = Player(number)
+    await again.load()
+    added = {"b": 1}
+    again.script("s").data["nested"]["items"].append(added)
+    added["b"] = 2
+    await again.save()
+
+    final = Player(number)
+    await final.load()
+    assert final.script("s").data["nested"] == {"a": 2, "items": [1, {"b": 2}]}
+
+
+async def test_scoped_load(memory_redis):
+    number = "+14155550113"
+    player = Player(number)
+    await player.load()
+    player.set_script("mine", ScriptInfo(data={"a": 1}))
+    player.set_script("other", ScriptInfo(data={"b": 2}))
+    player.active_script = "mine"
+    await player.save()
+
+    scoped = Player(number)
+    await scoped.load(scripts=["mine"])
+    assert list(scoped.scripts.keys()) == ["mine"]
+    assert scoped.active_script == "mine"
+    await scoped.update(lambda p: p.script("mine").data.update(a=3))
+
+    check = Player(number)
+    await check.load()
+    assert check.script("mine").data == {"a": 3}
+    assert check.script("other").data == {"b": 2}
+
+
+async def test_history_compaction():
+    number = "+14155550103"
+    player = Player(number)
+    player.History = HistoryPolicy(rooms_visited=2, choices=2, scene_history=2)
+    try:
+        await player.load()
+        info = ScriptInfo()
+        scene = info.add_scene("scene")
+        for n in range(5):
+            scene.rooms_visited.append(f"room {n}")
+            scene.room_state("room 0").choices.append(str(n))
+        player.set_script("s", info)
+        await player.save()
+
+        check = Player(number)
+        await check.load()
+        assert check.script("s").scene("scene").rooms_visited == ["room 3", "room 4"]
+        assert check.script("s").scene("scene").prev_room == "room 4"
+        assert check.script("s").scene("scene").room_state("room 0").choices == ["3", "4"]
+
+        archived = await check.archived_history()
+        assert {"script": "s", "scene": "scene", "rooms_visited": ["room 0", "room 1", "room 2"]} in archived
+        assert {"script": "s", "scene": "scene", "room": "room 0", "choices": ["0", "1", "2"]} in archived
+    finally:
+        await Player.reset(number)
+
+
+async def test_snapshot_ring(memory_redis, monkeypatch):
+    from spins_halp_line.stories.story_objects import Snapshot
+    monkeypatch.setattr(Snapshot, 'Keep', 3)
+
+    player = Player("+14155550103")
+    await player.load()
+    player.set_script("s", ScriptInfo(state="before"))
+    await player.save()
+
+    await player.load()
+    snap = Snapshot(None, [player])
+    # the request goes on to change the player before it fails
+    player.script("s").state = "after"
+    await snap.save()
+
+    saved = await Snapshot.get_snapshot(snap.index)
+    assert saved.players[player.key]["scripts"]["s"]["state"] == "before"
+
+    # only the last Keep are kept
+    for _ in range(3):
+        await Snapshot(None, [player]).save()
+    assert await Snapshot.get_snapshot(snap.index) is None
+    assert [s['index'] for s in await Snapshot.list_snapshots()] == [4, 3, 2]
@@ -0,0 +1,164 @@
+import gc
+
+import trio
+
+import spins_halp_line.resources.redis as redis_resource
+import spins_halp_line.resources.locks as locks
+from spins_halp_line.resources.redis import RedisPool, RedisBatch, new_redis, new_pubsub
+from spins_halp_line.resources.locks import RedisLock, KeyedLocks, fenced_set
+from spins_halp_line.tasks import _get_task, SharedTask, TaskPoller
+from spins_halp_line.util import LockManager
+
+
+async def test_pool_limits_connections():
+    pool = RedisPool(max_connections=3)
+
+    async def ping():
+        await pool().ping()
+
+    async with trio.open_nursery() as nursery:
+        for _ in range(20):
+            nursery.start_soon(ping)
+
+    assert pool.opened <= 3
+    assert pool.commands['PING'].calls == 20
+    assert pool.data['idle'] == pool.opened
+
+
+async def test_pool_closes_abandoned_transactions():
+    pool = RedisPool()
+    db = pool()
+    await db.watch('test_abandoned_watch')
+    connection = db._pinned
+    assert not connection.closed
+
+    # left mid-WATCH, so it can't go back in the pool
+    del db
+    gc.collect()
+    assert connection.closed
+    assert pool.closed == 1
+    assert pool.data['idle'] == 0
+
+
+async def test_batch_is_one_round_trip():
+    db = new_redis()
+    await db.set('test_batch_a', b'1')
+    pool = redis_resource._redis
+    start = pool.round_trips
+
+    batch = RedisBatch()
+    first = batch.get('test_batch_a')
+    second = batch.incr('test_batch_b')
+    missing = batch.get('test_batch_missing')
+    assert await first == b'1'
+    assert second.value == 1
+    assert missing.value is None
+    assert pool.round_trips - start == 1
+
+    await new_redis().delete('test_batch_a', 'test_batch_b')
+
+
+async def test_batch_set_and_get(memory_redis):
+    # SET and PING replies are only checked by redio, they mustn't push later replies onto the wrong result
+    batch = RedisBatch()
+    stored = batch.set('test_batch_set', 'x')
+    pinged = batch.ping()
+    value = batch.get('test_batch_set')
+    missing = batch.get('test_batch_missing')
+    await batch.flush()
+    assert stored.value == 'OK'
+    assert pinged.value == 'PONG'
+    assert value.value == b'x'
+    assert missing.value is None
+
+    # and on its own, when redio unwraps the single reply
+    batch = RedisBatch()
+    assert await batch.set('test_batch_set', 'y') == 'OK'
+    assert await new_redis().get('test_batch_set') == b'y'
+
+
+async def test_redis_lock(memory_redis, monkeypatch):
+    monkeypatch.setattr(locks, '_renewer', None)
+    first = RedisLock('test_lock', lease_seconds=0.05)
+    second = RedisLock('test_lock')
+    assert await first.acquire() == 1
+    # the LeaseRenewer, which we don't run so first's lease runs out
+    _get_task.receive_nowait()
+
+    with trio.move_on_after(0.01):
+        await second.acquire()
+    assert not second.locked()
+
+    await trio.sleep(0.06)
+    assert await second.acquire() == 2
+    assert not await first.renew()
+    assert first.lost
+
+    # first doesn't know it lost the lock, but redis won't take its writes
+    assert await fenced_set(second, 'test_lock_value', b'second')
+    assert not await fenced_set(first, 'test_lock_value', b'first')
+    assert await new_redis().get('test_lock_value') == b'second'
+
+    # and letting go of it doesn't let go of second's
+    await first.release()
+    assert await new_redis().exists('lock:test_lock') == 1
+    await second.release()
+    assert await new_redis().exists('lock:test_lock') == 0
+
+
+class _Ping(SharedTask):
+    def __init__(self, name: str, delay: int = 0):
+        super(_Ping, self).__init__(delay)
+        self.name = name
+
+    def shared_args(self) -> dict:
+        return {'name': self.name}
+
+
+async def test_shared_task_queue(memory_redis):
+    poller = TaskPoller()
+    await TaskPoller.push(_Ping('now'))
+    await TaskPoller.push(_Ping('later', delay=60))
+
+    claimed = await poller.claim()
+    assert [task.name for task in claimed] == ['now']
+    assert claimed[0].delay == 0
+    # nobody else gets it
+    assert await poller.claim() == []
+    assert await new_redis().zcard('spins_tasks') == 1
+
+
+async def test_pubsub(memory_redis):
+    pubsub = await new_pubsub('test_events').connect()
+    assert await new_redis().publish('test_events', 'hello') == 1
+    async for message in pubsub:
+        assert message == b'hello'
+        break
+
+
+async def test_keyed_locks():
+    pool = KeyedLocks('test_keyed', 64)
+    first, second = '+14155550100', '+14155550101'
+    assert pool.stripe(first) is not pool.stripe(second)
+    order = []
+
+    async def hold(number, name, task_status=trio.TASK_STATUS_IGNORED):
+        async with LockManager(pool.lock(number)):
+            order.append(f'{name} in')
+            task_status.started()
+            await trio.sleep(0.01)
+            order.append(f'{name} out')
+
+    async with trio.open_nursery() as nursery:
+        # trio runs tasks started together in any order, so make sure a has it first
+        await nursery.start(hold, first, 'a')
+        nursery.start_soon(hold, first, 'b')
+        nursery.start_soon(hold, second, 'c')
+        await trio.sleep(0.005)
+        # c didn't wait for a, b did
+        assert sorted(order) == ['a in', 'c in']
+
+    assert order.index('b in') > order.index('a out')
+    assert pool.stats['acquired'] == 3
+    assert pool.stats['contended'] == 1
+    assert pool.stats['wait_ms_max'] >= 5
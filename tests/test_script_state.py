@@ -1,9 +1,25 @@
 import pytest
+import trio
 from typing import List
 from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
 
-from spins_halp_line.stories.story_objects import ScriptStateManager, StateShard, ScriptState, Shard
-from spins_halp_line.resources.redis import delete_key
+from spins_halp_line.stories.story_objects import (
+    ScriptStateManager, FieldStateManager, StateShard, ScriptState, Shard, Change, Script, SceneAndState
+)
+from spins_halp_line.stories.tele_story_objects import TeleState, TeleShard
+from spins_halp_line.stories.telemarketopia import TeleStateManager
+from spins_halp_line.stories.matchmaking import Matchmaker
+from spins_halp_line.stories.dispatch import Dispatcher
+from spins_halp_line.stories.request_context import RequestContext
+from spins_halp_line.constants import Script_New_State, Script_Any_Number
+from spins_halp_line.player import Player, ScriptInfo
+from spins_halp_line.resources.numbers import PhoneNumber
+from spins_halp_line.twil import TwilRequest
+from spins_halp_line.resources import codec
+from spins_halp_line.resources.redis import delete_key, new_redis
+from spins_halp_line.tasks import _get_task
+from spins_halp_line.errors import SaveConflict
 
 @dataclass
 class TestState:
@@ -63,4 +79,461 @@ async def test_state_shard():
 
     assert ss.version == 2
     with pytest.raises(ValueError):
-        ss.version += 1
\ No newline at end of file
+        ss.version += 1
+
+@dataclass
+class ListState:
+    players: List[str] = field(default_factory=list)
+
+
+class ListShard(ListState, Shard):
+    def __init__(self, *args, **kwargs):
+        Shard.__init__(self)
+        ListState.__init__(self, *args, **kwargs)
+
+
+class ListManager(ScriptStateManager):
+    def _make_new_state(self, base: dict = None) -> ListState:
+        return ListState(**(base or {}))
+
+    def _make_shard(self) -> ListShard:
+        shard = ListShard(**self.dict)
+        shard.set_parent(self)
+        return shard
+
+
+async def test_integrate_is_versioned(memory_redis):
+    first = ListManager()
+    first.set_key('test_versioned_state')
+    second = ListManager()
+    second.set_key('test_versioned_state')
+    await first.load_from_redis()
+    await second.load_from_redis()
+
+    shard = first.shard
+    shard.append('players', 'a')
+    trips = memory_redis.round_trips
+    await shard.integrate()
+    assert memory_redis.round_trips - trips == 1
+    assert first.version == 1
+
+    # second is a version behind, so its save bounces and is re-applied to first's copy
+    shard = second.shard
+    shard.append('players', 'b')
+    await shard.integrate()
+    assert second.dict['players'] == ['a', 'b']
+    assert second.version == 2
+
+    # nothing changed, only the journal is read
+    trips = memory_redis.round_trips
+    await second.reduce()
+    assert memory_redis.round_trips - trips == 1
+
+    check = ListManager()
+    check.set_key('test_versioned_state')
+    await check.load_from_redis()
+    assert check.dict['players'] == ['a', 'b']
+    assert check.version == 2
+
+    async def mutate(state):
+        check.mark_dirty()
+
+    with pytest.raises(ValueError):
+        await check.update(mutate, attempts=0)
+    assert check.version == 2
+
+
+@dataclass
+class QueueState:
+    players: List[str] = field(default_factory=list)
+    waiting: List[str] = field(default_factory=list)
+    matched: List[str] = field(default_factory=list)
+
+
+class QueueShard(QueueState, Shard):
+    def __init__(self, *args, **kwargs):
+        Shard.__init__(self)
+        QueueState.__init__(self, *args, **kwargs)
+
+
+class QueueManager(FieldStateManager):
+    Reduce_Fields = ['waiting']
+
+    def _make_new_state(self, base: dict = None) -> QueueState:
+        return QueueState(**(base or {}))
+
+    def _make_shard(self) -> QueueShard:
+        shard = QueueShard(**self.dict)
+        shard.set_parent(self)
+        return shard
+
+    async def do_reduce(self, state: QueueState, shard: QueueShard):
+        while len(state.waiting) >= 2:
+            state.matched.extend([state.waiting.pop(0), state.waiting.pop(0)])
+            self.mark_dirty()
+        return state
+
+
+async def test_field_state(memory_redis):
+    key = 'test_field_state'
+    # saved as a single blob before
+    await new_redis().set(key, codec.encode({'players': ['a', 'b'], 'waiting': ['a'], 'matched': [],
+                                             'version': 7, 'generation': 0}))
+    first = QueueManager()
+    first.set_key(key)
+    await first.load_from_redis()
+    assert first.dict == {'players': ['a', 'b'], 'waiting': ['a'], 'matched': []}
+    assert await new_redis().zrange(f'{key}:players', 0, -1) == [b'a', b'b']
+
+    second = QueueManager()
+    second.set_key(key)
+    await second.load_from_redis()
+
+    # a change is one round trip however many players there are
+    shard = first.shard
+    shard.append('players', 'c')
+    shard.append('waiting', 'c', to_front=True)
+    trips = memory_redis.round_trips
+    await shard.integrate()
+    assert memory_redis.round_trips - trips == 1
+    assert first.dict['waiting'] == ['c', 'a']
+
+    # second hasn't seen 'c' join, but reduce re-reads the waiting list first
+    shard = second.shard
+    shard.append('players', 'd')
+    await second.reduce(shard.take_changes())
+    assert second.dict['waiting'] == []
+    assert second.dict['matched'] == ['c', 'a']
+
+    check = QueueManager()
+    check.set_key(key)
+    await check.load_from_redis()
+    assert check.dict == {'players': ['a', 'b', 'c', 'd'], 'waiting': [], 'matched': ['c', 'a']}
+
+
+async def test_journal_replay(memory_redis):
+    key = 'test_journal_replay'
+    first = ListManager()
+    first.set_key(key)
+    await first.load_from_redis()
+
+    shard = first.shard
+    shard.append('players', 'a')
+    await first.integrate_shard(shard)
+    # the reducer, which we don't run
+    _get_task.receive_nowait()
+    assert [seq for seq, _ in await first.journal.read_after(0)] == [1]
+
+    # first goes away before reducing, whoever loads next picks the change up
+    second = ListManager()
+    second.set_key(key)
+    await second.load_from_redis()
+    assert second.dict['players'] == ['a']
+    assert second.version == 1
+
+    # and it isn't applied twice when first gets to it
+    await first.reduce()
+    assert first.dict['players'] == ['a']
+    assert first.version == 1
+
+    first.Journal_Keep = 2
+    for player in 'bcd':
+        shard = first.shard
+        shard.append('players', player)
+        await first.integrate_shard(shard)
+        await first.reduce()
+    assert [seq for seq, _ in await first.journal.read_after(0)] == [3, 4]
+
+    # entry 2 is gone, so second has to go back to the checkpoint
+    await second.reduce()
+    assert second.dict['players'] == ['a', 'b', 'c', 'd']
+
+
+class CountingManager(ListManager):
+    reduces = 0
+
+    async def do_reduce(self, state: ListState, shard: ListShard):
+        self.reduces += 1
+        return state
+
+
+async def test_reducer_coalesces(memory_redis, autojump_clock):
+    state = CountingManager()
+    state.set_key('test_reducer_coalesces')
+    await state.load_from_redis()
+
+    async def request(player):
+        shard = state.shard
+        shard.append('players', player)
+        await state.integrate_shard(shard)
+
+    async with trio.open_nursery() as nursery:
+        for player in 'abcde':
+            nursery.start_soon(request, player)
+    reducer = _get_task.receive_nowait()
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(reducer.execute)
+        await trio.sleep(1)
+        nursery.cancel_scope.cancel()
+
+    assert state.reduces == 1
+    assert sorted(state.dict['players']) == ['a', 'b', 'c', 'd', 'e']
+    assert state.reducer_stats['batches'] == 1
+    assert state.reducer_stats['shards'] == 5
+    assert state.reducer_stats['max_lag_ms'] == pytest.approx(state.Reduce_Delay * 1000)
+
+
+class FlakyManager(CountingManager):
+    Journal_Changes = False
+
+    async def do_reduce(self, state: ListState, shard: ListShard):
+        await super(FlakyManager, self).do_reduce(state, shard)
+        if self.reduces == 1:
+            state.players.append('half done')
+            raise RuntimeError('redis went away')
+        return state
+
+
+async def test_reducer_retries_unjournaled(memory_redis, autojump_clock):
+    state = FlakyManager()
+    state.set_key('test_reducer_retries_unjournaled')
+    await state.load_from_redis()
+    await state.save_to_redis()
+
+    shard = state.shard
+    shard.append('players', 'a')
+    await state.integrate_shard(shard)
+    reducer = _get_task.receive_nowait()
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(reducer.execute)
+        await trio.sleep(5)
+        nursery.cancel_scope.cancel()
+
+    # applied by the second reduce and saved, without what the first one left behind
+    assert state.reduces == 2
+    assert state.dict['players'] == ['a']
+    assert state.reducer_stats['failed_changes'] == 0
+    await state.load_from_redis()
+    assert state.dict['players'] == ['a']
+
+
+async def test_field_state_journal(memory_redis):
+    key = 'test_field_state_journal'
+    first = QueueManager()
+    first.set_key(key)
+    await first.load_from_redis()
+    second = QueueManager()
+    second.set_key(key)
+    await second.load_from_redis()
+
+    for player in 'xy':
+        shard = first.shard
+        shard.append('waiting', player)
+        await first.integrate_shard(shard)
+    _get_task.receive_nowait()
+
+    await second.reduce()
+    assert second.dict['matched'] == ['x', 'y']
+
+    # first replays nothing, redis says both entries are applied
+    await first.reduce()
+    assert first.dict['waiting'] == []
+    assert await new_redis().hget(f'{key}:version', 'applied') == b'2'
+
+    check = QueueManager()
+    check.set_key(key)
+    await check.load_from_redis()
+    assert check.dict == {'players': [], 'waiting': [], 'matched': ['x', 'y']}
+
+
+async def test_tele_state_lists():
+    state = TeleState(clavae_players=['a', 'b', 'a'], karen_players=['c'])
+    assert state.clavae_players == ['a', 'b']
+    state.clavae_waiting_for_conf.append('a')
+    assert state.lists_with('a') == {'clavae_players', 'clavae_waiting_for_conf'}
+
+    Change(From='clavae_waiting_for_conf', To='clavae_in_conf', Value=['a']).apply(state)
+    assert state.lists_with('a') == {'clavae_players', 'clavae_in_conf'}
+    state.clavae_in_conf = []
+    assert state.lists_with('a') == {'clavae_players'}
+
+    Change(To='clavae_players', Value=['d'], At_Front=True).apply(state)
+    assert state.clavae_players.pop(0) == 'd'
+    assert state.lists_with('d') == set()
+
+    # stored as plain lists, and shards get their own index
+    assert codec.decode(codec.encode(asdict(state)))['clavae_players'] == ['a', 'b']
+    shard = TeleShard(**asdict(state))
+    assert shard.lists_with('c') == {'karen_players'}
+    assert state.lists_with('c') == {'karen_players'}
+
+
+class ViewManager(ScriptStateManager):
+    def _make_new_state(self, base: dict = None) -> QueueState:
+        return QueueState(**(base or {}))
+
+
+async def test_state_view(memory_redis):
+    state = ViewManager()
+    state.set_key('test_state_view')
+    await state.load_from_redis()
+    state._state.players.extend(['a', 'b'])
+
+    shard = state.shard
+    # nothing is copied until it's read
+    shard.append('waiting', 'a')
+    assert vars(shard).keys().isdisjoint({'players', 'waiting', 'matched'})
+
+    assert shard.players == ['a', 'b']
+    shard.players.append('z')
+    assert state.dict['players'] == ['a', 'b']
+
+    shard.move('players', 'matched', 'b')
+    await shard.integrate()
+    assert state.dict == {'players': ['a'], 'waiting': ['a'], 'matched': ['b']}
+
+    with pytest.raises(ValueError):
+        shard.append('nope', 'a')
+    with pytest.raises(ValueError):
+        shard.players = []
+
+
+async def test_matchmaker():
+    now = datetime(2021, 3, 14, 12)
+    clock = [0]
+    matchmaker = Matchmaker(lambda: clock[0])
+    matchmaker.observe(['c1'], [])
+    clock[0] = 30
+
+    last_ready = {'c3': (now - timedelta(minutes=1)).isoformat(), 'c2': (now - timedelta(hours=1)).isoformat()}
+    pairs = matchmaker.match(['c1', 'c2', 'c3'], ['k1', 'k2'], last_ready, now)
+    # c3 was around recently, c1 has waited longer than c2
+    assert pairs == [('c3', 'k1'), ('c1', 'k2')]
+    assert matchmaker.stats['pairs'] == 2
+    assert matchmaker.stats['waiting'] == 1
+    assert matchmaker.stats['wait_p90'] == 30
+
+
+async def test_tele_matchmaking_timer(memory_redis, autojump_clock):
+    state = TeleStateManager()
+    state.set_key('test_tele_matchmaking_timer')
+    await state.load_from_redis()
+
+    shard = state.shard
+    for n in range(3):
+        shard.append('clavae_waiting_for_conf', f'+1415555020{n}')
+    for n in range(2):
+        shard.append('karen_waiting_for_conf', f'+1415555030{n}')
+    # straight into redis, no reduce
+    await state.integrate(shard.take_changes())
+
+    reducer = await state.start_reducer()
+    _get_task.receive_nowait()
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(reducer.execute)
+        await trio.sleep(state.Reduce_Every + 1)
+        nursery.cancel_scope.cancel()
+
+    assert state.reducer_stats['timed'] == 1
+    assert state.dict['clavae_waiting_for_conf'] == ['+14155550202']
+    assert state.dict['clavae_in_conf'] == ['+14155550200', '+14155550201']
+    assert state.dict['karen_in_conf'] == ['+14155550300', '+14155550301']
+    assert [type(_get_task.receive_nowait()).__name__ for _ in range(2)] == ['ConfStartFirst'] * 2
+
+
+# Someone else adds a Karen player while each of our first `conflicts` reduces is running
+class ConflictingTeleManager(TeleStateManager):
+    def __init__(self, other: TeleStateManager, conflicts: int):
+        super(ConflictingTeleManager, self).__init__()
+        self.other = other
+        self.conflicts = conflicts
+        self.runs = 0
+
+    async def do_reduce(self, state, shard):
+        state = await super(ConflictingTeleManager, self).do_reduce(state, shard)
+        self.runs += 1
+        if self.runs <= self.conflicts:
+            other_shard = self.other.shard
+            other_shard.append('karen_waiting_for_conf', f'+141555503{self.runs:02}')
+            await self.other.integrate(other_shard.take_changes())
+        return state
+
+
+async def test_tele_reduce_conflict(memory_redis):
+    key = 'test_tele_reduce_conflict'
+    other = TeleStateManager()
+    other.set_key(key)
+    await other.load_from_redis()
+
+    state = ConflictingTeleManager(other, conflicts=1)
+    state.set_key(key)
+    await state.load_from_redis()
+    shard = state.shard
+    for n in range(2):
+        shard.append('clavae_waiting_for_conf', f'+1415555020{n}')
+    shard.append('karen_waiting_for_conf', '+14155550300')
+
+    await state.reduce(shard.take_changes())
+    # the first run paired one couple and didn't get saved, the second paired both
+    assert state.runs == 2
+    assert len(state.dict['clavae_in_conf']) == 2
+    tasks = [_get_task.receive_nowait() for _ in range(2)]
+    assert sorted(task.info.c_num.e164 for task in tasks) == sorted(state.dict['clavae_in_conf'])
+    assert sorted(task.info.k_num.e164 for task in tasks) == sorted(state.dict['karen_in_conf'])
+    with pytest.raises(trio.WouldBlock):
+        _get_task.receive_nowait()
+
+    # nothing starts if the pairing never gets saved
+    state.conflicts = state.runs + 3
+    shard = state.shard
+    shard.append('clavae_waiting_for_conf', '+14155550209')
+    shard.append('karen_waiting_for_conf', '+14155550399')
+    with pytest.raises(SaveConflict):
+        await state.reduce(shard.take_changes())
+    with pytest.raises(trio.WouldBlock):
+        _get_task.receive_nowait()
+
+
+def _fake_call(caller: str, called: str) -> TwilRequest:
+    req = TwilRequest(None)
+    req._data = {'From': caller, 'To': called, 'CallSid': 'CA0'}
+    req._loaded = True
+    return req
+
+
+async def test_dispatcher(memory_redis):
+    first = Script('dispatch_first', {
+        Script_New_State: {'+14155550150': SceneAndState(None, 'started')},
+        'started': {Script_Any_Number: SceneAndState(None, 'started')}
+    }, ScriptStateManager())
+    second = Script('dispatch_second', {
+        Script_New_State: {'+14155550151': SceneAndState(None, 'started')}
+    }, ScriptStateManager())
+    dispatcher = Dispatcher([first, second])
+    caller = '+14155550160'
+
+    # new players go by the number they called
+    assert await dispatcher.call_script(RequestContext(_fake_call(caller, '+14155550151'))) is second
+    assert await dispatcher.call_script(RequestContext(_fake_call(caller, '+14155550152'))) is None
+    assert first._get_scene_state(ScriptInfo('started'), PhoneNumber('+14155550152')) is not None
+
+    # a player from before the marker: found the slow way, and marked when they're saved
+    player = Player(caller)
+    await player.load()
+    player.set_script(second.name, ScriptInfo('started'))
+    await player.save()
+
+    ctx = RequestContext(_fake_call(caller, '+14155550150'))
+    assert await dispatcher.call_script(ctx) is second
+    await (await ctx.caller_player()).save()
+
+    player = Player(caller)
+    await player.load()
+    assert player.active_script == second.name
+    assert player.scripts.decoded == {}
+
+    await first.start_game_for_player(player)
+    await player.save()
+    assert await dispatcher.active_script(RequestContext(_fake_call(caller, '+14155550150'))) is first
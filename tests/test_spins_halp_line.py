@@ -1,6 +1,10 @@
 from typing import Optional
 
+import pytest
+
+from spins_halp_line.errors import StoryNavigationException
 from spins_halp_line.stories.story_objects import Script, Scene, Room, SceneAndState, RoomContext
+from spins_halp_line.stories.tele_story_objects import PathScene
 from spins_halp_line.player import ScriptInfo, Player
 from spins_halp_line.resources.numbers import PhoneNumber
 from spins_halp_line.constants import (
@@ -216,3 +220,56 @@ async def test_state():
     print(f'player.scripts: {player.scripts}')
     print(f'loaded: {player._load_scripts(player_data)}')
     assert player._load_scripts(player_data) == player.scripts
+
+
+async def test_scene_graph():
+    one, two, three = RoomTestOne(1), RoomTestTwo(2), RoomTestThree(3)
+
+    class PathTestScene(PathScene):
+        Name = "Path Scene"
+        Start = [one]
+        Choices = {
+            one: {
+                'left': {'1': [two, three], '*': one},
+                'right': {'*': three},
+            },
+            two: {
+                '*': {'1': one}
+            },
+            three: {
+                '*': {'*': two}
+            },
+        }
+
+    graph = PathTestScene().compile()
+    assert graph.start == [one.Name]
+    assert graph.next_rooms(one.Name, '1', 'left') == [two.Name, three.Name]
+    assert graph.next_rooms(one.Name, '5', 'left') == [one.Name]
+    assert graph.next_rooms(one.Name, '1', 'right') == [three.Name]
+    # only a '*' path, so any path goes
+    assert graph.next_rooms(two.Name, '1', 'right') == [one.Name]
+    # no '*' digit
+    assert graph.next_rooms(two.Name, '9', 'left') == []
+    with pytest.raises(KeyError):
+        graph.next_rooms(one.Name, '1', 'up')
+    assert not graph.is_terminal(one.Name)
+    # queues are copies, the player's queue gets popped
+    graph.next_rooms(one.Name, '1', 'left').pop()
+    assert graph.next_rooms(one.Name, '1', 'left') == [two.Name, three.Name]
+
+    class BrokenScene(Scene):
+        Name = "Broken Scene"
+        Start = [one]
+        Choices = {one: {'1': 'Nowhere'}}
+
+    with pytest.raises(StoryNavigationException):
+        BrokenScene().compile()
+
+    class LeafScene(Scene):
+        Name = "Leaf Scene"
+        Start = [one]
+        Choices = {one: {'1': two}, three: {'1': one}}
+
+    graph = LeafScene().compile()
+    assert graph.is_terminal(two.Name)
+    assert graph.unreachable == [three.Name]